@@ -1,9 +1,30 @@
 import json
-import copy
+import binascii
+import hashlib
+import heapq
+import math
 import random
-from functools import reduce
+import threading
+import time
+import types
+import warnings
+from contextlib import contextmanager
+from functools import partial, reduce
 import plyvel
 from ._version import schema_version
+from .codec import get_codec
+from . import columnar, fileio, frames, grouping, join, parallel
+from .pipeline import Pipeline
+from .keyindex import KeyIndex, encode_key, decode_key
+from .indexes import SecondaryIndex
+from .columns import StoredColumn, MISSING, field_records, field_rows
+from .sortkey import prefix_end
+from .cache import RecordCache
+
+# Deleted ids logged before a key index is rewritten, however few runs it has
+MIN_KEY_LOG = 1000
+# Base layers a collection may read before cloning it copies its records instead
+MAX_LAYERS = 8
 
 class DB:
     """
@@ -16,23 +37,142 @@ class DB:
 
     Arguments:
     `database_path` -- The path to the folder for database storage
+
+    Keyword arguments:
+    `batch_size` -- The number of writes grouped into one LevelDB write batch by bulk operations
+    `batch_bytes` -- The number of key and value bytes after which a write batch is committed early
+    `sync` -- When True every write and write batch is synced to disk before returning
+    `background_reclaim` -- When True the records of reset and deleted collections are
+        deleted by a background thread.  Otherwise they are kept until ``reclaim()`` is called.
+    `cache_entries` -- When set, up to this many decoded records read by index are kept in
+        an LRU cache shared by all collections
+    `cache_bytes` -- When set, the shared record cache holds at most this many encoded bytes
+
+    A DB and its collections can be shared by threads.  Writes to a
+    collection are serialized by its ``lock``, which a thread holds for the
+    whole of a ``Collection.batch()`` block, so record ids are allocated
+    atomically.  Reads take no lock: they see the collection as of its last
+    committed write batch, and reads of several records use a LevelDB
+    snapshot, so they never see a write batch half applied.
     """
 
-    def __init__(self, database_path, **kwargs):         
+    def __init__(self, database_path, batch_size=10000, batch_bytes=4*1024*1024,
+        sync=False, background_reclaim=True, cache_entries=None, cache_bytes=None, **kwargs):
         self.db=plyvel.DB(database_path, **kwargs)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.sync = sync
+        self.background_reclaim = background_reclaim
+        self.record_cache = None
+        if cache_entries or cache_bytes:
+            self.record_cache = RecordCache(cache_entries, cache_bytes)
 
         self.collections_set=self.db.prefixed_db(b'collections/')
         self.collection_items_set=self.db.prefixed_db(b'collection-items/')
+        self.garbage_set=self.db.prefixed_db(b'garbage/')
         self.collections_cache = {}
-
-        try:
-            self.schema_version = decode(self.db.get(b'pypeline-schema-version'))
-        except:
+        self.lock = threading.RLock()
+        self._generation_lock = threading.Lock()
+        # Prefixes being written that already have a garbage entry
+        self._writing_prefixes = set()
+        # Held by reclaim() while it decides a prefix is garbage, and by
+        # writers while they stop writing a prefix
+        self._reclaim_lock = threading.Lock()
+
+        self._reclaim_thread = None
+        self._reclaim_wanted = threading.Event()
+        self._closing = False
+
+        stored_version = self.db.get(b'pypeline-schema-version')
+        if stored_version is None:
             self.schema_version = schema_version
             self.db.put(b'pypeline-schema-version', encode(schema_version))
+        else:
+            self.schema_version = decode(stored_version)
+            self._migrate()
+
+        self._schedule_reclaim()
+
+    def _migrate(self):
+        """
+        Upgrades the on-disk layout written by older versions of pypeline
+        to the current schema version, one version at a time.
+        """
+        while self.schema_version != schema_version:
+            if self.schema_version not in migrations:
+                raise ValueError("Cannot migrate database from schema version '{0}' to '{1}'"
+                    .format(self.schema_version, schema_version))
+            self.schema_version = migrations[self.schema_version](self)
+            self.db.put(b'pypeline-schema-version', encode(self.schema_version))
+
+    def _next_generation(self):
+        """
+        Allocates a storage generation.  Every collection keeps its records
+        under a generation-specific key prefix, so a collection can be
+        emptied by moving it to a fresh generation.
+        """
+        with self._generation_lock:
+            data = self.db.get(b'pypeline-generation')
+            generation = 1 if data is None else decode(data) + 1
+            self.db.put(b'pypeline-generation', encode(generation))
+            return generation
+
+    def reclaim(self):
+        """
+        Deletes the records left behind by reset and deleted collections and
+        compacts the key ranges they occupied.  This runs automatically in a
+        background thread unless the DB was opened with ``background_reclaim=False``.
+        """
+        for prefix in list(self.garbage_set.iterator(include_value=False)):
+            # A prefix switched to since it was listed has lost its garbage
+            # entry by the time it stops being written, and a garbage prefix
+            # nobody writes never becomes live again
+            with self._reclaim_lock:
+                if prefix in self._writing_prefixes or self.garbage_set.get(prefix) is None:
+                    continue
+            stale = self.db.prefixed_db(prefix)
+            # One iterator for the whole prefix, so no batch steps over the
+            # tombstones written by the ones before it
+            batch = stale.write_batch()
+            deleted = 0
+            for key in stale.iterator(include_value=False):
+                if self._closing:
+                    return
+                batch.delete(key)
+                deleted += 1
+                if deleted % self.batch_size == 0:
+                    batch.write()
+                    batch = stale.write_batch()
+            batch.write()
+            if self._closing:
+                return
+            self.garbage_set.delete(prefix)
+            self.db.compact_range(start=prefix, stop=prefix_end(prefix))
+
+    def _schedule_reclaim(self):
+        if not self.background_reclaim:
+            return
+        if self._reclaim_thread is None:
+            self._reclaim_thread = threading.Thread(target=self._reclaim_loop)
+            self._reclaim_thread.daemon = True
+            self._reclaim_thread.start()
+        self._reclaim_wanted.set()
+
+    def _reclaim_loop(self):
+        while True:
+            self._reclaim_wanted.wait()
+            self._reclaim_wanted.clear()
+            if self._closing:
+                return
+            try:
+                self.reclaim()
+            except Exception as e:
+                # Keep the thread for the next request, which retries what is left
+                if not self._closing:
+                    warnings.warn("Reclaiming deleted records failed: {0!r}".format(e), RuntimeWarning)
 
     def collection(self, collection_name, reset_collection=False, 
-        create_if_missing=True, error_if_exists=False):
+        create_if_missing=True, error_if_exists=False, codec=None, layout=None):
         """
         Returns the collection stored at `collection_name`, or creates it if it doesn't exist.
 
@@ -43,22 +183,37 @@ class DB:
         | ``reset_collection`` -- when True any existant data in the collection is deleted before it is returned
         | ``create_if_missing`` -- when False a ValueError is raised if the collection doesn't exist
         | ``error_if_exists`` -- When True a ValueError is raised if the collection already exists 
+        | ``codec`` -- The name of the codec records are stored with (default: 'json').
+            The codec of an existing collection can only be changed while it is empty or being reset.
+        | ``layout`` -- 'records' (the default) or 'columnar'.  See ``Collection.set_layout()``.
         """
 
-        if collection_name not in self.collections_cache:
-            data = self.collections_set.get(collection_name.encode())
-            if data == None:
-                if create_if_missing == False:
-                    raise ValueError("Collection '{0}' does not exist".format(collection_name))
-                self.collections_set.put(collection_name.encode(), b'true')
-            self.collections_cache[collection_name] = Collection(self, self.collection_items_set, collection_name)
-        elif error_if_exists:
-            raise ValueError("Collection '{0}' already exists".format(collection_name))
-
+        with self.lock:
+            if collection_name not in self.collections_cache:
+                data = self.collections_set.get(collection_name.encode())
+                if data == None:
+                    if create_if_missing == False:
+                        raise ValueError("Collection '{0}' does not exist".format(collection_name))
+                    if '!!' in collection_name:
+                        raise ValueError("Disallowed character sequence '!!' in collection name")
+                    get_codec(codec or 'json')
+                    generation = self._next_generation()
+                    data = encode({'generation': generation, 'created': generation, 'codec': codec or 'json'})
+                    self.collections_set.put(collection_name.encode(), data)
+                self.collections_cache[collection_name] = Collection(self, self.collection_items_set,
+                    collection_name, decode(data))
+            elif error_if_exists:
+                raise ValueError("Collection '{0}' already exists".format(collection_name))
+
+            collection = self.collections_cache[collection_name]
         if reset_collection:
-            self.collections_cache[collection_name].delete_all()
+            collection.delete_all()
+        if codec is not None and codec != collection.codec.name:
+            collection.set_codec(codec)
+        if layout is not None and layout != collection.layout:
+            collection.set_layout(layout)
 
-        return self.collections_cache[collection_name]
+        return collection
 
     def collections(self):
         """
@@ -69,7 +224,11 @@ class DB:
 
     def copy_collection(self, old_collection, new_collection, start=None, end=None, **kwargs):
         """
-        Copies all instances in the old_collection into the new_collection
+        Copies all instances in the old_collection into the new_collection.
+
+        Unless a different codec is requested, the copy is a copy-on-write
+        clone made with ``Collection.clone()``, which takes constant time
+        and space.
 
         | Arguments:
         | ``old_collection`` -- The string name of the old collection
@@ -82,11 +241,58 @@ class DB:
         | ``error_if_exists`` -- When True a ValueError is raised if the collection already exists (default: False)
         """
         old = self.collection(old_collection, create_if_missing=False)
+        if kwargs.get('codec') in [None, old.codec.name]:
+            return old.clone(new_collection, start, end, **kwargs)
+
         new = self.collection(new_collection, reset_collection=True, **kwargs)
         new.append_all(old.iterator(start, end))
 
         return new
 
+    def join(self, left, right, left_key, right_key, new_collection, how='inner',
+        max_entries=100000, **kwargs):
+        """
+        Joins two collections on equal keys and inserts a ``[left record, right record]``
+        record per matching pair into a new collection.
+
+        When one collection has at most ``max_entries`` records it is loaded
+        into a hash table and the other is streamed past it, and pairs follow
+        the order of the streamed collection (the left one when both fit).
+        Otherwise both collections are sorted by key on disk and merged, so
+        memory use is bounded by the largest group of right records with
+        one key, and pairs are in key order (see ``sortkey``).
+
+        | Arguments:
+        | ``left`` -- The string name of the left collection
+        | ``right`` -- The string name of the right collection
+        | ``left_key`` -- A function returning the join key of a left record
+        | ``right_key`` -- A function returning the join key of a right record.  Keys must be None,
+            booleans, numbers, strings, bytes or lists of these.
+        | ``new_collection`` -- The name of the collection to insert the pairs into.
+            Any existing values will be deleted.
+
+        | Keyword arguments:
+        | ``how`` -- 'inner' to keep matching pairs only, or 'left' to also pair every left
+            record without a match with None
+        | ``max_entries`` -- The number of records of one collection held in memory for a hash join
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        if how not in join.JOINS:
+            raise ValueError("Unknown join '{0}', use 'inner' or 'left'".format(how))
+        if new_collection in [left, right]:
+            raise ValueError("Cannot write a join into its source collection '{0}'".format(new_collection))
+
+        left = self.collection(left, create_if_missing=False)
+        right = self.collection(right, create_if_missing=False)
+        with self._scratch() as scratch, left.snapshot() as left_view, right.snapshot() as right_view:
+            new = self.collection(new_collection, reset_collection=True, **kwargs)
+            with new.batch():
+                for pair in join.join_records(left_view, right_view, left_key, right_key, how,
+                        scratch, max_entries):
+                    new.append(pair)
+        return new
+
     def delete(self, collection_name):
         """
         Deletes a collection.
@@ -95,17 +301,73 @@ class DB:
         | ``collection_name`` -- the name of the collection to delete
         """
 
-        self.collection(collection_name).delete_all()
-        self.collections_set.delete(collection_name.encode())
-        del self.collections_cache[collection_name]
+        collection = self.collection(collection_name)
+        with collection.lock, self.lock:
+            with self.db.write_batch(sync=self.sync) as batch:
+                batch.delete(b'collections/' + collection_name.encode())
+                batch.delete(b'collection-index/' + collection_name.encode())
+                if 'key_log' in collection.metadata:
+                    batch.put(b'garbage/' + _key_log_prefix(collection.metadata['key_log']), b'')
+                for prefix in self._unreferenced(collection._prefixes(), collection_name):
+                    batch.put(b'garbage/' + prefix, b'')
+                for index in collection._secondary():
+                    batch.put(b'garbage/' + index.prefix, b'')
+            collection._invalidate_cache()
+        with self.lock:
+            self.collections_cache.pop(collection_name, None)
+        self._schedule_reclaim()
+
+    def _unreferenced(self, prefixes, collection_name):
+        """
+        Returns the record prefixes that collection ``collection_name`` can
+        hand to ``reclaim()``, leaving out base layers other collections
+        still read.  Call it holding ``self.lock`` until the garbage
+        entries are written.
+        """
+        referenced = set()
+        for name, data in self.collections_set.iterator():
+            if name != collection_name.encode():
+                referenced.update(_layer_prefixes(decode(data)))
+        return [prefix for prefix in prefixes if prefix not in referenced]
+
+    @contextmanager
+    def _scratch(self):
+        """
+        Yields a fresh key prefix for temporary data, such as aggregates
+        spilled to disk.  Everything written under it is deleted by
+        ``reclaim()`` once the block exits, or after a crash.
+        """
+        prefix = b'scratch/' + encode_key(self._next_generation())
+        self._writing_prefixes.add(prefix)
+        self.db.put(b'garbage/' + prefix, b'')
+        try:
+            yield prefix
+        finally:
+            self._done_writing(prefix)
+
+    def _done_writing(self, prefix):
+        """
+        Lets ``reclaim()`` delete ``prefix`` if it still has a garbage
+        entry.  Call it once whatever was written under the prefix has
+        been committed.
+        """
+        with self._reclaim_lock:
+            self._writing_prefixes.discard(prefix)
+        self._schedule_reclaim()
 
     def close(self):
         """Closes the database."""
+        if self._reclaim_thread is not None:
+            self._closing = True
+            self._reclaim_wanted.set()
+            self._reclaim_thread.join()
+            self._reclaim_thread = None
         self.db.close()
 
     def open(self):
         """Opens the database."""
         self.db.open()
+        self._closing = False
 
 class Collection:
     """
@@ -113,13 +375,28 @@ class Collection:
 
     This class should never be instantiated directly.  Use the ``DB.collection()`` method instead
     """
-    def __init__(self, database, items_set, name):
+    def __init__(self, database, items_set, name, metadata):
         if '!!' in name:
             raise ValueError("Disallowed character sequence '!!' in collection name")
 
         self.name = name
-        self.db = items_set.prefixed_db(name.encode()+b'!!')
+        self.items_set = items_set
+        self.metadata = metadata
+        self.prefix = name.encode() + b'!!' + encode_key(metadata['generation'])
+        self.db = items_set.prefixed_db(self.prefix)
+        self.codec = get_codec(metadata.get('codec', 'json'))
         self.parent_db = database
+        self._batch = None
+        self.indexes = {}
+        self.columns = {}
+        self.chunks = None
+        self.record_cache = None
+        self.lock = threading.RLock()
+        self._cache_version = 0
+        # Odd while a write batch is being committed and published
+        self._commits = 0
+        # True while an in-place rewrite holds back publishing its keys
+        self._rewriting = False
 
         self.refresh()
 
@@ -128,25 +405,605 @@ class Collection:
         Appends a single record.
 
         | Arguments:
-        | ``record`` -- Any JSON-serializable python object (dicts, lists, ints, strings, etc.)
+        | ``record`` -- Any object the collection's codec can store.  With the default JSON codec
+            this is any JSON-serializable python object (dicts, lists, ints, strings, etc.)
+        """
+        self._append_encoded(self.codec.encode(record))
+
+    def _append_encoded(self, value, record=None):
+        with self.batch() as batch, batch.record():
+            secondary = self._secondary()
+            if secondary and record is None:
+                record = self.codec.decode(value)
+            if self.chunks is not None:
+                self.chunks.check(record)
+            self.last_index += 1
+            self.keys.append(self.last_index)
+            batch.put(encode_key(self.last_index), value)
+            if secondary:
+                for index in secondary:
+                    index.add(batch, self.last_index, record)
+
+    @property
+    def cache(self):
+        """The record cache used by the collection, or None"""
+        if self.record_cache is not None:
+            return self.record_cache
+        return self.parent_db.record_cache
+
+    def enable_cache(self, max_entries=None, max_bytes=None):
         """
-        self.last_index += 1
-        key = str(self.last_index).encode()
-        self.db.put(key, encode(record))
-        self.keys.append(key)
+        Gives the collection its own LRU cache of decoded records, used by
+        indexing, ``find()`` and ``range()``.  Its ``hits`` and ``misses``
+        counters show how well it is sized.  Cached records are shared
+        between reads and should not be modified in place.
 
-    def refresh(self):
+        | Keyword arguments:
+        | ``max_entries`` -- (Optional) The maximum number of cached records
+        | ``max_bytes`` -- (Optional) The maximum total encoded size of the cached records
+        """
+        self.record_cache = RecordCache(max_entries, max_bytes)
+        return self.record_cache
+
+    def disable_cache(self):
+        """Removes the collection's own record cache.  A DB-wide cache still applies."""
+        self.record_cache = None
+
+    def _get(self, record_id, db=None, prefixes=None, version=None):
+        """
+        Returns the decoded record with the given id, through the record
+        cache.  By default it is read from the last committed view;
+        otherwise from ``db`` (the DB or a snapshot of it) under the record
+        ``prefixes`` of a view whose ``_cache_version`` was ``version``.
+        """
+        if db is None:
+            version = self._cache_version
+            db, prefixes = self.parent_db.db, self._view[2]
+        cache = self.cache
+        if cache is None:
+            return self.codec.decode(_read_value(db, prefixes, record_id))
+
+        cache_key = (prefixes[0], record_id)
+        found, record = cache.lookup(cache_key)
+        # Cached records are only valid for reads of the current version
+        if found and version == self._cache_version:
+            return record
+        value = _read_value(db, prefixes, record_id)
+        record = self.codec.decode(value)
+        # Don't cache a read that a write committed since may have replaced,
+        # or one made while a batch is pending
+        if self._batch is None and version == self._cache_version:
+            cache.put(cache_key, record, len(value))
+        return record
+
+    def snapshot(self):
+        """
+        Returns a read-only ``CollectionSnapshot`` of the collection as of its
+        last committed write.  Reads from it are unaffected by later writes,
+        so long-running analytics see one consistent state without copying
+        the collection.
+
+        Release the snapshot with ``close()``, or use it as a context
+        manager, e.g. ``with collection.snapshot() as view:``.
+        """
+        while True:
+            commits = self._commits
+            if commits % 2 == 0:
+                version = self._cache_version
+                view = self._view
+                indexes = dict((name, SecondaryIndex(self, name, dict(index.definition), index.key))
+                    for name, index in self.indexes.items())
+                columns = dict((field, StoredColumn(self, field, dict(column.definition)))
+                    for field, column in self.columns.items())
+                chunks = None
+                if self.chunks is not None:
+                    chunks = columnar.ChunkStore(self, dict(self.chunks.definition))
+                snapshot = self.parent_db.db.snapshot()
+                if commits == self._commits:
+                    return CollectionSnapshot(self, view, indexes, columns, chunks, snapshot, version)
+                snapshot.close()
+            time.sleep(0)
+
+    @contextmanager
+    def _committing(self):
         """
-        Reloads the collection from the database.
+        Wraps the commit of a write batch, publishing the new keys once it
+        is written.  ``snapshot()`` retries while a commit is in progress,
+        so its LevelDB snapshot always matches the published keys.
         """
-        self.keys = []
-        for key in self.db.iterator(include_value=False):
-            self.keys.append(key)
+        self._commits += 1
+        try:
+            yield
+        finally:
+            self._publish()
+            self._commits += 1
 
-        if len(self.keys) > 0:
-            self.last_index = int(self.keys[-1])
+    def _publish(self):
+        """
+        Makes the current keys visible to readers as ``_view``, a tuple of
+        the key index, the length, the record prefixes and the items DB.
+        Called once the records they refer to have been committed.  During
+        an in-place rewrite readers keep the old view until its last commit.
+        """
+        if self._rewriting:
+            return
+        self._view = (self.keys, len(self.keys), self._prefixes(), self.db)
+        self._cache_version += 1
+
+    def _invalidate_cache(self, record_id=None):
+        self._cache_version += 1
+        cache = self.cache
+        if cache is None:
+            return
+        if record_id is None:
+            cache.invalidate(self._items_prefix())
         else:
-            self.last_index = 0
+            cache.discard((self._items_prefix(), record_id))
+
+    def create_index(self, name, key=None):
+        """
+        Creates a secondary index, which is kept up to date as records are
+        written and is used by ``find()`` and ``range()``.  Creating an
+        index that already exists does nothing.
+
+        | Arguments:
+        | ``name`` -- The name of the index.  Without ``key``, records are
+            indexed by their value for the field of the same name.
+
+        | Keyword arguments:
+        | ``key`` -- (Optional) A function returning the value to index a record by.
+            Key functions are not stored in the database, so they must be passed to
+            ``create_index()`` again each time the collection is opened.
+        """
+        with self.lock:
+            if name in self.indexes:
+                index = self.indexes[name]
+                if key is not None and 'field' not in index.definition:
+                    index.key = key
+                    if index.definition.get('stale'):
+                        with self._rewrite():
+                            pass
+                return index
+
+            definition = {'generation': self.parent_db._next_generation()}
+            if key is None:
+                definition['field'] = name
+            self.metadata.setdefault('indexes', {})[name] = definition
+            self.indexes[name] = SecondaryIndex(self, name, definition, key)
+            with self._rewrite():
+                pass
+            return self.indexes[name]
+
+    def drop_index(self, name):
+        """
+        Deletes a secondary index.
+
+        | Arguments:
+        | ``name`` -- The name of the index
+        """
+        with self.lock:
+            index = self._index(name)
+            del self.metadata['indexes'][name]
+            del self.indexes[name]
+            with self.parent_db.db.write_batch(sync=self.parent_db.sync) as batch:
+                self._write_state(batch)
+                batch.put(b'garbage/' + index.prefix, b'')
+            self.parent_db._schedule_reclaim()
+
+    def create_column(self, field):
+        """
+        Stores a copy of a top-level field of every dict record under its
+        own key prefix, kept up to date as records are written.  Reading
+        fields that all have stored columns with ``iterator(fields=...)`` or
+        ``column()`` then decodes only those fields instead of whole
+        records, at the cost of writing each field value twice.  Creating
+        a column that already exists does nothing.
+
+        | Arguments:
+        | ``field`` -- The name of the field
+        """
+        with self.lock:
+            if field not in self.columns:
+                definition = {'generation': self.parent_db._next_generation()}
+                self.metadata.setdefault('columns', {})[field] = definition
+                self.columns[field] = StoredColumn(self, field, definition)
+                with self._rewrite():
+                    pass
+            return self.columns[field]
+
+    def drop_column(self, field):
+        """
+        Deletes a stored column.
+
+        | Arguments:
+        | ``field`` -- The name of the field
+        """
+        with self.lock:
+            if field not in self.columns:
+                raise ValueError("Collection '{0}' has no stored column '{1}'".format(self.name, field))
+            column = self.columns.pop(field)
+            del self.metadata['columns'][field]
+            with self.parent_db.db.write_batch(sync=self.parent_db.sync) as batch:
+                self._write_state(batch)
+                batch.put(b'garbage/' + column.prefix, b'')
+            self.parent_db._schedule_reclaim()
+
+    @property
+    def layout(self):
+        """'columnar' if the collection keeps chunked arrays of its fields, otherwise 'records'"""
+        return 'records' if self.chunks is None else 'columnar'
+
+    def set_layout(self, layout, chunk_size=4096):
+        """
+        Changes the storage layout of the collection.
+
+        The 'columnar' layout is for collections of numeric records: dicts
+        with the same fields, whose values are all numbers.  The first
+        record fixes the fields and the dtype of each (bool, int64 or
+        float64), and until the collection is emptied records that do not
+        fit them exactly, such as a float in an int64 field, are rejected.
+        Besides every record, it stores chunks of ``chunk_size`` records as
+        one NumPy array per field, which ``map_batches()`` and ``reduce_batches()`` hand to
+        vectorized code without decoding single records.  The record-level
+        API keeps working, and writes of records of another kind raise a
+        ValueError.  Each commit stores its values as a new segment of their
+        chunk, and every ``columnar.MAX_SEGMENTS`` commits to a chunk rewrite
+        it whole, so batching writes still pays off.  Requires the ``numpy``
+        package.
+
+        | Arguments:
+        | ``layout`` -- 'records' or 'columnar'
+
+        | Keyword arguments:
+        | ``chunk_size`` -- The number of records per chunk of the columnar layout
+        """
+        if layout not in columnar.LAYOUTS:
+            raise ValueError("Unknown layout '{0}', use 'records' or 'columnar'".format(layout))
+        with self.lock:
+            if layout == self.layout:
+                return
+            if layout == 'records':
+                chunks, self.chunks = self.chunks, None
+                del self.metadata['chunks']
+                with self.parent_db.db.write_batch(sync=self.parent_db.sync) as batch:
+                    self._write_state(batch)
+                    batch.put(b'garbage/' + chunks.prefix, b'')
+                self.parent_db._schedule_reclaim()
+                return
+
+            chunks = columnar.ChunkStore(self, {'generation': self.parent_db._next_generation(),
+                'chunk_size': chunk_size})
+            # Check every record first, so a rejected record leaves the collection unchanged
+            for _, value in self._records():
+                chunks.check(self.codec.decode(value))
+            self.metadata['chunks'] = chunks.definition
+            self.chunks = chunks
+            with self._rewrite():
+                pass
+
+    def _secondary(self):
+        """Returns the secondary indexes, stored columns and chunks, which every write updates"""
+        secondary = list(self.indexes.values()) + list(self.columns.values())
+        if self.chunks is not None:
+            secondary.append(self.chunks)
+        return secondary
+
+    def find(self, **criteria):
+        """
+        Returns a list of the records whose indexed values equal the given
+        values, e.g. ``collection.find(user_id=5)``.  Every keyword must be
+        the name of an index.  Records are returned in collection order.
+        """
+        with self.snapshot() as view:
+            return view.find(**criteria)
+
+    def range(self, name, low=None, high=None):
+        """
+        Returns a list of the records whose indexed values lie between
+        ``low`` and ``high``, both inclusive, ordered by the indexed value.
+
+        | Arguments:
+        | ``name`` -- The name of the index
+
+        | Keyword arguments:
+        | ``low`` -- (Optional) The smallest value to return.  Unbounded if None.
+        | ``high`` -- (Optional) The largest value to return.  Unbounded if None.
+        """
+        with self.snapshot() as view:
+            return view.range(name, low, high)
+
+    def _index(self, name):
+        if name not in self.indexes:
+            raise ValueError("Collection '{0}' has no index '{1}'".format(self.name, name))
+        return self.indexes[name]
+
+    def _rebuild_indexes(self, batch):
+        """
+        Re-indexes the stored records into a new, empty key prefix for
+        every index, stored column and chunk store, then switches to them
+        and clears the ``rewriting`` flag in a final commit, which also
+        publishes the keys of an in-place rewrite.  Until then readers keep
+        using the old ones.  Unbound key function indexes are
+        left empty and marked stale.  Records of columnar collections are
+        checked again, since they may have been copied in without being
+        checked.
+        """
+        def rebuilt(definition):
+            definition = dict(definition, generation=self.parent_db._next_generation())
+            definition.pop('stale', None)
+            return definition
+
+        indexes = dict((name, SecondaryIndex(self, name, rebuilt(index.definition), index.key))
+            for name, index in self.indexes.items())
+        columns = dict((field, StoredColumn(self, field, rebuilt(column.definition)))
+            for field, column in self.columns.items())
+        chunks = None
+        if self.chunks is not None:
+            chunks = columnar.ChunkStore(self, rebuilt(self.chunks.definition))
+            # Chunks take their fields and dtypes afresh from the records
+            chunks.definition.pop('fields', None)
+            chunks.definition.pop('dtypes', None)
+        old_secondary = self._secondary()
+        secondary = list(indexes.values()) + list(columns.values()) + ([chunks] if chunks else [])
+        for index in secondary:
+            if not index.usable:
+                index.definition['stale'] = True
+            # Reclaimed if the switch below never happens
+            self.parent_db._writing_prefixes.add(index.prefix)
+            batch.put(b'garbage/' + index.prefix, b'', prefix=b'')
+
+        try:
+            if secondary:
+                for key, value in self._records():
+                    record = self.codec.decode(value)
+                    if chunks is not None:
+                        chunks.check(record)
+                    for index in secondary:
+                        if index.usable:
+                            index.add(batch, decode_key(key), record)
+                    if chunks is not None and chunks.pending_count >= batch.batch_size:
+                        chunks.flush(batch._write_batch())
+                        batch.write()
+                if chunks is not None:
+                    chunks.flush(batch._write_batch())
+                # Every new entry is committed before readers switch to them
+                batch.write()
+
+            for index in old_secondary:
+                batch.put(b'garbage/' + index.prefix, b'', prefix=b'')
+            for index in secondary:
+                batch.delete(b'garbage/' + index.prefix, prefix=b'')
+
+            def switch():
+                self.indexes, self.columns, self.chunks = indexes, columns, chunks
+                if indexes:
+                    self.metadata['indexes'] = dict((name, index.definition) for name, index in indexes.items())
+                if columns:
+                    self.metadata['columns'] = dict((field, column.definition) for field, column in columns.items())
+                if chunks is not None:
+                    self.metadata['chunks'] = chunks.definition
+                self.metadata.pop('rewriting', None)
+                self._rewriting = False
+            batch.write(force=True, switch=switch)
+        finally:
+            for index in secondary:
+                self.parent_db._done_writing(index.prefix)
+
+    def set_codec(self, codec):
+        """
+        Changes the codec records are stored with.  Only allowed while the
+        collection is empty.
+
+        | Arguments:
+        | ``codec`` -- The name of a registered codec
+        """
+        with self.lock:
+            if len(self.keys) > 0:
+                raise ValueError("Cannot change the codec of non-empty collection '{0}'".format(self.name))
+            self.codec = get_codec(codec)
+            self.metadata['codec'] = codec
+            self._save_state()
+
+    @contextmanager
+    def batch(self, batch_size=None, batch_bytes=None, sync=None):
+        """
+        Groups every write made to the collection inside a ``with`` block
+        into LevelDB write batches.  A batch is committed atomically each
+        time it reaches ``batch_size`` writes or ``batch_bytes`` bytes, and
+        once more when the block exits.  Records written inside the block
+        are only readable, and counted by ``len()``, once their batch has
+        been committed.
+
+        Nested calls reuse the outermost batch.  The collection's ``lock``
+        is held until the block exits, so other threads wait to write.
+
+        | Keyword arguments:
+        | ``batch_size`` -- The number of writes per batch (defaults to the DB setting)
+        | ``batch_bytes`` -- The number of bytes per batch (defaults to the DB setting)
+        | ``sync`` -- When True each batch is synced to disk (defaults to the DB setting)
+        """
+        with self.lock:
+            if self._batch is not None:
+                yield self._batch
+                return
+
+            self._batch = Batch(self,
+                self.parent_db.batch_size if batch_size is None else batch_size,
+                self.parent_db.batch_bytes if batch_bytes is None else batch_bytes,
+                self.parent_db.sync if sync is None else sync)
+            try:
+                yield self._batch
+            finally:
+                batch, self._batch = self._batch, None
+                batch.write()
+
+    def _put(self, key, value):
+        with self.batch() as batch:
+            batch.put(key, value)
+
+    def _delete(self, key):
+        with self.batch() as batch:
+            batch.delete(key)
+
+    @contextmanager
+    def _rewrite(self):
+        """
+        Wraps a bulk in-place rewrite that replaces ``self.keys`` before it
+        finishes.  Until then the persisted key index is left alone and the
+        collection is flagged, so an interrupted rewrite is repaired by
+        ``verify()`` the next time the collection is opened.  Readers keep
+        seeing the collection as it was until the rewrite's last commit.
+        """
+        with self.lock:
+            self.metadata['rewriting'] = True
+            self._save_state()
+            self._rewriting = True
+            try:
+                with self.batch() as batch:
+                    yield batch
+                    batch.write()
+                    self._rebuild_indexes(batch)
+            except BaseException:
+                self._rewriting = False
+                self.verify()
+                raise
+            finally:
+                if self._rewriting:
+                    self._rewriting = False
+                    self._publish()
+                self._invalidate_cache()
+
+    def _items_prefix(self):
+        return b'collection-items/' + self.prefix
+
+    def _prefixes(self):
+        """The collection's own records prefix followed by those of its base layers"""
+        return (self._items_prefix(),) + tuple(self.layers)
+
+    def _records(self):
+        """Iterates over the current keys and encoded values of every record"""
+        if not self.layers:
+            return self.db.iterator()
+        if len(self.keys) == 0:
+            return iter([])
+        return _layered_scan(self.parent_db.db, self._prefixes(), self.keys, len(self.keys),
+            0, len(self.keys), True, True)
+
+    def _write_state(self, write_batch):
+        """
+        Adds the collection's metadata, and its key index if it changed,
+        to a write batch, so they are committed atomically with the records.
+        """
+        if self.chunks is not None and self.chunks.pending:
+            self.chunks.flush(write_batch)
+        if not self.metadata.get('rewriting'):
+            self._write_keys(write_batch)
+        self.metadata['last_index'] = self.last_index
+        self.metadata['length'] = len(self.keys)
+        write_batch.put(b'collections/' + self.name.encode(), encode(self.metadata))
+
+    def _write_keys(self, write_batch):
+        """
+        Adds the changes to the key index to a write batch.  Deleted ids are
+        added to a log under their own keys, so a delete does not rewrite
+        every run of the index.  The whole index is rewritten, and the log
+        dropped, when the index changed in another way or the log holds
+        more ids than the index has runs.
+        """
+        keys = self.keys
+        if not keys.changed and not keys.removed:
+            return
+        log = self.metadata.get('key_log')
+        logged = len(keys.removed) + (log['length'] if log else 0)
+        if keys.changed or logged > max(len(keys.starts), MIN_KEY_LOG):
+            write_batch.put(b'collection-index/' + self.name.encode(), keys.to_bytes(self.last_index))
+            if log:
+                write_batch.put(b'garbage/' + _key_log_prefix(log), b'')
+                del self.metadata['key_log']
+                self.parent_db._schedule_reclaim()
+        else:
+            if not log:
+                log = self.metadata['key_log'] = {'generation': self.parent_db._next_generation(), 'length': 0}
+            for record_id in keys.removed:
+                write_batch.put(_key_log_prefix(log) + encode_key(record_id), b'')
+            log['length'] = logged
+        keys.changed = False
+        keys.removed = []
+
+    def _save_state(self):
+        with self.parent_db.db.write_batch(sync=self.parent_db.sync) as write_batch:
+            self._write_state(write_batch)
+
+    def refresh(self):
+        """
+        Reloads the collection's length and key index from the database.
+        """
+        with self.lock:
+            data = self.parent_db.collections_set.get(self.name.encode())
+            index = self.parent_db.db.get(b'collection-index/' + self.name.encode())
+            if data is not None:
+                self.metadata = decode(data)
+            self.layers = _layer_prefixes(self.metadata)
+            self.indexes = dict((name, SecondaryIndex(self, name, definition,
+                    self.indexes[name].key if name in self.indexes else None))
+                for name, definition in self.metadata.get('indexes', {}).items())
+            self.columns = dict((field, StoredColumn(self, field, definition))
+                for field, definition in self.metadata.get('columns', {}).items())
+            self.chunks = None
+            if 'chunks' in self.metadata:
+                self.chunks = columnar.ChunkStore(self, self.metadata['chunks'])
+
+            rewriting = self.metadata.get('rewriting')
+            if index is None or 'last_index' not in self.metadata or (rewriting and not self.layers):
+                self.keys = KeyIndex()
+                self.last_index = self.metadata.get('last_index', 0)
+                self.verify()
+            else:
+                self.last_index = self.metadata['last_index']
+                self.keys = KeyIndex.from_bytes(index, self.last_index)
+                if 'key_log' in self.metadata:
+                    prefix = _key_log_prefix(self.metadata['key_log'])
+                    self.keys = self.keys.without(decode_key(key[len(prefix):])
+                        for key in self.parent_db.db.iterator(prefix=prefix, include_value=False))
+                    self.keys.changed = False
+                if rewriting:
+                    self.verify()
+            self._publish()
+
+    def verify(self, repair=True):
+        """
+        Scans every key in the collection and checks them against the key
+        index persisted in the collection's metadata.  This takes time
+        proportional to the size of the collection, and is run
+        automatically when a collection written by an older version or
+        interrupted during an in-place rewrite is opened.
+
+        | Keyword arguments:
+        | ``repair`` -- When True the persisted index is rebuilt from the scan if it does not match
+
+        The key index of a clone is the only record of which base layer
+        records it kept, so for clones this only drops ids whose records
+        are missing.
+
+        Returns True if the persisted index matched the stored records.
+        """
+        with self.lock:
+            if self.layers:
+                keys = KeyIndex(record_id for record_id in self.keys
+                    if _read_value(self.parent_db.db, self._prefixes(), record_id) is not None)
+            else:
+                keys = KeyIndex(decode_key(key) for key in self.db.iterator(include_value=False))
+            matches = (not self.metadata.get('rewriting')
+                and self.metadata.get('length') == len(keys) and self.keys == keys)
+
+            if not matches and repair:
+                self._invalidate_cache()
+                self.keys = keys
+                if len(keys) > 0:
+                    self.last_index = max(self.last_index, keys[-1])
+                with self.batch() as batch:
+                    self._rebuild_indexes(batch)
+            return matches
 
     def delete(self, index):
         """
@@ -155,27 +1012,180 @@ class Collection:
         | Arguments:
         | ``index`` -- Index of the item to be deleted.
         """
-        self.db.delete(self.keys[index])
-        self.keys.pop(index)
+        with self.batch() as batch, batch.record():
+            if self.keys is self._view[0]:
+                # Readers may be using the published index, so change a copy
+                self.keys = self.keys.copy()
+            record_id = self.keys.pop(index)
+            self._invalidate_cache(record_id)
+            self._mutated()
+            secondary = self._secondary()
+            if secondary:
+                # Only secondary indexes need the old record to find their entries
+                record = None
+                if self.indexes:
+                    record = self.codec.decode(_read_value(self.parent_db.db, self._prefixes(), record_id))
+                for secondary_index in secondary:
+                    secondary_index.remove(batch, record_id, record)
+            batch.delete(encode_key(record_id))
 
     def delete_all(self):
-        """Deletes all items in the collection"""
+        """
+        Deletes all items in the collection.
+
+        The collection is moved to a new, empty key prefix, so this takes
+        constant time.  The old records are deleted later by ``DB.reclaim()``.
+        """
+        with self.lock:
+            if len(self.keys) == 0 and not self.layers:
+                return
+
+            if self._batch is not None:
+                # Anything still pending belonged to the old records
+                self._batch.discard()
+            self._invalidate_cache()
+
+            old_prefixes = self._prefixes()
+            old_index_prefixes = [index.prefix for index in self._secondary()]
+            self.layers = []
+            self.metadata.pop('layers', None)
+            self.metadata.pop('derived', None)
+            self._mutated()
+            self.metadata['generation'] = self.parent_db._next_generation()
+            self.prefix = self.name.encode() + b'!!' + encode_key(self.metadata['generation'])
+            self.db = self.items_set.prefixed_db(self.prefix)
+            for index in self._secondary():
+                index.definition['generation'] = self.parent_db._next_generation()
+                index.definition.pop('stale', None)
+            if self.chunks is not None:
+                # An emptied columnar collection takes its fields from its next record
+                self.chunks.definition.pop('fields', None)
+                self.chunks.definition.pop('dtypes', None)
+            self.keys = KeyIndex()
+            self.last_index = 0
+            with self._committing(), self.parent_db.lock:
+                with self.parent_db.db.write_batch(sync=self.parent_db.sync) as batch:
+                    self._write_state(batch)
+                    for old_prefix in self.parent_db._unreferenced(old_prefixes, self.name):
+                        batch.put(b'garbage/' + old_prefix, b'')
+                    for old_prefix in old_index_prefixes:
+                        batch.put(b'garbage/' + old_prefix, b'')
 
-        for key in self.keys:
-            self.db.delete(key)
-        self.keys = []
-        self.last_index = 0
+            self.parent_db._schedule_reclaim()
 
     def append_all(self, iterable):
         """Appends every item in the iterable to the collection"""
 
-        for instance in iterable:
-            self.append(instance)
+        with self.batch():
+            for instance in iterable:
+                self.append(instance)
 
-    def map(self, function, new_collection, **kwargs):
+    def append_dataframe(self, frame, index=False, chunksize=10000):
+        """
+        Appends every row of a pandas DataFrame as a dict record, writing
+        them in batches.
+
+        | Arguments:
+        | ``frame`` -- The DataFrame to append
+
+        | Keyword arguments:
+        | ``index`` -- When True the DataFrame's index is stored as a column too
+        | ``chunksize`` -- The number of rows converted to records at a time
+        """
+        self.append_all(frames.dataframe_records(frame, chunksize, index))
+
+    def import_file(self, path, format=None, workers=None, chunk_size=10000, buffer_size=1024*1024):
+        """
+        Appends every record in a newline-delimited JSON, CSV or Parquet
+        file.  The file is streamed through a buffer and written in batches.
+        CSV rows are appended as dicts of strings.
+
+        | Arguments:
+        | ``path`` -- The file to import
+
+        | Keyword arguments:
+        | ``format`` -- (Optional) 'jsonl', 'csv' or 'parquet', by default taken from the file extension
+        | ``workers`` -- (Optional) The number of processes that parse and encode JSON lines
+        | ``chunk_size`` -- The number of records handed to a worker, or read from Parquet, at a time
+        | ``buffer_size`` -- The size of the file buffer in bytes
+        """
+        fileio.import_file(self, path, format, workers, chunk_size, buffer_size)
+
+    def export_file(self, path, format=None, columns=None, chunk_size=10000, buffer_size=1024*1024,
+            schema=None):
+        """
+        Writes every record to a newline-delimited JSON, CSV or Parquet
+        file, streaming them through a buffer.  With the JSON codec the
+        stored bytes are written to JSON lines files without being decoded.
+
+        CSV and Parquet files get one column per key of the dict records,
+        and other records are written as a single ``value`` column.  Unless
+        ``columns`` is given, finding the columns takes an extra pass.
+        Parquet files take that pass unless ``schema`` is given, to infer a
+        type for each column that fits every chunk, e.g. a float column
+        where some chunks only hold integers.
+
+        | Arguments:
+        | ``path`` -- The file to write
+
+        | Keyword arguments:
+        | ``format`` -- (Optional) 'jsonl', 'csv' or 'parquet', by default taken from the file extension
+        | ``columns`` -- (Optional) The columns written to CSV and Parquet files
+        | ``chunk_size`` -- The number of records converted to columns at a time
+        | ``buffer_size`` -- The size of the file buffer in bytes
+        | ``schema`` -- (Optional) The ``pyarrow.Schema`` Parquet files are written with
+        """
+        fileio.export_file(self, path, format, columns, chunk_size, buffer_size, schema)
+
+    def to_pandas(self, columns=None, chunksize=None):
+        """
+        Exports the collection as a pandas DataFrame.  Columns are built
+        directly from a range scan of the records rather than from a list of
+        every record.  Requires the ``pandas`` package.
+
+        Dict records become one column per key (None where a record lacks
+        one); other records become a single ``value`` column.  The frame's
+        index is the position of each record in the collection.
+
+        | Keyword arguments:
+        | ``columns`` -- (Optional) The columns to export, by default every key found
+        | ``chunksize`` -- (Optional) When given, returns a generator of DataFrames of
+            at most ``chunksize`` rows each, for collections larger than memory
+        """
+        return frames.to_pandas(self, columns, chunksize)
+
+    def to_numpy(self, field=None, dtype=None):
+        """
+        Exports the records, or one field of each record, as a NumPy array.
+        Requires the ``numpy`` package.
+
+        When ``dtype`` is given, or the collection uses the numpy codec, the
+        result is preallocated and filled while scanning, so only the
+        result array is held in memory.  Arrays stored with the numpy codec
+        are stacked along a new first axis.
+
+        | Keyword arguments:
+        | ``field`` -- (Optional) The field to export from every record
+        | ``dtype`` -- (Optional) The dtype of the result
+        """
+        return frames.to_numpy(self, field, dtype)
+
+    def to_arrow(self, columns=None, chunksize=65536):
+        """
+        Exports the collection as a ``pyarrow.Table`` built from record
+        batches of ``chunksize`` rows, with the same columns as ``to_pandas()``.
+        Requires the ``pyarrow`` package.
+        """
+        return frames.to_arrow(self, columns, chunksize)
+
+    def map(self, function, new_collection, workers=None, chunk_size=1000, incremental=False, **kwargs):
         """
         Maps a collection to a new collection with a provided function.
 
+        The new collection records which source records it was built from,
+        so with ``incremental`` a later call only maps the records appended
+        since.
+
         | Arguments:
         | ``function`` -- The function used for mapping.
         | ``new_collection`` -- The name of the collection to insert the new values into.  
@@ -183,25 +1193,39 @@ class Collection:
             If ``None``, values are mapped to the same collection.
 
         | Keyword arguments:
+        | ``workers`` -- When greater than 1, records are mapped in this many worker processes.
+            ``function`` must then be picklable (not a lambda).
+        | ``chunk_size`` -- The number of records sent to a worker process at a time
+        | ``incremental`` -- When True, only records appended to this collection since the new
+            collection was last built from it with the same function are mapped and appended.
+            Everything is mapped again if this collection has had records deleted or changed since,
+            or if ``function`` is an instance of a class defining ``__call__``, whose behaviour
+            cannot be fingerprinted.
         | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
         | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists 
         """
         collection = None
         if new_collection in [None, self.name]:
             collection = self
-            for key in self.keys:
-                new_value = function(decode(self.db.get(key)))
-                self.db.put(key, encode(new_value))
+            with self.lock:
+                self._mutated()
+                self._replace_records(self._checked((decode_key(key), value)
+                    for key, value in self._map_values(function, self.codec, workers, chunk_size)))
         else:
-            collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
-            for instance in self:
-                collection.append(function(instance))
+            collection, start, derived = self._derived(new_collection, 'map', function, incremental, kwargs)
+            with collection.batch() as batch:
+                for key, value in self._map_values(function, collection.codec, workers, chunk_size, start):
+                    with batch.record():
+                        collection._append_encoded(value)
+                        derived['last_processed'] = decode_key(key)
 
         return collection
 
-    def filter(self, function, new_collection, **kwargs):
+    def filter(self, function, new_collection, workers=None, chunk_size=1000, incremental=False, **kwargs):
         """
         Filters a collection into a new collection with a given function.
+        As with ``map()``, ``incremental`` only filters the records appended
+        since the last run.
 
         | Arguments:
         | ``function`` -- The function used for filtering.
@@ -210,29 +1234,94 @@ class Collection:
             If ``None``, values are filtered in the same collection.
 
         | Keyword arguments:
+        | ``workers`` -- When greater than 1, records are tested in this many worker processes.
+            ``function`` must then be picklable (not a lambda).
+        | ``chunk_size`` -- The number of records sent to a worker process at a time
+        | ``incremental`` -- When True, only records appended since the new collection was last
+            built from this one with the same function are filtered.  See ``map()``.
         | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
         | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists 
         """
         collection = None
         if new_collection in [None, self.name]:
             collection = self
-            new_keys = []
-            for key in self.keys:
-                if function(decode(self.db.get(key))):
-                    new_keys.append(key)
-                else:
-                    self.db.delete(key)
-            self.keys = new_keys
+            with self.lock:
+                self._mutated()
+                self._replace_records((decode_key(key), value)
+                    for key, value, keep in self._filter_values(function, workers, chunk_size) if keep)
 
         else:
-            collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
-            for instance in self:
-                if function(instance):
-                    collection.append(instance)
+            collection, start, derived = self._derived(new_collection, 'filter', function, incremental, kwargs)
+            with collection.batch() as batch:
+                for key, value, keep in self._filter_values(function, workers, chunk_size, start):
+                    with batch.record():
+                        if keep:
+                            if collection.codec.name == self.codec.name:
+                                collection._append_encoded(value)
+                            else:
+                                collection.append(self.codec.decode(value))
+                        derived['last_processed'] = decode_key(key)
 
         return collection
 
-    def reduce(self, function, new_collection, initializer=None, **kwargs):
+    def _derived(self, new_collection, operation, function, incremental, kwargs):
+        """
+        Returns the target collection of a map or filter, the position of
+        the first record to process and the target's ``derived`` metadata,
+        whose ``last_processed`` id the caller advances as it goes, in the
+        same ``Batch.record()`` as the record it appends.  The target is
+        reset unless an incremental run can continue from its last one.
+        """
+        source = {'source': self.name, 'created': self.metadata.get('created'), 'operation': operation,
+            'function': _function_name(function), 'mutations': self.metadata.get('mutations', 0)}
+        # Callables that cannot be identified might have changed, so they always rebuild
+        if incremental and source['function'] is not None:
+            collection = self.parent_db.collection(new_collection, **kwargs)
+            derived = collection.metadata.get('derived')
+            if (derived is not None and all(derived.get(name) == value for name, value in source.items())
+                    and derived['last_processed'] <= self.last_index):
+                keys, length = self._view[:2]
+                return collection, min(keys.bisect(derived['last_processed']), length), derived
+            collection.delete_all()
+        else:
+            collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+
+        derived = dict(source, last_processed=0)
+        collection.metadata['derived'] = derived
+        return collection, 0, derived
+
+    def _mutated(self):
+        """Records that existing records were changed or deleted, for incremental runs"""
+        self.metadata['mutations'] = self.metadata.get('mutations', 0) + 1
+
+    def _map_values(self, function, encoder, workers, chunk_size, start=None):
+        """Yields each key with its mapped value, encoded with ``encoder``"""
+        if not workers or workers <= 1:
+            for key, value in self._scan(start, include_key=True):
+                yield key, encoder.encode(function(self.codec.decode(value)))
+            return
+
+        results = parallel.imap_keyed_chunks(parallel.map_chunk, (function, self.codec, encoder),
+            self._scan(start, include_key=True), chunk_size, workers)
+        for chunk, new_values in results:
+            for (key, _), new_value in zip(chunk, new_values):
+                yield key, new_value
+
+    def _filter_values(self, function, workers, chunk_size, start=None):
+        """Yields each key and encoded value with whether ``function`` keeps it"""
+        if not workers or workers <= 1:
+            for key, value in self._scan(start, include_key=True):
+                yield key, value, function(self.codec.decode(value))
+            return
+
+        results = parallel.imap_keyed_chunks(parallel.filter_chunk, (function, self.codec),
+            self._scan(start, include_key=True), chunk_size, workers)
+        for chunk, keeps in results:
+            for (key, value), keep in zip(chunk, keeps):
+                yield key, value, keep
+
+    def reduce(self, function, new_collection, initializer=None, combiner=None,
+        workers=None, chunk_size=10000, **kwargs):
         """
         Reduces a collection into a new collection with a given function.
 
@@ -243,14 +1332,18 @@ class Collection:
             If ``None``, the current collection is replaced with the reduction output.
 
         | Keyword arguments:
+        | ``initializer`` -- (Optional) The value the reduction starts from
+        | ``combiner`` -- (Optional) An associative function merging two partial reductions.
+            Required for ``workers`` to take effect.  When given, every partition starts from
+            ``initializer``, which must then be an identity of the combiner (e.g. 0 for sums).
+        | ``workers`` -- When greater than 1 and a combiner is given, partitions of ``chunk_size``
+            records are reduced in this many worker processes and combined in order.
+            ``function`` and ``combiner`` must then be picklable (not lambdas).
+        | ``chunk_size`` -- The number of records in each partition
         | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
         | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists 
         """
-        reduced = None
-        if initializer != None:
-            reduced = reduce(function, self.iterator(), initializer)
-        else:
-            reduced = reduce(function, self.iterator())
+        reduced = _reduce_records(self, function, initializer, combiner, workers, chunk_size)
 
         collection = None
         if new_collection in [None, self.name]:
@@ -261,80 +1354,971 @@ class Collection:
         collection.append(reduced)
         return collection
 
-    def random_subset(self, number, new_collection, **kwargs):
+    def batches(self, fields=None):
+        """
+        Returns an iterator of the records of a columnar collection in
+        batches of one chunk: dicts mapping each field to a NumPy array of
+        the chunk's values.  See ``set_layout()``.
+
+        | Keyword arguments:
+        | ``fields`` -- (Optional) The fields to read (default: every field)
+        """
+        return _closing(self.snapshot(), lambda view: view.batches(fields))
+
+    def map_batches(self, function, new_collection, fields=None, **kwargs):
+        """
+        Maps the records of a columnar collection into a new collection one
+        chunk at a time, so ``function`` can use vectorized NumPy code.
+        ``function`` receives a batch as returned by ``batches()`` and
+        returns either a dict of equal-length arrays, which becomes one dict
+        record per row, or an array, which becomes one record per value.
+
+        | Arguments:
+        | ``function`` -- The function used for mapping batches.
+        | ``new_collection`` -- The name of the collection to insert the new values into.
+            Any existing values will be deleted.
+            If ``None``, the current collection is replaced with the mapping output.
+
+        | Keyword arguments:
+        | ``fields`` -- (Optional) The fields to read (default: every field)
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        | ``layout`` -- The layout of the new collection, e.g. 'columnar'
+        """
+        with self.snapshot() as view:
+            return self._write_output(columnar.mapped_records(view, function, fields), new_collection, kwargs)
+
+    def reduce_batches(self, function, new_collection, initializer=None, fields=None, **kwargs):
+        """
+        Reduces the records of a columnar collection one chunk at a time,
+        calling ``function(reduced, batch)`` with batches as returned by
+        ``batches()``, and inserts the result into a new collection.
+        NumPy results are stored as the equivalent Python values.
+
+        | Arguments:
+        | ``function`` -- The function used for reducing.
+        | ``new_collection`` -- The name of the collection to insert the new value into.
+            Any existing values will be deleted.
+            If ``None``, the value is appended to the current collection.
+
+        | Keyword arguments:
+        | ``initializer`` -- (Optional) The value the reduction starts from.  Without one, the
+            first batch is.
+        | ``fields`` -- (Optional) The fields to read (default: every field)
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        with self.snapshot() as view:
+            reduced = view.reduce_batches(function, None, initializer, fields)
+
+        if new_collection in [None, self.name]:
+            collection = self
+        else:
+            collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+        collection.append(columnar.python_value(reduced))
+        return collection
+
+    def group_by(self, key_fn, agg_fn, new_collection, max_entries=100000, workers=None,
+        chunk_size=10000, **kwargs):
+        """
+        Groups the records of a collection by key and inserts a ``[key, agg_fn(records)]``
+        record per group into a new collection, in key order (see ``sortkey``).
+
+        At most ``max_entries`` records are buffered in memory.  Beyond that,
+        buffered records are spilled to disk sorted by key and merged once
+        every record has been read, so collections larger than memory can be
+        grouped as long as each single group fits in memory.
+
+        | Arguments:
+        | ``key_fn`` -- A function returning a record's key.  Keys must be None, booleans,
+            numbers, strings, bytes or lists of these.
+        | ``agg_fn`` -- A function aggregating the list of records of a group, in collection order.
+        | ``new_collection`` -- The name of the collection to insert the groups into.
+            Any existing values will be deleted.
+            If ``None``, the current collection is replaced with the groups.
+
+        | Keyword arguments:
+        | ``max_entries`` -- The number of records held in memory before spilling to disk
+        | ``workers`` -- When greater than 1, keys are computed in this many worker processes.
+            ``key_fn`` must then be picklable (not a lambda).
+        | ``chunk_size`` -- The number of records sent to a worker at a time
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        with self.parent_db._scratch() as scratch, self.snapshot() as view:
+            groups = grouping.group_records(view, key_fn, scratch, max_entries, workers, chunk_size)
+            return self._write_output(([key, agg_fn(records)] for key, records in groups),
+                new_collection, kwargs)
+
+    def reduce_by_key(self, key_fn, function, new_collection, initializer=None, combiner=None,
+        max_entries=100000, workers=None, chunk_size=10000, **kwargs):
+        """
+        Reduces the records of every key with a given function and inserts a
+        ``[key, reduced value]`` record per key into a new collection, in key
+        order (see ``sortkey``).
+
+        With a ``combiner``, only one partial reduction per key is kept in
+        memory.  When there are more than ``max_entries`` keys, the partial
+        reductions are spilled to disk sorted by key and merged with the
+        combiner once every record has been read.  Without one, this groups
+        the records with ``group_by()`` and reduces each group.
+
+        | Arguments:
+        | ``key_fn`` -- A function returning a record's key.  Keys must be None, booleans,
+            numbers, strings, bytes or lists of these.
+        | ``function`` -- The function used for reducing.
+        | ``new_collection`` -- The name of the collection to insert the reductions into.
+            Any existing values will be deleted.
+            If ``None``, the current collection is replaced with the reductions.
+
+        | Keyword arguments:
+        | ``initializer`` -- (Optional) The value the reduction of every key starts from
+        | ``combiner`` -- (Optional) An associative function merging two partial reductions.
+            When given, partial reductions may start from ``initializer``, which must then be
+            an identity of the combiner (e.g. 0 for sums).
+        | ``max_entries`` -- The number of keys (or records, without a combiner) held in memory
+            before spilling to disk
+        | ``workers`` -- When greater than 1 and a combiner is given, partitions of ``chunk_size``
+            records are reduced by key in this many worker processes and combined.
+            ``key_fn``, ``function`` and ``combiner`` must then be picklable (not lambdas).
+        | ``chunk_size`` -- The number of records in each partition
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        if combiner is None:
+            return self.group_by(key_fn, partial(grouping.reduce_group, function, initializer),
+                new_collection, max_entries=max_entries, workers=workers, chunk_size=chunk_size, **kwargs)
+
+        with self.parent_db._scratch() as scratch, self.snapshot() as view:
+            reduced = grouping.reduce_records_by_key(view, key_fn, function, initializer, combiner,
+                scratch, max_entries, workers, chunk_size)
+            return self._write_output(([key, value] for key, value in reduced), new_collection, kwargs)
+
+    def sort(self, key_fn, new_collection, reverse=False, workers=None, chunk_size=10000, **kwargs):
+        """
+        Sorts the records of a collection by key into a new collection.  The
+        sort is stable: records with equal keys keep their collection order.
+
+        Records are written to disk under their order-preserving sort key
+        (see ``sortkey``) and read back with one range scan, so LevelDB does
+        the sorting and memory use does not depend on the collection size.
+
+        | Arguments:
+        | ``key_fn`` -- A function returning a record's sort key.  Keys must be None, booleans,
+            numbers, strings, bytes or lists of these.
+        | ``new_collection`` -- The name of the collection to insert the sorted records into.
+            Any existing values will be deleted.
+            If ``None``, the current collection is replaced with the sorted records.
+
+        | Keyword arguments:
+        | ``reverse`` -- When True records are sorted in descending key order
+        | ``workers`` -- When greater than 1, keys are computed in this many worker processes.
+            ``key_fn`` must then be picklable (not a lambda).
+        | ``chunk_size`` -- The number of records sent to a worker at a time
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        with self.parent_db._scratch() as scratch, self.snapshot() as view:
+            values = grouping.sort_records(view, key_fn, reverse, scratch, workers, chunk_size)
+            return self._write_output(values, new_collection, kwargs, codec=self.codec)
+
+    def _write_output(self, records, new_collection, kwargs, codec=None):
+        """
+        Writes records into a reset collection, or in place of this
+        collection's records.  With a ``codec``, ``records`` are values
+        encoded with it.
+        """
+        if new_collection in [None, self.name]:
+            collection = self
+            with self.lock:
+                self.delete_all()
+                _append_output(self, records, codec)
+        else:
+            collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+            _append_output(collection, records, codec)
+        return collection
+
+    def random_subset(self, number, new_collection, seed=None, weight=None, stratify=None, **kwargs):
         """
         Produces a random subset of a given collection and inserts it into a new collection.
+        Records keep their collection order.
+
+        A plain sample picks ``number`` positions directly and only reads the
+        chosen records.  Weighted and stratified samples are drawn in one
+        streaming pass with a reservoir of ``number`` records per stratum.
 
         | Arguments:
+        | ``number`` -- The number of records to sample (per stratum when ``stratify`` is given)
         | ``new_collection`` -- The name of the collection to insert the new values into.  
             Any existing values will be deleted.
             If `None`, the subset is stored to the current collection.
 
         | Keyword arguments:
+        | ``seed`` -- (Optional) Seed for the random number generator, for reproducible samples
+        | ``weight`` -- (Optional) A function returning a record's sampling weight.  Records are
+            sampled without replacement with probability proportional to their weight, and records
+            with a weight of 0 or less are never sampled.
+        | ``stratify`` -- (Optional) A function returning a record's stratum.  Up to ``number``
+            records are sampled from every stratum.
         | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
         | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists 
         """
+        rng = random.Random(seed)
         collection = None
         if new_collection in [None, self.name]:
             collection = self
-            random.shuffle(self.keys)
-            for key in self.keys[number:]:
-                self.db.delete(key)
-            self.keys = self.keys[:number]
-            list.sort(self.keys)
+            with self.lock:
+                self._mutated()
+                self._replace_records(self._sample(number, rng, weight, stratify))
 
         else:
-            new_keys = copy.copy(self.keys)
-            random.shuffle(new_keys)
-            new_keys = new_keys[:number]
-            list.sort(new_keys)
-            collection = self.parent_db.collection(new_collection, **kwargs)
-            collection.delete_all()
-            for key in new_keys:
-                collection.append(decode(self.db.get(key)))
+            collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+            with collection.batch():
+                for _, value in self._sample(number, rng, weight, stratify):
+                    if collection.codec.name == self.codec.name:
+                        collection._append_encoded(value)
+                    else:
+                        collection.append(self.codec.decode(value))
+
+        return collection
+
+    def _sample(self, number, rng, weight, stratify):
+        """Returns the sampled records as ``(id, encoded value)`` pairs in id order"""
+        if weight is None and stratify is None:
+            with self.snapshot() as view:
+                positions = rng.sample(range(len(view)), min(number, len(view)))
+                return [(view.keys[position], _read_value(view.db, view.prefixes, view.keys[position]))
+                    for position in sorted(positions)]
+        return self._reservoir_sample(number, rng, weight, stratify)
+
+    def _reservoir_sample(self, number, rng, weight, stratify):
+        """
+        Weighted reservoir sampling (Efraimidis and Spirakis' A-Res) in one
+        pass, keeping the ``number`` records with the highest random priority
+        in every stratum.  Returns ``(id, encoded value)`` pairs in id order.
+        """
+        reservoirs = {}
+        for key, value in self._scan(include_key=True):
+            record = self.codec.decode(value)
+            record_weight = 1.0 if weight is None else weight(record)
+            if record_weight <= 0:
+                continue
+            priority = math.log(1.0 - rng.random()) / record_weight
+            reservoir = reservoirs.setdefault(None if stratify is None else stratify(record), [])
+            if len(reservoir) < number:
+                heapq.heappush(reservoir, (priority, key, value))
+            elif priority > reservoir[0][0]:
+                heapq.heapreplace(reservoir, (priority, key, value))
+
+        sampled = sorted((key, value) for reservoir in reservoirs.values()
+            for _, key, value in reservoir)
+        return [(decode_key(key), value) for key, value in sampled]
+
+    def _replace_records(self, records):
+        """
+        Replaces the collection's records with ``(id, encoded value)`` pairs
+        given in increasing id order.  They are written under a new
+        generation prefix that the collection then switches to, so this
+        costs one write per kept record rather than one delete per dropped
+        record, and readers see the old records until the switch.
+        """
+        generation = self.parent_db._next_generation()
+        prefix = self.name.encode() + b'!!' + encode_key(generation)
+        items_prefix = b'collection-items/' + prefix
+        # Reclaimed if the switch below never happens, e.g. after a crash
+        self.parent_db._writing_prefixes.add(items_prefix)
+        self.parent_db.db.put(b'garbage/' + items_prefix, b'')
+
+        try:
+            self._write_replacement(records, generation, prefix, items_prefix)
+        finally:
+            self.parent_db._done_writing(items_prefix)
+
+    def _checked(self, records):
+        """Passes on ``(id, encoded value)`` pairs, checking the records of a columnar collection first"""
+        for record_id, value in records:
+            if self.chunks is not None:
+                self.chunks.check(self.codec.decode(value))
+            yield record_id, value
+
+    def _write_replacement(self, records, generation, prefix, items_prefix):
+        with self._rewrite() as batch:
+            keys = KeyIndex()
+            for record_id, value in records:
+                batch.put(encode_key(record_id), value, prefix=items_prefix)
+                keys.append(record_id)
+
+            for old_prefix in self.parent_db._unreferenced(self._prefixes(), self.name):
+                batch.put(b'garbage/' + old_prefix, b'', prefix=b'')
+            batch.delete(b'garbage/' + items_prefix, prefix=b'')
+            self._invalidate_cache()
+            self.metadata['generation'] = generation
+            self.metadata.pop('layers', None)
+            self.layers = []
+            self.prefix = prefix
+            self.db = self.items_set.prefixed_db(prefix)
+            self.keys = keys
+
+    def clone(self, new_collection, start=None, end=None, **kwargs):
+        """
+        Makes a copy-on-write clone of the collection, or of the records
+        between positions ``start`` and ``end``, in constant time and
+        space.  Returns the new collection.
+
+        The records stored so far become a read-only base layer shared by
+        both collections, and each collection writes its own changes on top
+        of it, so records are only copied when they are modified.  Use
+        ``materialize()`` to give a clone its own copy of every record.
+        Secondary indexes of the new collection are rebuilt.
+
+        Cloning a collection that was written to since it was last cloned
+        adds a layer, and reads search a collection's layers in turn.  Once
+        a collection reads ``MAX_LAYERS`` layers, cloning it first copies
+        its records into a single layer with ``materialize()``, which takes
+        time proportional to the size of the collection.
 
+        | Arguments:
+        | ``new_collection`` -- The name of the new collection.  Any existing values will be deleted.
+
+        | Keyword arguments:
+        | ``start`` -- (Optional) The position to begin copying from
+        | ``end`` -- (Optional) The position to stop copying before
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        if new_collection == self.name:
+            raise ValueError("Cannot clone collection '{0}' into itself".format(self.name))
+        if kwargs.get('codec') not in [None, self.codec.name]:
+            raise ValueError("A clone of collection '{0}' must use its codec '{1}'".format(
+                self.name, self.codec.name))
+        collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+        collection.set_codec(self.codec.name)
+
+        # Lock in name order, so concurrent clones in opposite directions can't deadlock
+        first, second = sorted([self, collection], key=lambda locked: locked.name)
+        with first.lock, second.lock:
+            if self._batch is not None:
+                self._batch.write()
+            start, stop, _ = slice(start, end).indices(len(self.keys))
+            if len(self.layers) >= MAX_LAYERS and any(True for _ in self.db.iterator(include_value=False)):
+                self.materialize()
+
+            with self._committing(), collection._committing(), self.parent_db.lock:
+                if any(True for _ in self.db.iterator(include_value=False)):
+                    # The records stored so far become a base layer, and
+                    # later writes go to a new, empty prefix
+                    self.layers = [self._items_prefix()] + self.layers
+                    self.metadata['generation'] = self.parent_db._next_generation()
+                    self.prefix = self.name.encode() + b'!!' + encode_key(self.metadata['generation'])
+                    self.db = self.items_set.prefixed_db(self.prefix)
+                    self.metadata['layers'] = _encode_layers(self.layers)
+
+                collection._invalidate_cache()
+                collection.layers = list(self.layers)
+                collection.metadata['layers'] = _encode_layers(self.layers)
+                collection.keys = self.keys.subset(start, stop)
+                collection.last_index = self.last_index
+                with self.parent_db.db.write_batch(sync=self.parent_db.sync) as batch:
+                    self._write_state(batch)
+                    collection._write_state(batch)
+
+        if collection._secondary():
+            with collection._rewrite():
+                pass
         return collection
 
+    def materialize(self):
+        """
+        Copies every record a clone still reads from its base layers into
+        the collection itself, so it no longer shares storage with other
+        collections.  Does nothing for collections that are not clones.
+        """
+        with self.lock:
+            if not self.layers:
+                return
+            self._replace_records((decode_key(key), value) for key, value in self._records())
 
-    def iterator(self, start=None, end=None):
-        """Returns a collection iterator"""
+    def pipeline(self):
+        """
+        Returns a lazy ``Pipeline`` over the collection.  Chained map and
+        filter stages run in a single pass when the pipeline is consumed,
+        e.g. ``collection.pipeline().map(f).filter(g).into('output')``.
+        """
+        return Pipeline(self)
 
-        return Iterator(self, start, end)
+    def iterator(self, start=None, end=None, fill_cache=True, fields=None):
+        """
+        Returns a collection iterator over the records between positions
+        ``start`` and ``end``, read with a single LevelDB range scan.
+
+        | Keyword arguments:
+        | ``start`` -- (Optional) The position to begin iterating from
+        | ``end`` -- (Optional) The position to stop iterating before
+        | ``fill_cache`` -- When False the blocks read are not added to LevelDB's block cache.
+            Useful for one-off scans over collections larger than the cache.
+        | ``fields`` -- (Optional) A list of top-level fields.  When given, the iterator yields
+            dicts of the fields each record has.  If every field has a stored column (see
+            ``create_column()``), only those columns are read and decoded.
+        """
+        if fields is not None:
+            return _closing(self.snapshot(), lambda view: view.iterator(start, end, fill_cache, fields))
+        return Iterator(self, start, end, fill_cache=fill_cache)
+
+    def column(self, field, start=None, end=None):
+        """
+        Returns a list of the values of a top-level field for the records
+        between positions ``start`` and ``end``, with None for records
+        lacking it.  Reads only the field's stored column if it has one
+        (see ``create_column()``).
+        """
+        with self.snapshot() as view:
+            return view.column(field, start, end)
+
+    def _scan(self, start=None, end=None, include_key=False, fill_cache=True):
+        """
+        Returns a raw plyvel iterator over the stored keys and/or encoded
+        values between positions ``start`` and ``end``.
+        """
+        keys, length, prefixes, db = self._view
+        start, stop, _ = slice(start, end).indices(length)
+        if start >= stop:
+            return iter([])
+        if len(prefixes) > 1:
+            return _layered_scan(self.parent_db.db, prefixes, keys, length, start, stop,
+                include_key, fill_cache)
+        return db.iterator(start=encode_key(keys[start]),
+            stop=encode_key(keys[stop-1]), include_stop=True, include_key=include_key, fill_cache=fill_cache)
 
     def __iter__(self):
         return self.iterator()
 
     def __getitem__(self, key):
+        if isinstance(key, slice) and key.step in [None, 1]:
+            return list(self.iterator(key.start, key.stop))
+
         if isinstance(key, slice):
-            return [decode(self.db.get(key)) for key in self.keys[key]]
-        else:
-            return decode(self.db.get(self.keys[key]))
+            with self.snapshot() as view:
+                return view[key]
+
+        version = self._cache_version
+        keys, length, prefixes, _ = self._view
+        position = key + length if key < 0 else key
+        if position < 0 or position >= length:
+            raise IndexError("Collection index out of range")
+        return self._get(keys[position], self.parent_db.db, prefixes, version)
 
     def __setitem__(self, key, value):
-        self.db.put(self.keys[key], encode(value))
+        with self.batch() as batch, batch.record():
+            if self.chunks is not None:
+                self.chunks.check(value)
+            record_id = self.keys[key]
+            self._invalidate_cache(record_id)
+            self._mutated()
+            secondary = self._secondary()
+            if secondary:
+                # Only secondary indexes need the old record to find their entries
+                old_record = None
+                if self.indexes:
+                    old_record = self.codec.decode(_read_value(self.parent_db.db, self._prefixes(), record_id))
+                for index in secondary:
+                    index.remove(batch, record_id, old_record)
+                    index.add(batch, record_id, value)
+            batch.put(encode_key(record_id), self.codec.encode(value))
 
     def __repr__(self):
         return "%s(%r)" % (self.__class__, self.name)
 
     def __len__(self):
-        return len(self.keys)
+        return self._view[1]
+
+class Batch:
+    """
+    Accumulates puts and deletes in a plyvel write batch and commits it
+    whenever it grows past ``batch_size`` writes or ``batch_bytes`` bytes.
+
+    Every commit also carries the collection's metadata and key index, so
+    they always match the records on disk.  Writes made inside ``record()``
+    are committed together with their record's index, column and chunk
+    writes.
+
+    Created by ``Collection.batch()``.
+    """
+    def __init__(self, collection, batch_size, batch_bytes, sync=False):
+        self.collection = collection
+        self.db = collection.parent_db.db
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.sync = sync
+        self.write_batch = None
+        self.size = 0
+        self.bytes = 0
+        self.held = 0
+
+    @contextmanager
+    def record(self):
+        """
+        Wraps the writes of one record operation, so the batch is not
+        committed until all of them are queued.
+        """
+        self.held += 1
+        try:
+            yield self
+        finally:
+            self.held -= 1
+        self.maybe_write()
+
+    def maybe_write(self):
+        """Commits the pending writes if the batch is full and no record operation is under way"""
+        if self.held:
+            return
+        chunks = self.collection.chunks
+        if (self.size >= self.batch_size or self.bytes >= self.batch_bytes
+                or (chunks is not None and chunks.pending_count >= self.batch_size)):
+            self.write()
+
+    def put(self, key, value, prefix=None):
+        """
+        Adds a put of a record key, or of any key in the database when
+        ``prefix`` is given.
+        """
+        if prefix is None:
+            prefix = self.collection._items_prefix()
+        self._write_batch().put(prefix + key, value)
+        self._grow(len(key) + len(value))
+
+    def delete(self, key, prefix=None):
+        if prefix is None:
+            prefix = self.collection._items_prefix()
+        self._write_batch().delete(prefix + key)
+        self._grow(len(key))
+
+    def write(self, force=False, switch=None):
+        """
+        Commits the pending writes.  With ``force`` the collection's
+        metadata is committed even if no writes are pending.  ``switch``
+        is called just before the commit, while ``snapshot()`` waits for it.
+        """
+        chunks = self.collection.chunks
+        if force or (chunks is not None and chunks.pending):
+            self._write_batch()
+        if self.write_batch is not None:
+            with self.collection._committing():
+                if switch is not None:
+                    switch()
+                self.collection._write_state(self.write_batch)
+                self.write_batch.write()
+                self.discard()
+
+    def discard(self):
+        """Drops the pending writes."""
+        self.write_batch = None
+        self.size = 0
+        self.bytes = 0
+
+    def _write_batch(self):
+        if self.write_batch is None:
+            self.write_batch = self.db.write_batch(sync=self.sync)
+        return self.write_batch
+
+    def _grow(self, nbytes):
+        self.size += 1
+        self.bytes += nbytes
+        self.maybe_write()
 
 class Iterator:
-    def __init__(self, collection, start=None, end=None):
-        self.key_iterator = iter(collection.keys[start:end])
+    """
+    Streams decoded records out of a collection with one plyvel range
+    iterator, so reads are sequential and memory use is constant.
+    """
+    def __init__(self, collection, start=None, end=None, fill_cache=True):
+        self.value_iterator = collection._scan(start, end, fill_cache=fill_cache)
         self.collection = collection
 
     def __iter__(self):
         return self
 
-    def next(self):
-        return decode(self.collection.db.get(self.key_iterator.next()))
-
     def __next__(self):
-        return decode(self.collection.db.get(self.key_iterator.__next__()))
+        return self.collection.codec.decode(next(self.value_iterator))
+
+class CollectionSnapshot:
+    """
+    A read-only, point-in-time view of a collection, backed by a LevelDB
+    snapshot.  Supports the collection's read APIs: ``len()``, indexing,
+    slicing, iteration, ``iterator()``, ``find()``, ``range()``,
+    ``pipeline()``, and ``map()``, ``filter()`` and ``reduce()`` into other
+    collections.
+
+    The snapshot keeps LevelDB from discarding the versions of records it
+    can see, so close it once it is no longer needed.
+
+    This class should never be instantiated directly.  Use the ``Collection.snapshot()`` method instead
+    """
+    def __init__(self, collection, view, indexes, columns, chunks, snapshot, version):
+        self.collection = collection
+        self.name = collection.name
+        self.codec = collection.codec
+        self.parent_db = collection.parent_db
+        self.keys, self.length, self.prefixes, _ = view
+        self.indexes = indexes
+        self.columns = columns
+        self.chunks = chunks
+        self.db = snapshot
+        self.version = version
+
+    def iterator(self, start=None, end=None, fill_cache=True, fields=None):
+        """Returns an iterator over the records between positions ``start`` and ``end``.  See ``Collection.iterator()``"""
+        if fields is not None:
+            return field_records(self, fields, start, end, fill_cache)
+        return Iterator(self, start, end, fill_cache=fill_cache)
+
+    def column(self, field, start=None, end=None):
+        """Returns the values of a top-level field.  See ``Collection.column()``"""
+        return [None if value is MISSING else value
+            for value, in field_rows(self, [field], start, end)]
+
+    def _scan(self, start=None, end=None, include_key=False, fill_cache=True):
+        start, stop, _ = slice(start, end).indices(self.length)
+        if start >= stop:
+            return iter([])
+        return _layered_scan(self.db, self.prefixes, self.keys, self.length, start, stop,
+            include_key, fill_cache)
+
+    def _get(self, record_id):
+        return self.collection._get(record_id, self.db, self.prefixes, self.version)
+
+    def find(self, **criteria):
+        """Returns the records whose indexed values equal the given values.  See ``Collection.find()``"""
+        ids = None
+        for name, value in criteria.items():
+            matched = set(self._index(name).lookup(value, self.db))
+            ids = matched if ids is None else ids & matched
+
+        records = []
+        for record_id in sorted(self._visible(ids or [])):
+            record = self._get(record_id)
+            # Sort keys tell numbers apart exactly, but NaN's key matches
+            # NaN, so confirm matches with == (treating tuples as lists)
+            if all(self.indexes[name].matches(record, value) for name, value in criteria.items()):
+                records.append(record)
+        return records
+
+    def range(self, name, low=None, high=None):
+        """Returns the records whose indexed values lie between ``low`` and ``high``.  See ``Collection.range()``"""
+        return [self._get(record_id) for record_id in self._visible(self._index(name).range(low, high, self.db))]
+
+    def _visible(self, ids):
+        """
+        Leaves out ids an index still lists for records that an in-place
+        rewrite dropped before the index was rebuilt
+        """
+        for record_id in ids:
+            position = self.keys.position(record_id)
+            if position is not None and position < self.length:
+                yield record_id
+
+    def _index(self, name):
+        if name not in self.indexes:
+            raise ValueError("Collection '{0}' has no index '{1}'".format(self.name, name))
+        return self.indexes[name]
+
+    def pipeline(self):
+        """Returns a lazy ``Pipeline`` over the snapshot"""
+        return Pipeline(self)
+
+    def map(self, function, new_collection, **kwargs):
+        """Maps the snapshot's records into a new collection.  See ``Collection.map()``"""
+        return self.pipeline().map(function).into(new_collection, **kwargs)
+
+    def filter(self, function, new_collection, **kwargs):
+        """Filters the snapshot's records into a new collection.  See ``Collection.filter()``"""
+        return self.pipeline().filter(function).into(new_collection, **kwargs)
+
+    def reduce(self, function, new_collection=None, initializer=None, combiner=None,
+        workers=None, chunk_size=10000, **kwargs):
+        """
+        Reduces the snapshot's records.  Takes the same arguments as
+        ``Collection.reduce()``, but returns the reduced value itself when
+        ``new_collection`` is None.
+        """
+        reduced = _reduce_records(self, function, initializer, combiner, workers, chunk_size)
+        if new_collection is None:
+            return reduced
+        collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+        collection.append(reduced)
+        return collection
+
+    def batches(self, fields=None):
+        """Returns an iterator of the snapshot's records in chunks.  See ``Collection.batches()``"""
+        return columnar.batches(self, fields)
+
+    def map_batches(self, function, new_collection, fields=None, **kwargs):
+        """Maps the snapshot's records into a new collection in chunks.  See ``Collection.map_batches()``"""
+        if new_collection in [None, self.name]:
+            raise ValueError("Snapshots of collection '{0}' are read-only".format(self.name))
+        return self.collection._write_output(columnar.mapped_records(self, function, fields),
+            new_collection, kwargs)
+
+    def reduce_batches(self, function, new_collection=None, initializer=None, fields=None, **kwargs):
+        """
+        Reduces the snapshot's records in chunks.  Takes the same arguments
+        as ``Collection.reduce_batches()``, but returns the reduced value
+        itself when ``new_collection`` is None.
+        """
+        if initializer is not None:
+            reduced = reduce(function, self.batches(fields), initializer)
+        else:
+            reduced = reduce(function, self.batches(fields))
+        if new_collection is None:
+            return reduced
+        collection = self.parent_db.collection(new_collection, reset_collection=True, **kwargs)
+        collection.append(columnar.python_value(reduced))
+        return collection
+
+    @property
+    def lock(self):
+        # Taken by in-place rewrites, which snapshots don't support
+        raise ValueError("Snapshots of collection '{0}' are read-only".format(self.name))
+
+    def close(self):
+        """Releases the LevelDB snapshot"""
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.iterator()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step in [None, 1]:
+                return list(self.iterator(key.start, key.stop))
+            return [self._get(self.keys[position]) for position in range(*key.indices(self.length))]
+
+        position = key + self.length if key < 0 else key
+        if position < 0 or position >= self.length:
+            raise IndexError("Collection index out of range")
+        return self._get(self.keys[position])
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.name)
+
+def _function_name(function):
+    """
+    Identifies a function by its module, name and a hash of its code, for
+    incremental runs.  The hash tells apart lambdas defined in the same
+    scope and notices when a function's code is edited, but not changes to
+    its default arguments or the values it closes over.  Partials are
+    identified by their function and the repr of their arguments.  Returns
+    None for callables that cannot be identified, such as instances of
+    classes defining ``__call__``.
+    """
+    if isinstance(function, partial):
+        name = _function_name(function.func)
+        if name is None:
+            return None
+        digest = hashlib.sha1()
+        digest.update(repr(function.args).encode())
+        digest.update(repr(sorted(function.keywords.items())).encode())
+        return 'functools.partial({0}):{1}'.format(name, digest.hexdigest()[:16])
+
+    name = '{0}.{1}'.format(getattr(function, '__module__', None),
+        getattr(function, '__qualname__', getattr(function, '__name__', repr(type(function)))))
+    if isinstance(function, types.BuiltinFunctionType):
+        return name
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return None
+    digest = hashlib.sha1()
+    _hash_code(digest, code)
+    return '{0}:{1}'.format(name, digest.hexdigest()[:16])
+
+def _hash_code(digest, code):
+    """Adds a code object's bytecode, names and constants to a hash, recursing into nested functions"""
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _hash_code(digest, const)
+        elif isinstance(const, frozenset):
+            # Set order depends on string hashing, which varies between runs
+            digest.update(repr(sorted(repr(item) for item in const)).encode())
+        else:
+            digest.update(repr(const).encode())
+
+def _closing(snapshot, read):
+    """Yields everything ``read(snapshot)`` yields, then closes the snapshot"""
+    try:
+        for item in read(snapshot):
+            yield item
+    finally:
+        snapshot.close()
+
+def _read_value(db, prefixes, record_id):
+    """
+    Returns the encoded record with the given id from the first of the
+    record ``prefixes`` holding it, or None.
+    """
+    key = encode_key(record_id)
+    for prefix in prefixes:
+        value = db.get(prefix + key)
+        if value is not None:
+            return value
+    return None
+
+def _layered_scan(db, prefixes, keys, length, start, stop, include_key, fill_cache):
+    """
+    Scans the records at positions ``start`` to ``stop - 1`` of the key
+    index ``keys`` (of which the first ``length`` ids are visible).  Range
+    scans of every record prefix are merged, so a record in an upper layer
+    hides the same id below it, and base layer records that are not in
+    the index are skipped.
+    """
+    first, last = encode_key(keys[start]), encode_key(keys[stop-1])
+    if len(prefixes) == 1:
+        scan = db.iterator(start=prefixes[0] + first, stop=prefixes[0] + last, include_stop=True,
+            include_key=include_key, fill_cache=fill_cache)
+        if include_key:
+            scan = ((key[len(prefixes[0]):], value) for key, value in scan)
+        for item in scan:
+            yield item
+        return
+
+    scans = [_strip_prefix(db.iterator(start=prefix + first, stop=prefix + last, include_stop=True,
+            fill_cache=fill_cache), len(prefix), layer)
+        for layer, prefix in enumerate(prefixes)]
+    previous = None
+    for key, _, value in heapq.merge(*scans):
+        if key == previous:
+            continue
+        previous = key
+        position = keys.position(decode_key(key))
+        if position is None or position >= length:
+            continue
+        yield (key, value) if include_key else value
+
+def _strip_prefix(scan, prefix_length, layer):
+    for key, value in scan:
+        yield key[prefix_length:], layer, value
+
+def _layer_prefixes(metadata):
+    return [binascii.unhexlify(prefix.encode()) for prefix in metadata.get('layers', [])]
+
+def _encode_layers(prefixes):
+    return [binascii.hexlify(prefix).decode() for prefix in prefixes]
+
+def _key_log_prefix(log):
+    return b'collection-key-log/' + encode_key(log['generation'])
+
+def _reduce_records(source, function, initializer, combiner, workers, chunk_size):
+    """Reduces the records of a collection or snapshot, in worker processes when possible"""
+    if combiner is not None and workers and workers > 1:
+        partials = parallel.imap_ordered(parallel.reduce_chunk, (function, source.codec, initializer),
+            parallel.chunks(source._scan(), chunk_size), workers)
+        if initializer != None:
+            return reduce(combiner, partials, initializer)
+        return reduce(combiner, partials)
+    elif initializer != None:
+        return reduce(function, source.iterator(), initializer)
+    return reduce(function, source.iterator())
+
+def _append_output(collection, records, codec):
+    with collection.batch():
+        for record in records:
+            if codec is None:
+                collection.append(record)
+            elif codec.name == collection.codec.name:
+                collection._append_encoded(record)
+            else:
+                collection.append(codec.decode(record))
 
 def encode(obj):
     return json.dumps(obj).encode()
 
 def decode(string):
     return json.loads(string.decode())
+
+
+def _migrate_v1_to_v2(database, batch_size=10000):
+    """
+    Schema 1 stored record keys as decimal strings, which sort "10" before
+    "2". Rewrites every collection's keys with ``encode_key``.
+    """
+    for name in database.collections_set.iterator(include_value=False):
+        items = database.collection_items_set.prefixed_db(name+b'!!')
+        with items.snapshot() as snapshot:
+            # Already rewritten keys start with \x00, e.g. after an interrupted migration
+            _move_records(items, ((old_key, encode_key(int(old_key)), value)
+                for old_key, value in snapshot.iterator() if not old_key.startswith(b'\x00')), batch_size)
+    return '2'
+
+def _migrate_v2_to_v3(database, batch_size=10000):
+    """
+    Schema 3 keeps each collection's records under a generation prefix
+    and stores collection metadata as a JSON object.
+    """
+    for name in list(database.collections_set.iterator(include_value=False)):
+        metadata = decode(database.collections_set.get(name))
+        if not isinstance(metadata, dict):
+            metadata = {'generation': database._next_generation()}
+            database.collections_set.put(name, encode(metadata))
+        generation = metadata['generation']
+        items = database.collection_items_set.prefixed_db(name+b'!!')
+        with items.snapshot() as snapshot:
+            _move_records(items, ((old_key, encode_key(generation) + old_key, value)
+                for old_key, value in snapshot.iterator() if len(old_key) == 8), batch_size)
+    return '3'
+
+def _move_records(items, moves, batch_size):
+    """
+    Writes ``(old key, new key, value)`` moves in batches of ``batch_size``
+    as they are produced, so only one batch is held in memory.  ``moves``
+    must read from a snapshot of ``items`` taken before the first write, so
+    moved keys are not moved again.
+    """
+    batch = items.write_batch()
+    for count, (old_key, new_key, value) in enumerate(moves):
+        batch.put(new_key, value)
+        batch.delete(old_key)
+        if (count + 1) % batch_size == 0:
+            batch.write()
+            batch = items.write_batch()
+    batch.write()
+
+def _migrate_v3_to_v4(database):
+    """
+    Schema 4 records full key prefixes under garbage/, since secondary
+    indexes are stored outside collection-items/.
+    """
+    for prefix in list(database.garbage_set.iterator(include_value=False)):
+        with database.garbage_set.write_batch() as batch:
+            batch.put(b'collection-items/' + prefix, b'')
+            batch.delete(prefix)
+    return '4'
+
+def _migrate_v4_to_v5(database):
+    """
+    Schema 5 encodes integers in sort keys exactly.  Collections with
+    secondary indexes are flagged as rewriting, so ``verify()`` rebuilds
+    their indexes the next time they are opened.
+    """
+    with database.collections_set.write_batch() as batch:
+        for name, data in database.collections_set.iterator():
+            metadata = decode(data)
+            if metadata.get('indexes'):
+                metadata['rewriting'] = True
+                batch.put(name, encode(metadata))
+    return '5'
+
+migrations = {
+    '1': _migrate_v1_to_v2,
+    '2': _migrate_v2_to_v3,
+    '3': _migrate_v3_to_v4,
+    '4': _migrate_v4_to_v5,
+}
@@ -1,3 +1,6 @@
-from .DB import DB, Collection
+from .DB import DB, Collection, CollectionSnapshot
+from .codec import Codec, register_codec
+from .pipeline import Pipeline
+from .cache import RecordCache
 
 from ._version import __version__
\ No newline at end of file
@@ -3,4 +3,4 @@ Pypeline version module.
 """
 
 __version__ = '0.2.3'
-schema_version = '1'
\ No newline at end of file
+schema_version = '5'
\ No newline at end of file
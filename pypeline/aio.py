@@ -0,0 +1,220 @@
+"""
+asyncio wrappers around ``DB`` and ``Collection``.
+
+Every blocking LevelDB call runs in a bounded thread pool, so coroutines
+never block the event loop.  Appends made by concurrent coroutines are
+queued and written together, so many small appends become few LevelDB
+write batches.  Requires Python 3.7 or later.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from .DB import DB
+
+class AsyncDB:
+    """
+    An asyncio interface to a pypeline database.
+
+    Arguments:
+    `database_path` -- The path to the folder for database storage
+
+    Keyword arguments:
+    `workers` -- The number of threads running blocking database calls
+    All other keyword arguments are passed to the ``DB`` constructor.
+    """
+
+    def __init__(self, database_path, workers=4, **kwargs):
+        self.db = DB(database_path, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.collections_cache = {}
+
+    async def run(self, function, *args, **kwargs):
+        """Runs ``function(*args, **kwargs)`` in the thread pool and returns its result"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor,
+            lambda: function(*args, **kwargs))
+
+    async def collection(self, collection_name, **kwargs):
+        """
+        Returns an ``AsyncCollection`` for the named collection.  Takes the
+        same keyword arguments as ``DB.collection()``.
+        """
+        collection = await self.run(self.db.collection, collection_name, **kwargs)
+        if collection_name not in self.collections_cache:
+            self.collections_cache[collection_name] = AsyncCollection(self, collection)
+        async_collection = self.collections_cache[collection_name]
+        async_collection.collection = collection
+        return async_collection
+
+    async def collections(self):
+        return await self.run(self.db.collections)
+
+    async def delete(self, collection_name):
+        if collection_name in self.collections_cache:
+            await self.collections_cache.pop(collection_name).flush()
+        await self.run(self.db.delete, collection_name)
+
+    async def close(self):
+        """Writes any queued appends, closes the database and stops the thread pool"""
+        for collection in list(self.collections_cache.values()):
+            await collection.flush()
+        await self.run(self.db.close)
+        self.executor.shutdown()
+
+class AsyncCollection:
+    """
+    An asyncio interface to a collection.
+
+    This class should never be instantiated directly.  Use the ``AsyncDB.collection()`` method instead
+    """
+
+    def __init__(self, database, collection):
+        self.parent_db = database
+        self.collection = collection
+        self.name = collection.name
+        self.pending = []
+        self.flushing = None
+
+    async def append(self, record):
+        """Appends a single record"""
+        await self.append_many([record])
+
+    async def append_many(self, records):
+        """
+        Appends every record in ``records``.  Records appended by other
+        coroutines while a write is running are queued and written
+        together in the next write batch.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((list(records), future))
+        if self.flushing is None or self.flushing.done():
+            self.flushing = asyncio.ensure_future(self._flush_pending())
+        await future
+
+    async def flush(self):
+        """Waits until every queued append has been written"""
+        while self.flushing is not None and not self.flushing.done():
+            await asyncio.shield(self.flushing)
+
+    async def _flush_pending(self):
+        while self.pending:
+            pending, self.pending = self.pending, []
+            try:
+                errors = await self.parent_db.run(self._write, [records for records, _ in pending])
+            except Exception as e:
+                errors = [e] * len(pending)
+            for (_, future), error in zip(pending, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    def _write(self, record_lists):
+        """
+        Appends every list of records in one write batch and returns the
+        exception raised for each list, or None.  Each list is encoded and
+        checked before any of it is written, so a rejected list is not
+        partly appended and does not fail the other lists.
+        """
+        collection = self.collection
+        errors = []
+        with collection.batch():
+            for records in record_lists:
+                try:
+                    values = [collection.codec.encode(record) for record in records]
+                    if collection.chunks is not None:
+                        for value in values:
+                            collection.chunks.check(collection.codec.decode(value))
+                    for value in values:
+                        collection._append_encoded(value)
+                except Exception as e:
+                    errors.append(e)
+                else:
+                    errors.append(None)
+        return errors
+
+    async def get(self, index):
+        """Returns the record at position ``index``, or a list of records for a slice"""
+        return await self.parent_db.run(self.collection.__getitem__, index)
+
+    async def set(self, index, value):
+        await self.parent_db.run(self.collection.__setitem__, index, value)
+
+    async def delete(self, index):
+        await self.flush()
+        await self.parent_db.run(self.collection.delete, index)
+
+    async def delete_all(self):
+        await self.flush()
+        await self.parent_db.run(self.collection.delete_all)
+
+    def iterator(self, start=None, end=None, chunk_size=1000):
+        """
+        Asynchronously iterates over the records between positions
+        ``start`` and ``end``.  Records are read by a single range scan in
+        chunks of ``chunk_size``, each read in the thread pool.
+        """
+        return AsyncIterator(self, start, end, chunk_size)
+
+    def __aiter__(self):
+        return self.iterator()
+
+    async def map(self, function, new_collection, **kwargs):
+        """
+        Runs ``Collection.map()`` in the thread pool and returns the
+        resulting collection.  Takes the same arguments as ``Collection.map()``.
+        """
+        return await self._transform(self.collection.map, function, new_collection, **kwargs)
+
+    async def filter(self, function, new_collection, **kwargs):
+        """
+        Runs ``Collection.filter()`` in the thread pool and returns the
+        resulting collection.  Takes the same arguments as ``Collection.filter()``.
+        """
+        return await self._transform(self.collection.filter, function, new_collection, **kwargs)
+
+    async def _transform(self, method, function, new_collection, **kwargs):
+        await self.flush()
+        result = await self.parent_db.run(method, function, new_collection, **kwargs)
+        if result is self.collection:
+            return self
+        return await self.parent_db.collection(result.name)
+
+    def __len__(self):
+        return len(self.collection)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.name)
+
+class AsyncIterator:
+    """
+    An asynchronous iterator over a range scan.
+
+    This class should never be instantiated directly.  Use the ``AsyncCollection.iterator()`` method instead
+    """
+
+    def __init__(self, collection, start, end, chunk_size):
+        self.collection = collection
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.iterator = None
+        self.records = iter([])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        for record in self.records:
+            return record
+        if self.iterator is None:
+            await self.collection.flush()
+            self.iterator = await self.collection.parent_db.run(
+                self.collection.collection.iterator, self.start, self.end)
+        chunk = await self.collection.parent_db.run(lambda: list(islice(self.iterator, self.chunk_size)))
+        if not chunk:
+            raise StopAsyncIteration
+        self.records = iter(chunk)
+        return next(self.records)
@@ -0,0 +1,85 @@
+"""
+Bounded LRU cache of decoded records for random access.
+"""
+import threading
+from collections import OrderedDict
+
+class RecordCache:
+    """
+    Keeps recently read records decoded in memory, evicting the least
+    recently used ones once there are more than ``max_entries`` records or
+    their encoded size exceeds ``max_bytes``.  Records are cached by
+    ``(tag, record id)``, where the tag identifies the collection.
+
+    Cached records are shared between reads, so records returned by a
+    cached collection should not be modified in place.  The cache can be
+    used from several threads.
+
+    | Keyword arguments:
+    | ``max_entries`` -- (Optional) The maximum number of cached records
+    | ``max_bytes`` -- (Optional) The maximum total encoded size of the cached records
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        if not max_entries and not max_bytes:
+            raise ValueError("A record cache needs max_entries or max_bytes")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """Returns ``(True, record)`` for a cached record, or ``(False, None)``"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, record, size):
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = (record, size)
+            self.bytes += size
+            while ((self.max_entries and len(self.entries) > self.max_entries)
+                    or (self.max_bytes and self.bytes > self.max_bytes)):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def invalidate(self, tag):
+        """Drops every cached record of the collection identified by ``tag``"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == tag]:
+                self._discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def stats(self):
+        """Returns the hit, miss and eviction counts and the current size of the cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'entries': len(self.entries), 'bytes': self.bytes}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.stats())
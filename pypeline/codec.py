@@ -0,0 +1,133 @@
+"""
+Record codecs.  A collection encodes every record it stores with the codec
+named in its metadata, which defaults to JSON.
+"""
+import json
+import pickle
+import struct
+
+class Codec(object):
+    """
+    Base class for record codecs.  Subclasses set ``name`` and implement
+    ``encode`` and ``decode``, and are made available to collections with
+    ``register_codec()``.
+    """
+    name = None
+
+    def encode(self, obj):
+        """Returns the bytes stored for ``obj``"""
+        raise NotImplementedError
+
+    def decode(self, data):
+        """Returns the object stored as ``data``"""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.name)
+
+class JSONCodec(Codec):
+    """Stores any JSON-serializable object.  The default codec."""
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode()
+
+    def decode(self, data):
+        return json.loads(data.decode())
+
+class PickleCodec(Codec):
+    """Stores any picklable object.  Only open databases from trusted sources."""
+    name = 'pickle'
+
+    def encode(self, obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+class RawCodec(Codec):
+    """Stores bytes records unchanged."""
+    name = 'raw'
+
+    def encode(self, obj):
+        if not isinstance(obj, bytes):
+            raise TypeError("The raw codec only stores bytes, not {0}".format(type(obj).__name__))
+        return obj
+
+    def decode(self, data):
+        return data
+
+class MsgpackCodec(Codec):
+    """Stores msgpack-serializable objects.  Requires the ``msgpack`` package."""
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def __reduce__(self):
+        return (get_codec, (self.name,))
+
+    def encode(self, obj):
+        return self.msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+class NumpyCodec(Codec):
+    """
+    Stores NumPy arrays as a small dtype and shape header followed by the
+    raw array buffer.  Decoding wraps the stored bytes with
+    ``numpy.frombuffer`` without copying them, so decoded arrays are
+    read-only.  Requires the ``numpy`` package.
+    """
+    name = 'numpy'
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+
+    def __reduce__(self):
+        return (get_codec, (self.name,))
+
+    def encode(self, obj):
+        array = self.numpy.ascontiguousarray(obj)
+        if array.dtype.hasobject:
+            raise TypeError("The numpy codec cannot store arrays of Python objects")
+        header = json.dumps([array.dtype.str, array.shape]).encode()
+        return struct.pack('>I', len(header)) + header + array.tobytes()
+
+    def decode(self, data):
+        header_length = struct.unpack('>I', data[:4])[0]
+        dtype, shape = json.loads(data[4:4+header_length].decode())
+        array = self.numpy.frombuffer(data, dtype=dtype, offset=4+header_length)
+        return array.reshape(shape)
+
+_codec_types = {}
+_codecs = {}
+
+def register_codec(codec):
+    """
+    Makes a codec available to collections under ``codec.name``.
+
+    | Arguments:
+    | ``codec`` -- A ``Codec`` instance, or a ``Codec`` subclass to be instantiated when first used
+    """
+    if not codec.name:
+        raise ValueError("Codecs must have a name")
+    if isinstance(codec, type):
+        _codec_types[codec.name] = codec
+        _codecs.pop(codec.name, None)
+    else:
+        _codecs[codec.name] = codec
+
+def get_codec(name):
+    """Returns the registered codec called ``name``"""
+    if name not in _codecs:
+        if name not in _codec_types:
+            raise ValueError("Unknown codec '{0}'".format(name))
+        _codecs[name] = _codec_types[name]()
+    return _codecs[name]
+
+for _codec in [JSONCodec, PickleCodec, RawCodec, MsgpackCodec, NumpyCodec]:
+    register_codec(_codec)
@@ -0,0 +1,276 @@
+"""
+Columnar chunk storage for collections of numeric records.
+
+A collection with the columnar layout also keeps its records in chunks
+of ``chunk_size`` consecutive record ids, stored as NumPy arrays per
+field, so vectorized code reads a whole chunk of a field with one short
+range scan and no per-record decoding.  Slot ``i`` of a chunk holds the
+record with id ``chunk * chunk_size + i``.  Slots of deleted records are
+kept and skipped when reading, using the collection's key index.
+
+Each commit adds the values it wrote as new segments of their chunks:
+one array per field, stored under the chunk store's key prefix as the
+chunk number, a segment number, the first slot of the segment and the
+field name.  Later segments override the slots of earlier ones.  A
+commit therefore writes only its own values, and once a chunk has
+``MAX_SEGMENTS`` segments they are merged into one.
+
+Requires the ``numpy`` package, which is imported when first used.
+"""
+import numbers
+
+from .codec import get_codec
+from .keyindex import encode_key, decode_key
+
+LAYOUTS = ('records', 'columnar')
+
+# Segments a chunk may have before they are merged
+MAX_SEGMENTS = 16
+
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+class ChunkStore:
+    """
+    The chunked NumPy arrays of a columnar collection.  Chunks are kept up
+    to date with every write, like secondary indexes.  Record values are
+    collected in memory and added to their chunks when the collection's
+    write batch is committed.
+
+    This class should never be instantiated directly.  Use ``DB.collection(name, layout='columnar')`` instead
+    """
+    # Rebuilt along with the secondary indexes, which skip unusable ones
+    usable = True
+
+    def __init__(self, collection, definition):
+        self.collection = collection
+        self.definition = definition
+        # Record values waiting to be written, by generation and chunk
+        self.pending = {}
+        self.pending_count = 0
+        # Stored segments of the chunks flushed so far, by generation and chunk
+        self.segments = {}
+
+    @property
+    def prefix(self):
+        return b'collection-chunks/' + encode_key(self.definition['generation'])
+
+    @property
+    def chunk_size(self):
+        return self.definition['chunk_size']
+
+    @property
+    def fields(self):
+        return self.definition.get('fields', [])
+
+    def check(self, record):
+        """
+        Raises ValueError unless ``record`` is a dict of real numbers with
+        the same fields as the collection's other records.  The fields of
+        the first record checked become the collection's fields, and the
+        type of each value fixes the dtype of its field: bool, int64 or
+        float64.  Later values must fit that dtype exactly, so integers
+        must fit in 64 bits, an int64 field takes no floats and a float64
+        field takes integers only when they are exact as floats.
+        """
+        if not isinstance(record, dict):
+            raise ValueError("Columnar collection '{0}' only stores dict records".format(self.collection.name))
+        if 'fields' in self.definition and set(record) != set(self.definition['fields']):
+            raise ValueError("Records of columnar collection '{0}' must have the fields {1}".format(
+                self.collection.name, self.definition['fields']))
+        dtypes = self.definition.get('dtypes', {})
+        for field, value in record.items():
+            if not isinstance(value, numbers.Real):
+                raise ValueError("Field '{0}' of columnar collection '{1}' must be a real number, not {2}".format(
+                    field, self.collection.name, type(value).__name__))
+            if isinstance(value, numbers.Integral) and not INT64_MIN <= value <= INT64_MAX:
+                raise ValueError("Field '{0}' of columnar collection '{1}' must fit in 64 bits, not {2}".format(
+                    field, self.collection.name, value))
+            if field in dtypes and not _fits(value, dtypes[field]):
+                raise ValueError("Field '{0}' of columnar collection '{1}' holds {2} values, not {3!r}".format(
+                    field, self.collection.name, dtypes[field], value))
+        if 'fields' not in self.definition:
+            self.definition['fields'] = list(record)
+            self.definition['dtypes'] = dict((field, _dtype(value)) for field, value in record.items())
+
+    def add(self, batch, record_id, record):
+        chunk, slot = divmod(record_id, self.chunk_size)
+        slots = self.pending.setdefault((self.definition['generation'], chunk), {})
+        slots[slot] = [record[field] for field in self.fields]
+        self.pending_count += 1
+        batch.maybe_write()
+
+    def remove(self, batch, record_id, record):
+        # Slots of deleted records are skipped using the key index
+        pass
+
+    def flush(self, write_batch):
+        """Adds the pending record values to a write batch as new segments of their chunks"""
+        import numpy
+        codec = get_codec('numpy')
+        database = self.collection.parent_db.db
+        generation = self.definition['generation']
+        for (pending_generation, chunk), slots in sorted(self.pending.items()):
+            # Values pending for an abandoned generation are dropped
+            if pending_generation != generation:
+                continue
+            chunk_prefix = self.prefix + encode_key(chunk)
+            positions = sorted(slots)
+            if (generation, chunk) not in self.segments:
+                self.segments[generation, chunk] = len(set(key[len(chunk_prefix):len(chunk_prefix)+8]
+                    for key in database.iterator(prefix=chunk_prefix, include_value=False)))
+            if self.segments[generation, chunk] < MAX_SEGMENTS:
+                runs = _runs(positions)
+                segments = [(run[0], dict((field, numpy.array([slots[slot][column] for slot in run],
+                    dtype=self.definition['dtypes'][field])) for column, field in enumerate(self.fields)))
+                    for run in runs]
+            else:
+                # Merge the stored segments and the pending values into one segment
+                arrays = read_chunk(database, chunk_prefix, self.fields)
+                for key in database.iterator(prefix=chunk_prefix, include_value=False):
+                    write_batch.delete(key)
+                self.segments[generation, chunk] = 0
+                offsets = numpy.array(positions)
+                for column, field in enumerate(self.fields):
+                    dtype = self.definition['dtypes'][field]
+                    values = numpy.array([slots[position][column] for position in positions], dtype=dtype)
+                    existing = arrays.get(field, values[:0])
+                    array = numpy.zeros(max(len(existing), positions[-1] + 1), dtype=dtype)
+                    array[:len(existing)] = existing
+                    array[offsets] = values
+                    arrays[field] = array
+                segments = [(0, arrays)]
+
+            for first_slot, arrays in segments:
+                segment = self.definition.get('next_segment', 0)
+                self.definition['next_segment'] = segment + 1
+                self.segments[generation, chunk] += 1
+                key = chunk_prefix + encode_key(segment) + encode_key(first_slot)
+                for field in self.fields:
+                    write_batch.put(key + field.encode('utf-8'), codec.encode(arrays[field]))
+        self.pending = {}
+        self.pending_count = 0
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, self.collection.name)
+
+def batches(source, fields=None):
+    """
+    Yields a dict mapping each of ``fields`` (default: every field) to a
+    NumPy array of its values, for every chunk of a collection snapshot
+    holding visible records.  Arrays only hold the visible records, in
+    collection order.
+    """
+    import numpy
+    if source.chunks is None:
+        raise ValueError("Collection '{0}' does not use the columnar layout".format(source.name))
+    if source.length == 0:
+        return
+    store = source.chunks
+    fields = store.fields if fields is None else list(fields)
+    chunk_size = store.chunk_size
+    keys, length = source.keys, source.length
+
+    first_chunk, last_chunk = keys[0] // chunk_size, keys[length-1] // chunk_size
+    for chunk in range(first_chunk, last_chunk + 1):
+        low = chunk * chunk_size
+        start = keys.bisect(low - 1)
+        stop = min(keys.bisect(low + chunk_size - 1), length)
+        if start >= stop:
+            continue
+        first, last = keys[start], keys[stop-1]
+        if last - first + 1 == stop - start:
+            # The visible records fill a contiguous range of slots
+            selection = slice(first - low, last - low + 1)
+        else:
+            selection = numpy.fromiter((record_id - low for record_id in keys.subset(start, stop)),
+                dtype=numpy.int64, count=stop - start)
+
+        arrays = read_chunk(source.db, store.prefix + encode_key(chunk), fields)
+        batch = {}
+        for field in fields:
+            if field not in arrays:
+                raise ValueError("Collection '{0}' has no field '{1}'".format(source.name, field))
+            batch[field] = arrays[field][selection]
+        yield batch
+
+def read_chunk(database, chunk_prefix, fields):
+    """Returns a dict mapping each of ``fields`` stored in a chunk to the array of its slots"""
+    import numpy
+    codec = get_codec('numpy')
+    fields = set(fields)
+    segments = {}
+    offset = len(chunk_prefix) + 8
+    for key, value in database.iterator(prefix=chunk_prefix):
+        field = key[offset+8:].decode('utf-8')
+        if field in fields:
+            segments.setdefault(field, []).append((decode_key(key[offset:offset+8]), codec.decode(value)))
+
+    arrays = {}
+    for field, parts in segments.items():
+        if len(parts) == 1 and parts[0][0] == 0:
+            arrays[field] = parts[0][1]
+            continue
+        array = numpy.zeros(max(start + len(values) for start, values in parts),
+            dtype=numpy.result_type(*[values for _, values in parts]))
+        for start, values in parts:
+            array[start:start+len(values)] = values
+        arrays[field] = array
+    return arrays
+
+def mapped_records(source, function, fields=None):
+    """Yields the records ``function`` maps every batch of ``source`` to"""
+    for batch in batches(source, fields):
+        for record in batch_records(function(batch)):
+            yield record
+
+def batch_records(output):
+    """
+    Yields the records of a batch returned by a ``map_batches()`` function:
+    a dict of equal-length arrays becomes one dict record per row, and an
+    array becomes one record per value.
+    """
+    if isinstance(output, dict):
+        names = list(output)
+        columns = [_python_values(output[name]) for name in names]
+        for row in zip(*columns):
+            yield dict(zip(names, row))
+    else:
+        for value in _python_values(output):
+            yield value
+
+def python_value(value):
+    """Converts NumPy arrays and scalars into the equivalent Python objects"""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+def _dtype(value):
+    """The dtype of the field whose first value is ``value``"""
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, numbers.Integral):
+        return 'int64'
+    return 'float64'
+
+def _fits(value, dtype):
+    """Whether ``value`` is stored exactly in an array of ``dtype``"""
+    if dtype == 'bool':
+        return isinstance(value, bool)
+    if dtype == 'int64':
+        return isinstance(value, numbers.Integral)
+    return not isinstance(value, numbers.Integral) or float(value) == value
+
+def _runs(slots):
+    """Splits sorted slots into lists of consecutive slots"""
+    runs = []
+    for slot in slots:
+        if runs and runs[-1][-1] == slot - 1:
+            runs[-1].append(slot)
+        else:
+            runs.append([slot])
+    return runs
+
+def _python_values(values):
+    if hasattr(values, 'tolist'):
+        return values.tolist()
+    return list(values)
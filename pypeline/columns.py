@@ -0,0 +1,102 @@
+"""
+Stored columns and field-level reads.
+
+A stored column keeps a copy of one top-level field of every dict record
+under its own key prefix, as the record id followed by the field value
+encoded with the collection's codec.  Reading some fields of wide
+records from their columns decodes only those fields instead of every
+whole record.
+"""
+from .keyindex import encode_key
+
+MISSING = object()
+
+class StoredColumn:
+    """
+    One stored field of a collection's records.  Columns are kept up to
+    date with every write, like secondary indexes.  Records that are not
+    dicts or lack the field have no entry.
+
+    This class should never be instantiated directly.  Use the ``Collection.create_column()`` method instead
+    """
+    # Rebuilt along with the secondary indexes, which skip unusable ones
+    usable = True
+
+    def __init__(self, collection, field, definition):
+        self.collection = collection
+        self.field = field
+        self.definition = definition
+
+    @property
+    def prefix(self):
+        return b'collection-columns/' + encode_key(self.definition['generation'])
+
+    def add(self, batch, record_id, record):
+        try:
+            value = record[self.field]
+        except (KeyError, IndexError, TypeError):
+            return
+        batch.put(self.prefix + encode_key(record_id), self.collection.codec.encode(value), prefix=b'')
+
+    def remove(self, batch, record_id, record):
+        batch.delete(self.prefix + encode_key(record_id), prefix=b'')
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__, self.collection.name, self.field)
+
+def field_rows(source, fields, start, end, fill_cache=True):
+    """
+    Yields a list of the values of ``fields`` for every record of a
+    collection snapshot between positions ``start`` and ``end``, with
+    ``MISSING`` for fields a record lacks.  When every field has a stored
+    column only the columns are read, otherwise whole records are decoded.
+    """
+    start, stop, _ = slice(start, end).indices(source.length)
+    if start >= stop:
+        return
+    decode = source.codec.decode
+
+    if not all(field in source.columns for field in fields):
+        for value in source._scan(start, stop, fill_cache=fill_cache):
+            record = decode(value)
+            if isinstance(record, dict):
+                yield [record.get(field, MISSING) for field in fields]
+            else:
+                yield [MISSING] * len(fields)
+        return
+
+    ids = source.keys.subset(start, stop)
+    first, last = encode_key(ids[0]), encode_key(ids[-1])
+    scans = []
+    for field in fields:
+        prefix = source.columns[field].prefix
+        scans.append(_entries(source.db.iterator(start=prefix + first, stop=prefix + last,
+            include_stop=True, fill_cache=fill_cache), len(prefix)))
+    entries = [next(scan, None) for scan in scans]
+
+    for record_id in ids:
+        key = encode_key(record_id)
+        row = []
+        for column, scan in enumerate(scans):
+            entry = entries[column]
+            # Columns only hold ids that are in the key index, but skip
+            # any others rather than misalign the rows
+            while entry is not None and entry[0] < key:
+                entry = next(scan, None)
+            if entry is not None and entry[0] == key:
+                row.append(decode(entry[1]))
+                entry = next(scan, None)
+            else:
+                row.append(MISSING)
+            entries[column] = entry
+        yield row
+
+def field_records(source, fields, start, end, fill_cache=True):
+    """Yields a dict of the requested fields each record has.  See ``field_rows()``"""
+    fields = list(fields)
+    for row in field_rows(source, fields, start, end, fill_cache):
+        yield dict((field, value) for field, value in zip(fields, row) if value is not MISSING)
+
+def _entries(scan, prefix_length):
+    for key, value in scan:
+        yield key[prefix_length:], value
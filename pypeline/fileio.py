@@ -0,0 +1,133 @@
+"""
+Streaming import and export of collections as newline-delimited JSON, CSV
+and Parquet files.
+
+Files are read and written through large buffers in chunks of records, so
+memory use does not depend on the file size.  Parquet support requires the
+``pyarrow`` package (14 or later), which is imported when first used.
+"""
+import csv
+import io
+import json
+import os
+
+from . import parallel
+from .frames import column_chunks
+
+# .json files usually hold a single JSON document, so they need format='jsonl'
+FORMATS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv', '.parquet': 'parquet'}
+
+def file_format(path, format=None):
+    """Returns ``format``, or the format implied by the extension of ``path``"""
+    if format is None:
+        format = FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise ValueError("Cannot tell the format of '{0}', pass format='jsonl', 'csv' or 'parquet'".format(path))
+    if format not in ('jsonl', 'csv', 'parquet'):
+        raise ValueError("Unknown file format '{0}'".format(format))
+    return format
+
+def import_file(collection, path, format=None, workers=None, chunk_size=10000, buffer_size=1024*1024):
+    format = file_format(path, format)
+    with collection.batch():
+        if format == 'jsonl':
+            with io.open(path, 'rb', buffering=buffer_size) as f:
+                lines = (line for line in f if line.strip())
+                if workers and workers > 1:
+                    encoded = parallel.imap_ordered(encode_jsonl_chunk, (collection.codec,),
+                        parallel.chunks(lines, chunk_size), workers)
+                    for values in encoded:
+                        for value in values:
+                            collection._append_encoded(value)
+                else:
+                    for line in lines:
+                        collection.append(json.loads(line.decode('utf-8')))
+
+        elif format == 'csv':
+            with io.open(path, 'r', buffering=buffer_size, newline='', encoding='utf-8') as f:
+                for record in csv.DictReader(f):
+                    collection.append(record)
+
+        else:
+            from pyarrow import parquet
+            for record_batch in parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+                for record in record_batch.to_pylist():
+                    collection.append(record)
+
+def export_file(collection, path, format=None, columns=None, chunk_size=10000, buffer_size=1024*1024,
+        schema=None):
+    format = file_format(path, format)
+    if format == 'jsonl':
+        with io.open(path, 'wb', buffering=buffer_size) as f:
+            if collection.codec.name == 'json':
+                # Stored JSON records never contain raw newlines, so they
+                # are written out without being decoded
+                for value in collection._scan(fill_cache=False):
+                    f.write(value)
+                    f.write(b'\n')
+            else:
+                for value in collection._scan(fill_cache=False):
+                    f.write(json.dumps(collection.codec.decode(value)).encode('utf-8'))
+                    f.write(b'\n')
+        return
+
+    if format == 'parquet':
+        import pyarrow
+        from pyarrow import parquet
+        # Every chunk is written with the same schema, so find the columns
+        # and a type for each that holds every chunk's values before writing
+        if schema is None:
+            schema = record_schema(collection, columns, chunk_size)
+        elif columns is not None:
+            schema = pyarrow.schema([schema.field(name) for name in columns])
+        columns = schema.names
+        writer = None
+        try:
+            for _, _, chunk in column_chunks(collection, columns, chunk_size):
+                table = pyarrow.Table.from_pydict(chunk, schema=schema)
+                if writer is None:
+                    writer = parquet.ParquetWriter(path, schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return
+
+    # Every chunk needs the same columns, so find them all before writing
+    if columns is None:
+        columns = record_columns(collection)
+
+    with io.open(path, 'w', buffering=buffer_size, newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for _, _, chunk in column_chunks(collection, columns, chunk_size):
+            writer.writerows(zip(*[chunk[name] for name in columns]))
+
+def record_schema(collection, columns=None, chunk_size=10000):
+    """
+    Returns an Arrow schema for the collection's records, unifying the
+    types inferred for each chunk of ``chunk_size`` records.  A column of
+    integers in one chunk and floats in another becomes a float column,
+    and one that is only None in some chunks takes the type of the others.
+    """
+    import pyarrow
+    schema = None
+    for _, _, chunk in column_chunks(collection, columns, chunk_size):
+        chunk_schema = pyarrow.Table.from_pydict(chunk).schema
+        if schema is None:
+            schema = chunk_schema
+        else:
+            schema = pyarrow.unify_schemas([schema, chunk_schema], promote_options='permissive')
+    return schema
+
+def record_columns(collection):
+    """Returns every key of the collection's dict records, in the order they first appear"""
+    columns = {}
+    for value in collection._scan(fill_cache=False):
+        record = collection.codec.decode(value)
+        for name in (record if isinstance(record, dict) else ['value']):
+            columns.setdefault(name, len(columns))
+    return sorted(columns, key=columns.get)
+
+def encode_jsonl_chunk(codec, lines):
+    return [codec.encode(json.loads(line.decode('utf-8'))) for line in lines]
@@ -0,0 +1,98 @@
+"""
+Conversion between collections and pandas, NumPy and Arrow data.
+
+pandas, NumPy and pyarrow (14 or later) are optional.  Each is imported
+when a conversion needing it is first used.
+"""
+
+def column_chunks(collection, columns=None, chunksize=None):
+    """
+    Yields ``(offset, count, columns)`` tuples, where ``columns`` maps column
+    names to lists of values for the ``count`` consecutive records starting
+    at position ``offset``, with at most ``chunksize`` records per chunk.
+    Records are read with a single range scan and their values are added
+    straight to the column lists.
+
+    Dict records become one column per key and missing keys are filled with
+    None.  Any other record becomes a single ``value`` column.  When
+    ``columns`` is None, columns are added in the order their keys first
+    appear, and later chunks keep every column seen so far.
+    """
+    decode = collection.codec.decode
+    names = list(columns) if columns is not None else []
+    chunk = dict((name, []) for name in names)
+    offset = count = 0
+    for value in collection._scan(fill_cache=False):
+        record = decode(value)
+        if not isinstance(record, dict):
+            record = {'value': record}
+        if columns is None:
+            for name in record:
+                if name not in chunk:
+                    names.append(name)
+                    chunk[name] = [None] * count
+        for name in names:
+            chunk[name].append(record.get(name))
+        count += 1
+        if count == chunksize:
+            yield offset, count, chunk
+            chunk = dict((name, []) for name in names)
+            offset += count
+            count = 0
+    if count or not offset:
+        yield offset, count, chunk
+
+def to_pandas(collection, columns=None, chunksize=None):
+    import pandas
+
+    def chunks():
+        for offset, count, chunk in column_chunks(collection, columns, chunksize):
+            yield pandas.DataFrame(chunk, columns=list(chunk),
+                index=pandas.RangeIndex(offset, offset + count))
+
+    if chunksize:
+        return chunks()
+    return next(chunks())
+
+def to_numpy(collection, field=None, dtype=None):
+    import numpy
+
+    length = collection._view[1]
+    values = (collection.codec.decode(value) for value in collection._scan(0, length, fill_cache=False))
+    if field is not None:
+        values = (record[field] for record in values)
+
+    if dtype is None and collection.codec.name != 'numpy':
+        return numpy.array(list(values))
+
+    # The element type is known up front, so fill a preallocated array
+    # instead of building a list of every value first
+    values = iter(values)
+    if length == 0:
+        return numpy.empty((0,), dtype=dtype)
+    first = numpy.asarray(next(values), dtype=dtype)
+    result = numpy.empty((length,) + first.shape, dtype=first.dtype)
+    result[0] = first
+    for position, value in enumerate(values, 1):
+        result[position] = value
+    return result
+
+def to_arrow(collection, columns=None, chunksize=65536):
+    import pyarrow
+
+    tables = [pyarrow.Table.from_pydict(chunk)
+        for _, _, chunk in column_chunks(collection, columns, chunksize)]
+    if len(tables) == 1:
+        return tables[0]
+    return pyarrow.concat_tables(tables, promote_options='default')
+
+def dataframe_records(frame, chunksize=10000, index=False):
+    """
+    Yields the rows of a DataFrame as dicts of Python values, converting
+    ``chunksize`` rows at a time.
+    """
+    if index:
+        frame = frame.reset_index()
+    for start in range(0, len(frame), chunksize):
+        for record in frame.iloc[start:start + chunksize].to_dict('records'):
+            yield record
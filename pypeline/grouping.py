@@ -0,0 +1,206 @@
+"""
+Keyed aggregation and sorting with bounded memory.
+
+Groups are collected in an in-memory hash table.  When the table holds
+more than ``max_entries`` records (``group_records``) or partial
+aggregates (``reduce_records_by_key``), its contents are written to a
+scratch key prefix ordered by the sort key of each group, and the table
+is emptied.  LevelDB keeps the spilled entries sorted, so they are
+merged with a single range scan once the source has been read.  Groups
+are identified by the sort key of their key (see ``sortkey``), which is
+exact, so keys are in the same group exactly when they are equal, and
+groups are produced in sort key order.
+
+Sorting writes every record under a scratch prefix as its sort key
+followed by a sequence number and reads them back with one range scan,
+so LevelDB itself performs the external merge sort.
+"""
+import pickle
+from itertools import groupby
+
+from . import parallel
+from .keyindex import encode_key
+from .sortkey import encode_sort_key, prefix_end
+
+MAX_SEQUENCE = 2**64 - 1
+
+def group_records(source, key_fn, scratch, max_entries, workers, chunk_size):
+    """
+    Reads every record of ``source`` and returns an iterator of
+    ``(key, records)`` pairs, with the records of each group in collection
+    order.
+    """
+    decode = source.codec.decode
+    spill = Spill(source.parent_db, scratch)
+    table = {}
+    buffered = 0
+    for key, value in keyed_values(source, key_fn, workers, chunk_size):
+        sort_key = encode_sort_key(key)
+        if sort_key not in table:
+            table[sort_key] = (key, [])
+        table[sort_key][1].append(value)
+        buffered += 1
+        if buffered >= max_entries:
+            spill.write((sort_key, (key, value)) for sort_key, (key, values) in sorted(table.items())
+                for value in values)
+            table = {}
+            buffered = 0
+
+    if spill.count == 0:
+        return ((key, [decode(value) for value in values])
+            for _, (key, values) in sorted(table.items()))
+
+    spill.write((sort_key, (key, value)) for sort_key, (key, values) in sorted(table.items())
+        for value in values)
+    return ((key, [decode(value) for value in values]) for key, values in spill.groups())
+
+def reduce_records_by_key(source, key_fn, function, initializer, combiner, scratch, max_entries,
+        workers, chunk_size):
+    """
+    Reads every record of ``source`` and returns an iterator of
+    ``(key, reduced value)`` pairs.  Partial aggregates are merged with
+    ``combiner``.
+    """
+    spill = Spill(source.parent_db, scratch)
+    table = {}
+    for key, partial, is_record in keyed_partials(source, key_fn, function, initializer, workers, chunk_size):
+        sort_key = encode_sort_key(key)
+        entry = table.get(sort_key)
+        if entry is None:
+            if is_record and initializer is not None:
+                partial = function(initializer, partial)
+            table[sort_key] = [key, partial]
+            if len(table) > max_entries:
+                spill.write((sort_key, tuple(entry)) for sort_key, entry in sorted(table.items()))
+                table = {}
+        elif is_record:
+            entry[1] = function(entry[1], partial)
+        else:
+            entry[1] = combiner(entry[1], partial)
+
+    if spill.count == 0:
+        return (tuple(entry) for _, entry in sorted(table.items()))
+
+    spill.write((sort_key, tuple(entry)) for sort_key, entry in sorted(table.items()))
+    return ((key, _combine(combiner, values)) for key, values in spill.groups())
+
+def keyed_partials(source, key_fn, function, initializer, workers, chunk_size):
+    """
+    Yields ``(key, record, True)`` for every record, or, with workers,
+    ``(key, partial, False)`` for every key of every chunk reduced in a
+    worker process.
+    """
+    if not workers or workers <= 1:
+        decode = source.codec.decode
+        for value in source._scan():
+            record = decode(value)
+            yield key_fn(record), record, True
+        return
+
+    results = parallel.imap_ordered(parallel.reduce_by_key_chunk, (key_fn, function, initializer, source.codec),
+        parallel.chunks(source._scan(), chunk_size), workers)
+    for partials in results:
+        for key, partial in partials:
+            yield key, partial, False
+
+def sort_records(source, key_fn, reverse, scratch, workers, chunk_size):
+    """
+    Returns an iterator of the encoded values of ``source`` ordered by
+    ``key_fn``.  Records with equal keys keep their collection order, also
+    when ``reverse`` is True.
+    """
+    write_sorted(source, key_fn, reverse, scratch, workers, chunk_size)
+    return source.parent_db.db.iterator(start=scratch, stop=prefix_end(scratch), include_key=False,
+        reverse=reverse, fill_cache=False)
+
+def write_sorted(source, key_fn, reverse, scratch, workers, chunk_size):
+    """
+    Writes every encoded value of ``source`` under ``scratch`` followed by
+    the sort key of its record and a sequence number.
+    """
+    database = source.parent_db
+    batch = database.db.write_batch()
+    for count, (key, value) in enumerate(keyed_values(source, key_fn, workers, chunk_size)):
+        # A reverse scan returns equal keys in reverse, so count down instead
+        sequence = MAX_SEQUENCE - count if reverse else count
+        batch.put(scratch + encode_sort_key(key) + encode_key(sequence), value)
+        if (count + 1) % database.batch_size == 0:
+            batch.write()
+            batch = database.db.write_batch()
+    batch.write()
+
+def sorted_groups(database, scratch):
+    """
+    Yields the sort key and an iterator of the encoded values of every
+    group written by ``write_sorted()``, in key order.
+    """
+    scan = database.db.iterator(start=scratch, stop=prefix_end(scratch), fill_cache=False)
+    for sort_key, entries in groupby(scan, lambda entry: entry[0][len(scratch):-8]):
+        yield sort_key, (value for _, value in entries)
+
+def keyed_values(source, key_fn, workers, chunk_size):
+    """Yields the group key and encoded value of every record"""
+    if not workers or workers <= 1:
+        decode = source.codec.decode
+        for value in source._scan():
+            yield key_fn(decode(value)), value
+        return
+
+    results = parallel.imap_keyed_chunks(parallel.key_chunk, (key_fn, source.codec),
+        source._scan(include_key=True), chunk_size, workers)
+    for chunk, keys in results:
+        for (_, value), key in zip(chunk, keys):
+            yield key, value
+
+class Spill:
+    """
+    Entries spilled under a scratch key prefix as the sort key of their
+    group followed by a sequence number, so a range scan returns them
+    grouped and in the order they were spilled.
+    """
+    def __init__(self, database, prefix):
+        self.database = database
+        self.prefix = prefix
+        self.count = 0
+
+    def write(self, entries):
+        """Spills ``(sort key, entry)`` pairs, given in sort key order"""
+        batch = self.database.db.write_batch()
+        for sort_key, entry in entries:
+            batch.put(self.prefix + sort_key + encode_key(self.count), pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+            self.count += 1
+            if self.count % self.database.batch_size == 0:
+                batch.write()
+                batch = self.database.db.write_batch()
+        batch.write()
+
+    def scan(self):
+        """Yields the sort key and entry of every spilled entry in order"""
+        for key, value in self.database.db.iterator(start=self.prefix, stop=prefix_end(self.prefix)):
+            yield key[len(self.prefix):-8], pickle.loads(value)
+
+    def groups(self):
+        """Yields ``(key, [values])`` for each group of spilled ``(key, value)`` entries"""
+        group_sort_key, group_key, values = None, None, []
+        for sort_key, (key, value) in self.scan():
+            if sort_key != group_sort_key:
+                if values:
+                    yield group_key, values
+                group_sort_key, group_key, values = sort_key, key, []
+            values.append(value)
+        if values:
+            yield group_key, values
+
+def _combine(combiner, partials):
+    combined = partials[0]
+    for partial in partials[1:]:
+        combined = combiner(combined, partial)
+    return combined
+
+def reduce_group(function, initializer, records):
+    """Reduces the records of one group, as ``functools.reduce`` would"""
+    records = iter(records)
+    reduced = next(records) if initializer is None else initializer
+    for record in records:
+        reduced = function(reduced, record)
+    return reduced
@@ -0,0 +1,109 @@
+"""
+Secondary indexes over the records of a collection.
+"""
+from .keyindex import decode_key, encode_key
+from .sortkey import encode_sort_key, prefix_end
+
+class SecondaryIndex:
+    """
+    Maps the values of a record field, or of a key function, to the ids of
+    the records holding them.  Entries are stored under their own key
+    prefix as the value's sort key followed by the record id, so lookups
+    and range queries are LevelDB seeks followed by short range scans.
+
+    Field indexes skip records that are not dicts or lack the field.  Key
+    functions cannot be stored in the database, so after a restart a key
+    function index must be bound again with ``Collection.create_index()``.
+    Writes made while it is unbound mark it stale, and a stale index is
+    rebuilt when it is bound.
+
+    This class should never be instantiated directly.  Use the ``Collection.create_index()`` method instead
+    """
+    def __init__(self, collection, name, definition, key=None):
+        self.collection = collection
+        self.name = name
+        self.definition = definition
+        self.key = key
+
+    @property
+    def prefix(self):
+        return b'collection-indexes/' + encode_key(self.definition['generation'])
+
+    @property
+    def usable(self):
+        return not self.definition.get('stale') and (self.key is not None or 'field' in self.definition)
+
+    def value(self, record):
+        """
+        Returns ``(True, value)`` with the indexed value of a record, or
+        ``(False, None)`` if the record is not indexed.
+        """
+        if 'field' in self.definition:
+            try:
+                return True, record[self.definition['field']]
+            except (KeyError, IndexError, TypeError):
+                return False, None
+        if self.key is None:
+            self.definition['stale'] = True
+            return False, None
+        return True, self.key(record)
+
+    def matches(self, record, value):
+        """
+        Returns whether the indexed value of a record equals ``value``.
+        Tuples compare equal to lists, as their sort keys do.
+        """
+        indexed, own = self.value(record)
+        return indexed and _as_lists(own) == _as_lists(value)
+
+    def entry(self, record_id, record):
+        """Returns the index key for a record, or None if the record is not indexed"""
+        indexed, value = self.value(record)
+        if not indexed:
+            return None
+        return self.prefix + encode_sort_key(value) + encode_key(record_id)
+
+    def add(self, batch, record_id, record):
+        entry = self.entry(record_id, record)
+        if entry is not None:
+            batch.put(entry, b'', prefix=b'')
+
+    def remove(self, batch, record_id, record):
+        entry = self.entry(record_id, record)
+        if entry is not None:
+            batch.delete(entry, prefix=b'')
+
+    def lookup(self, value, snapshot=None):
+        """
+        Yields the ids of the records whose indexed value equals ``value``,
+        read from ``snapshot`` when given.
+        """
+        start = self.prefix + encode_sort_key(value)
+        return self._ids(start, prefix_end(start), snapshot)
+
+    def range(self, low=None, high=None, snapshot=None):
+        """
+        Yields the ids of the records whose indexed value lies between
+        ``low`` and ``high`` (both inclusive, None for unbounded) in index
+        order, read from ``snapshot`` when given.
+        """
+        start = self.prefix if low is None else self.prefix + encode_sort_key(low)
+        stop = prefix_end(self.prefix if high is None else self.prefix + encode_sort_key(high))
+        return self._ids(start, stop, snapshot)
+
+    def _ids(self, start, stop, snapshot=None):
+        if not self.usable:
+            raise ValueError("Index '{0}' of collection '{1}' must be rebuilt by calling create_index() "
+                "with its key function".format(self.name, self.collection.name))
+        source = self.collection.parent_db.db if snapshot is None else snapshot
+        for key in source.iterator(start=start, stop=stop, include_value=False):
+            yield decode_key(key[-8:])
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__, self.collection.name, self.name)
+
+def _as_lists(value):
+    """Returns ``value`` with every tuple in it turned into a list"""
+    if isinstance(value, (list, tuple)):
+        return [_as_lists(item) for item in value]
+    return value
@@ -0,0 +1,80 @@
+"""
+Equi-joins of two collections.
+
+When one side has at most ``max_entries`` records, its records are held
+in a hash table keyed by the sort key of their join key, which is exact
+(see ``sortkey``), and the other side is streamed past it.  Otherwise
+both sides are written under scratch key prefixes ordered by join key,
+as ``Collection.sort()`` does, and merged with one range scan of each.
+"""
+from .sortkey import encode_sort_key
+from . import grouping
+
+JOINS = ('inner', 'left')
+
+def join_records(left, right, left_key, right_key, how, scratch, max_entries):
+    """
+    Yields ``[left record, right record]`` pairs for the records of
+    ``left`` and ``right`` with equal keys.  When ``how`` is 'left', left
+    records without a match are paired with None.
+    """
+    if len(right) <= max_entries:
+        table = hash_table(right, right_key)
+        decode = left.codec.decode
+        for value in left._scan(fill_cache=False):
+            record = decode(value)
+            matches = table.get(encode_sort_key(left_key(record)))
+            if matches:
+                for match in matches:
+                    yield [record, match]
+            elif how == 'left':
+                yield [record, None]
+
+    elif how == 'inner' and len(left) <= max_entries:
+        table = hash_table(left, left_key)
+        decode = right.codec.decode
+        for value in right._scan(fill_cache=False):
+            record = decode(value)
+            for match in table.get(encode_sort_key(right_key(record)), ()):
+                yield [match, record]
+
+    else:
+        for pair in merge_join(left, right, left_key, right_key, how, scratch):
+            yield pair
+
+def hash_table(source, key_fn):
+    """Returns the records of ``source`` in lists keyed by the sort key of ``key_fn``"""
+    table = {}
+    decode = source.codec.decode
+    for value in source._scan(fill_cache=False):
+        record = decode(value)
+        table.setdefault(encode_sort_key(key_fn(record)), []).append(record)
+    return table
+
+def merge_join(left, right, left_key, right_key, how, scratch):
+    """
+    Sorts both sides by key under ``scratch`` and merges them.  Only the
+    right records of one key are held in memory at a time.
+    """
+    database = left.parent_db
+    left_scratch, right_scratch = scratch + b'left/', scratch + b'right/'
+    grouping.write_sorted(left, left_key, False, left_scratch, None, None)
+    grouping.write_sorted(right, right_key, False, right_scratch, None, None)
+
+    decode_left, decode_right = left.codec.decode, right.codec.decode
+    right_groups = grouping.sorted_groups(database, right_scratch)
+    right_sort_key, right_values = next(right_groups, (None, None))
+    for sort_key, values in grouping.sorted_groups(database, left_scratch):
+        while right_values is not None and right_sort_key < sort_key:
+            right_sort_key, right_values = next(right_groups, (None, None))
+
+        if right_values is not None and right_sort_key == sort_key:
+            matches = [decode_right(value) for value in right_values]
+            right_sort_key, right_values = next(right_groups, (None, None))
+            for value in values:
+                record = decode_left(value)
+                for match in matches:
+                    yield [record, match]
+        elif how == 'left':
+            for value in values:
+                yield [decode_left(value), None]
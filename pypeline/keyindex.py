@@ -0,0 +1,225 @@
+"""
+Compact positional index of the record ids in a collection.
+"""
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, repeat
+from operator import sub
+
+def encode_key(index):
+    """
+    Encodes a record index as a fixed-width big-endian key, so LevelDB's
+    lexicographic key order matches insertion order.
+    """
+    return struct.pack('>Q', index)
+
+def decode_key(key):
+    return struct.unpack('>Q', key)[0]
+
+class KeyIndex:
+    """
+    The ordered record ids of a collection, stored as runs of consecutive
+    ids.  Records are appended with increasing ids, so a collection that
+    has never had a record deleted is a single run however large it is,
+    and every delete adds at most one run.  Each run costs 24 bytes.
+
+    Supports ``len()``, positional indexing and slicing (returning ids),
+    iteration, ``append`` and ``pop``.
+
+    ``changed`` is set whenever the index changes in a way that alters
+    ``to_bytes()``, other than by ``pop()``, so the persisted copy is only
+    rewritten when needed.  ``removed`` lists the ids popped since, so
+    they can be persisted on their own.
+    """
+    def __init__(self, ids=()):
+        self.starts = array('Q')
+        self.ends = array('Q')
+        # offsets[i] is the position of the first id in run i
+        self.offsets = array('Q')
+        self.length = 0
+        self.changed = True
+        self.removed = []
+        for record_id in ids:
+            self.append(record_id)
+
+    @classmethod
+    def from_runs(cls, starts, ends):
+        """Builds an index from parallel arrays of run starts and (exclusive) ends"""
+        index = cls()
+        for start, end in zip(starts, ends):
+            index.append_run(start, end)
+        return index
+
+    def append(self, record_id):
+        """Appends an id, which must be greater than every id in the index"""
+        self.append_run(record_id, record_id + 1)
+
+    def append_run(self, start, end):
+        """Appends the ids ``start`` to ``end - 1``"""
+        if end <= start:
+            return
+        if len(self.ends) > 0 and start < self.ends[-1]:
+            raise ValueError("Record ids must be appended in increasing order")
+        if len(self.ends) > 0 and start == self.ends[-1]:
+            self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.offsets.append(self.length)
+            self.changed = True
+        self.length += end - start
+
+    def pop(self, position=-1):
+        """Removes the id at ``position`` and returns it"""
+        position = self._position(position)
+        run = bisect_right(self.offsets, position) - 1
+        record_id = self.starts[run] + position - self.offsets[run]
+        start, end = self.starts[run], self.ends[run]
+
+        if end - start == 1:
+            del self.starts[run]
+            del self.ends[run]
+            del self.offsets[run]
+            later = run
+        elif record_id == start:
+            self.starts[run] += 1
+            later = run + 1
+        elif record_id == end - 1:
+            self.ends[run] -= 1
+            later = run + 1
+        else:
+            self.ends[run] = record_id
+            self.starts.insert(run + 1, record_id + 1)
+            self.ends.insert(run + 1, end)
+            self.offsets.insert(run + 1, self.offsets[run] + record_id - start)
+            later = run + 2
+
+        if later < len(self.offsets):
+            self.offsets[later:] = array('Q', map(sub, self.offsets[later:], repeat(1)))
+        self.length -= 1
+        self.removed.append(record_id)
+        return record_id
+
+    def without(self, record_ids):
+        """Returns a new index without ``record_ids``, built in one pass over the runs"""
+        removed = sorted(set(record_ids))
+        index = KeyIndex()
+        next_removed = 0
+        for start, end in zip(self.starts, self.ends):
+            while next_removed < len(removed) and removed[next_removed] < end:
+                record_id = removed[next_removed]
+                if record_id >= start:
+                    index.append_run(start, record_id)
+                    start = record_id + 1
+                next_removed += 1
+            index.append_run(start, end)
+        return index
+
+    def position(self, record_id):
+        """Returns the position of ``record_id``, or None if it is not in the index"""
+        run = bisect_right(self.starts, record_id) - 1
+        if run < 0 or record_id >= self.ends[run]:
+            return None
+        return self.offsets[run] + record_id - self.starts[run]
+
+    def bisect(self, record_id):
+        """Returns the number of ids in the index that are not greater than ``record_id``"""
+        run = bisect_right(self.starts, record_id) - 1
+        if run < 0:
+            return 0
+        return self.offsets[run] + min(record_id - self.starts[run] + 1, self.ends[run] - self.starts[run])
+
+    def runs(self):
+        """Yields ``(start, end)`` for every run of consecutive ids"""
+        return zip(self.starts, self.ends)
+
+    def to_bytes(self, last_id):
+        """
+        Serializes the runs.  A final run that ends at ``last_id`` is
+        stored as open-ended, so appending further ids to it leaves the
+        serialized form unchanged.
+        """
+        runs = array('Q', bytes(16 * len(self.starts)))
+        runs[0::2] = self.starts
+        runs[1::2] = self.ends
+        if len(runs) > 0 and runs[-1] == last_id + 1:
+            runs[-1] = 0
+        if sys.byteorder != 'little':
+            runs.byteswap()
+        return runs.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, last_id):
+        """Loads an index serialized by ``to_bytes()``"""
+        runs = array('Q')
+        runs.frombytes(data)
+        if sys.byteorder != 'little':
+            runs.byteswap()
+        if len(runs) > 0 and runs[-1] == 0:
+            runs[-1] = last_id + 1
+        # Serialized runs are already sorted and separate, so the arrays are built directly
+        index = cls()
+        index.starts, index.ends = runs[0::2], runs[1::2]
+        lengths = list(map(sub, index.ends, index.starts))
+        index.offsets = array('Q', accumulate([0] + lengths[:-1])) if lengths else array('Q')
+        index.length = sum(lengths)
+        index.changed = False
+        return index
+
+    def subset(self, start, stop):
+        """Returns a new index of the ids at positions ``start`` to ``stop - 1``"""
+        index = KeyIndex()
+        if start >= stop:
+            return index
+        run = max(bisect_right(self.offsets, start) - 1, 0)
+        while run < len(self.starts) and self.offsets[run] < stop:
+            first = self.starts[run] + max(start - self.offsets[run], 0)
+            last = self.starts[run] + min(stop - self.offsets[run], self.ends[run] - self.starts[run])
+            index.append_run(first, last)
+            run += 1
+        return index
+
+    def copy(self):
+        index = KeyIndex()
+        index.starts = array('Q', self.starts)
+        index.ends = array('Q', self.ends)
+        index.offsets = array('Q', self.offsets)
+        index.length = self.length
+        index.changed = self.changed
+        index.removed = list(self.removed)
+        return index
+
+    def __contains__(self, record_id):
+        return self.position(record_id) is not None
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(self.length))]
+        position = self._position(position)
+        run = bisect_right(self.offsets, position) - 1
+        return self.starts[run] + position - self.offsets[run]
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            for record_id in range(start, end):
+                yield record_id
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if not isinstance(other, KeyIndex):
+            return NotImplemented
+        return list(self.runs()) == list(other.runs())
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__, list(self.runs()))
+
+    def _position(self, position):
+        if position < 0:
+            position += self.length
+        if position < 0 or position >= self.length:
+            raise IndexError("Collection index out of range")
+        return position
@@ -0,0 +1,78 @@
+"""
+Helpers for running collection operations in a pool of worker processes.
+
+Only one process can open a LevelDB database, so the parent process reads
+chunks of encoded records and writes the results back, while the workers
+decode and process the chunks.  Functions sent to the workers must be
+picklable, i.e. defined at the top level of a module rather than lambdas.
+"""
+from collections import deque
+from functools import reduce
+from itertools import tee
+from concurrent.futures import ProcessPoolExecutor
+
+from .sortkey import encode_sort_key
+
+def chunks(iterable, chunk_size):
+    """Yields lists of up to ``chunk_size`` consecutive items from ``iterable``"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def imap_ordered(function, args, chunk_iterable, workers):
+    """
+    Yields ``function(*args, chunk)`` for every chunk, computed in ``workers``
+    processes and returned in the original chunk order.  At most two chunks
+    per worker are in flight, so memory use does not depend on the input size.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunk_iterable:
+            pending.append(executor.submit(function, *(tuple(args) + (chunk,))))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def imap_keyed_chunks(function, args, pairs, chunk_size, workers):
+    """
+    Splits an iterable of ``(key, value)`` pairs into chunks and yields each
+    chunk together with ``function(*args, values)`` computed for its values
+    by ``imap_ordered``.
+    """
+    chunk_iterable, value_source = tee(chunks(pairs, chunk_size))
+    value_chunks = ([value for _, value in chunk] for chunk in value_source)
+    return zip(chunk_iterable, imap_ordered(function, args, value_chunks, workers))
+
+def map_chunk(function, decoder, encoder, values):
+    return [encoder.encode(function(decoder.decode(value))) for value in values]
+
+def filter_chunk(function, codec, values):
+    return [bool(function(codec.decode(value))) for value in values]
+
+def reduce_chunk(function, codec, initializer, values):
+    records = (codec.decode(value) for value in values)
+    if initializer is not None:
+        return reduce(function, records, initializer)
+    return reduce(function, records)
+
+def key_chunk(key_fn, codec, values):
+    return [key_fn(codec.decode(value)) for value in values]
+
+def reduce_by_key_chunk(key_fn, function, initializer, codec, values):
+    """Reduces a chunk into ``(key, partial)`` pairs, one per key in the chunk"""
+    partials = {}
+    for value in values:
+        record = codec.decode(value)
+        key = key_fn(record)
+        sort_key = encode_sort_key(key)
+        if sort_key in partials:
+            partials[sort_key][1] = function(partials[sort_key][1], record)
+        else:
+            partials[sort_key] = [key, record if initializer is None else function(initializer, record)]
+    return [tuple(partial) for partial in partials.values()]
@@ -0,0 +1,153 @@
+"""
+Lazy pipelines of map and filter stages.
+"""
+from contextlib import ExitStack
+from functools import reduce
+from .keyindex import decode_key
+
+class Pipeline:
+    """
+    A lazy chain of map and filter stages over a collection.  Nothing is
+    read until the pipeline is consumed with ``into()``, ``reduce()`` or
+    iteration.  All stages then run in one streaming pass over the source
+    collection, so every record is read and decoded once and every
+    surviving record is encoded and written once, without intermediate
+    collections.  Use ``persist()`` to keep an intermediate result.
+
+    Stage methods return a new pipeline, so a pipeline can be extended in
+    several directions.
+
+    This class should never be instantiated directly.  Use the ``Collection.pipeline()`` method instead
+    """
+    def __init__(self, source, stages=()):
+        self.source = source
+        self.stages = tuple(stages)
+
+    def map(self, function):
+        """
+        Adds a map stage.
+
+        | Arguments:
+        | ``function`` -- The function used for mapping.
+        """
+        return Pipeline(self.source, self.stages + (('map', function),))
+
+    def filter(self, function):
+        """
+        Adds a filter stage.
+
+        | Arguments:
+        | ``function`` -- The function used for filtering.
+        """
+        return Pipeline(self.source, self.stages + (('filter', function),))
+
+    def persist(self, collection_name, **kwargs):
+        """
+        Adds a stage that writes the records reaching it into a collection
+        while the pipeline runs, and passes them on unchanged.
+
+        | Arguments:
+        | ``collection_name`` -- The name of the collection to insert the records into.
+            Any existing values will be deleted.
+
+        | Keyword arguments:
+        | Passed to ``DB.collection()``, e.g. ``create_if_missing``, ``error_if_exists`` or ``codec``
+        """
+        return Pipeline(self.source, self.stages + (('persist', (collection_name, kwargs)),))
+
+    def into(self, new_collection, **kwargs):
+        """
+        Runs the pipeline and writes its output into a collection.
+
+        | Arguments:
+        | ``new_collection`` -- The name of the collection to insert the output into.
+            Any existing values will be deleted.
+            If ``None``, the output replaces the source collection's records in place.
+
+        | Keyword arguments:
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        source = self.source
+        with ExitStack() as stack:
+            if new_collection in [None, source.name]:
+                collection = source
+                with source.lock:
+                    source._mutated()
+                    source._replace_records(source._checked((decode_key(key), source.codec.encode(record))
+                        for key, record, keep in self._run(stack) if keep))
+            else:
+                collection = self._target(new_collection, kwargs)
+                stack.enter_context(collection.batch())
+                for _, record, keep in self._run(stack):
+                    if keep:
+                        collection.append(record)
+
+        return collection
+
+    def reduce(self, function, new_collection, initializer=None, **kwargs):
+        """
+        Runs the pipeline and reduces its output into a collection.
+
+        | Arguments:
+        | ``function`` -- The function used for reducing.
+        | ``new_collection`` -- The name of the collection to insert the new value into.
+            Any existing values will be deleted.
+
+        | Keyword arguments:
+        | ``initializer`` -- (Optional) The value the reduction starts from
+        | ``create_if_missing`` -- when False a ValueError is raised if the new collection doesn't exist
+        | ``error_if_exists`` -- When True a ValueError is raised if the new collection already exists
+        """
+        if initializer != None:
+            reduced = reduce(function, self, initializer)
+        else:
+            reduced = reduce(function, self)
+
+        collection = self._target(new_collection, kwargs)
+        collection.append(reduced)
+        return collection
+
+    def __iter__(self):
+        with ExitStack() as stack:
+            for _, record, keep in self._run(stack):
+                if keep:
+                    yield record
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__, self.source.name,
+            [kind for kind, _ in self.stages])
+
+    def _target(self, collection_name, kwargs):
+        if collection_name in [None, self.source.name]:
+            raise ValueError("Cannot write pipeline stages into the source collection '{0}'"
+                .format(self.source.name))
+        return self.source.parent_db.collection(collection_name, reset_collection=True, **kwargs)
+
+    def _run(self, stack):
+        """
+        Streams the source collection through every stage, yielding each
+        source key with the record it became and whether it survived.
+        """
+        stages = []
+        for kind, argument in self.stages:
+            if kind == 'persist':
+                collection_name, kwargs = argument
+                argument = self._target(collection_name, kwargs)
+                stack.enter_context(argument.batch())
+            stages.append((kind, argument))
+
+        decode = self.source.codec.decode
+        for key, value in self.source._scan(include_key=True):
+            record = decode(value)
+            keep = True
+            for kind, argument in stages:
+                if kind == 'map':
+                    record = argument(record)
+                elif kind == 'filter':
+                    if not argument(record):
+                        keep = False
+                        break
+                else:
+                    argument.append(record)
+            yield key, record, keep
@@ -0,0 +1,82 @@
+"""
+Order-preserving encoding of record values as LevelDB keys.
+
+``encode_sort_key(a) < encode_sort_key(b)`` (comparing bytes) whenever
+``a < b`` for values of the same kind, so LevelDB range scans return
+values in sorted order.  Values of different kinds sort as
+None < booleans < numbers < strings < bytes < lists and tuples.
+Encoded values are self-delimiting, so further bytes can be appended to
+them without changing their order.
+
+Numbers are encoded as the nearest 64-bit float followed by the exact
+difference between the number and that float, so integers beyond 2**53
+keep their order and equal numbers such as ``1`` and ``1.0`` encode
+equally.  Integers too large for a float raise OverflowError.
+"""
+import struct
+
+_NONE = b'\x01'
+_BOOL = b'\x02'
+_NUMBER = b'\x03'
+_STRING = b'\x04'
+_BYTES = b'\x05'
+_SEQUENCE = b'\x06'
+
+def encode_sort_key(value):
+    """Returns the order-preserving key for ``value``"""
+    if value is None:
+        return _NONE
+    if isinstance(value, bool):
+        return _BOOL + (b'\x01' if value else b'\x00')
+    if isinstance(value, (int, float)):
+        return _NUMBER + _encode_number(value)
+    if isinstance(value, str):
+        return _STRING + _escape(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return _BYTES + _escape(value)
+    if isinstance(value, (list, tuple)):
+        return _SEQUENCE + b''.join(encode_sort_key(item) for item in value) + b'\x00'
+    raise TypeError("Cannot build a sort key for {0}".format(type(value).__name__))
+
+def prefix_end(prefix):
+    """
+    Returns the smallest key greater than every key starting with
+    ``prefix``, or None if there is no such key.
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+def _encode_number(value):
+    number = float(value)
+    if number == 0:
+        # -0.0 == 0.0, so they must encode equally
+        number = 0.0
+    difference = 0
+    if isinstance(value, int):
+        difference = value - int(number)
+    return _encode_float(number) + _encode_difference(difference)
+
+def _encode_difference(difference):
+    # Zero, or a sign byte, a length byte and the magnitude, complemented
+    # when negative so that larger magnitudes sort first
+    if difference == 0:
+        return b'\x01'
+    magnitude = abs(difference)
+    data = magnitude.to_bytes((magnitude.bit_length() + 7) // 8, 'big')
+    if difference > 0:
+        return b'\x02' + bytes([len(data)]) + data
+    return b'\x00' + bytes([255 - len(data)]) + bytes(255 - byte for byte in data)
+
+def _encode_float(number):
+    data = bytearray(struct.pack('>d', number))
+    if data[0] & 0x80:
+        data = bytearray(255 - byte for byte in data)
+    else:
+        data[0] |= 0x80
+    return bytes(data)
+
+def _escape(data):
+    # \x00 terminates the value, so literal \x00 bytes become \x00\xff
+    return data.replace(b'\x00', b'\x00\xff') + b'\x00\x00'
@@ -1,2 +1 @@
-env/bin/python -m pytest test/test_pypeline.py
-env3/bin/python -m pytest test/test_pypeline.py
\ No newline at end of file
+env3/bin/python -m pytest test/test_pypeline.py
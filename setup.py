@@ -30,13 +30,26 @@ setup(
     classifiers=[
         "Development Status :: 4 - Beta",
         "License :: OSI Approved :: MIT License",
-        "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Intended Audience :: Science/Research",
         "Operating System :: POSIX",
         "Topic :: Utilities",
         "Topic :: Database",
         "Topic :: Scientific/Engineering",
     ],
-    install_requires=['plyvel']
+    python_requires='>=3.7',
+    install_requires=['plyvel'],
+    extras_require={
+        'msgpack': ['msgpack'],
+        'numpy': ['numpy'],
+        'pandas': ['pandas'],
+        'arrow': ['pyarrow>=14'],
+        'all': ['msgpack', 'numpy', 'pandas', 'pyarrow>=14'],
+    }
 )
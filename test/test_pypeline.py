@@ -6,6 +6,7 @@ import plyvel, json
 import pytest
 
 from pypeline import DB
+from pypeline.DB import encode_key
 from pypeline._version import schema_version
 
 
@@ -50,6 +51,7 @@ def test_db_creation(db_dir):
     test_db = DB(db_dir, create_if_missing=True)
     assert os.path.isdir(db_dir) == True
     assert isinstance(test_db, DB) == True
+    test_db.close()
 
 def test_db_schema(db_dir):
     test_db = DB(db_dir, create_if_missing=True)
@@ -214,6 +216,44 @@ def test_database_reloading(db_dir):
     test_db2 = DB(db_dir)
     assert test_db2.collection('test')[0] == 6
     assert len(test_db2.collection('test')) == 1
+    test_db2.close()
+
+def test_key_index_log(db_dir, monkeypatch):
+    import sys
+    monkeypatch.setattr(sys.modules['pypeline.DB'], 'MIN_KEY_LOG', 3)
+    test_db = DB(db_dir, create_if_missing=True, background_reclaim=False)
+    c1 = test_db.collection('test')
+    c1.append_all(range(20))
+    index = test_db.db.get(b'collection-index/test')
+    # Deletes are logged without rewriting the index
+    c1.delete(5)
+    c1.delete(0)
+    assert test_db.db.get(b'collection-index/test') == index
+    assert c1.metadata['key_log']['length'] == 2
+    test_db.close()
+
+    test_db = DB(db_dir, background_reclaim=False)
+    c1 = test_db.collection('test')
+    assert list(c1) == [1, 2, 3, 4] + list(range(6, 20))
+    assert c1.verify() == True
+    # The index is rewritten once the log outgrows it
+    c1.delete(-1)
+    c1.delete(-1)
+    assert 'key_log' not in c1.metadata
+    assert test_db.db.get(b'collection-index/test') != index
+    c1.delete(0)
+    test_db.reclaim()
+    assert len(list(test_db.db.iterator(prefix=b'collection-key-log/'))) == 1
+    test_db.close()
+
+    test_db = DB(db_dir, background_reclaim=False)
+    c1 = test_db.collection('test')
+    assert list(c1) == [2, 3, 4] + list(range(6, 18))
+    assert c1.verify() == True
+    test_db.delete('test')
+    test_db.reclaim()
+    assert list(test_db.db.iterator(prefix=b'collection-key-log/')) == []
+    test_db.close()
 
 def test_maps(db):
     c1 = db.collection('c1')
@@ -270,4 +310,1270 @@ def test_random_subset(db):
     with pytest.raises(ValueError):
         c1.random_subset(5, 'c2', error_if_exists=True)
     with pytest.raises(ValueError):
-        c1.random_subset(5, 'c5', create_if_missing=False)
\ No newline at end of file
+        c1.random_subset(5, 'c5', create_if_missing=False)
+
+def test_keys_sort_in_insertion_order(db_dir):
+    test_db = DB(db_dir, create_if_missing=True)
+    c1 = test_db.collection('test')
+    c1.append_all(range(25))
+    test_db.close()
+
+    test_db2 = DB(db_dir)
+    c2 = test_db2.collection('test')
+    assert [instance for instance in c2] == list(range(25))
+    c2.append(25)
+    assert c2[-1] == 25
+    assert len(c2) == 26
+    test_db2.close()
+
+def test_schema_1_migration(db_dir):
+    old_db = plyvel.DB(db_dir, create_if_missing=True)
+    old_db.put(b'pypeline-schema-version', json.dumps('1').encode())
+    old_db.put(b'collections/test', b'true')
+    for index in range(1, 13):
+        old_db.put('collection-items/test!!{0}'.format(index).encode(), json.dumps(index).encode())
+    old_db.close()
+
+    test_db = DB(db_dir)
+    assert test_db.schema_version == schema_version
+    c1 = test_db.collection('test')
+    assert [instance for instance in c1] == list(range(1, 13))
+    c1.append(13)
+    assert c1[-1] == 13
+    assert len(c1) == 13
+    test_db.close()
+
+def test_schema_4_migration(db_dir):
+    test_db = DB(db_dir, create_if_missing=True)
+    c1 = test_db.collection('test')
+    c1.create_index('n')
+    c1.append_all([{'n': 2**60 + n} for n in range(3)])
+    test_db.close()
+
+    # Indexes written with schema 4 are rebuilt when the database is opened
+    old_db = plyvel.DB(db_dir)
+    old_db.put(b'pypeline-schema-version', json.dumps('4').encode())
+    for key in old_db.iterator(prefix=b'collection-indexes/', include_value=False):
+        old_db.delete(key)
+    old_db.close()
+
+    test_db = DB(db_dir)
+    assert test_db.schema_version == schema_version
+    c1 = test_db.collection('test')
+    assert c1.find(n=2**60 + 1) == [{'n': 2**60 + 1}]
+    assert c1.verify() == True
+    test_db.close()
+
+def test_iterator_ranges(collection):
+    collection.append_all(range(10))
+    collection.delete(3)
+
+    assert list(collection.iterator()) == [0,1,2,4,5,6,7,8,9]
+    assert list(collection.iterator(2, 5)) == [2,4,5]
+    assert list(collection.iterator(-3)) == [7,8,9]
+    assert list(collection.iterator(5, 2)) == []
+    assert list(collection.iterator(fill_cache=False)) == [0,1,2,4,5,6,7,8,9]
+    assert collection[1:4] == [1,2,4]
+    assert collection[::4] == [0,5,9]
+
+def test_collection_batch(collection):
+    with collection.batch(batch_size=3) as batch:
+        collection.append_all(range(4))
+        # The first three writes filled a batch and were committed
+        assert batch.size == 1
+        assert collection.db.get(encode_key(collection.keys[2])) is not None
+        assert collection.db.get(encode_key(collection.keys[3])) is None
+        # Pending records are not counted until they are readable
+        assert len(collection) == 3
+        assert collection[len(collection)-1] == 2
+        collection.append(4)
+        collection[0] = 10
+    assert len(collection) == 5
+    assert [instance for instance in collection] == [10,1,2,3,4]
+
+    with collection.batch(batch_bytes=1):
+        collection.delete(0)
+        assert collection._batch.size == 0
+    assert [instance for instance in collection] == [1,2,3,4]
+
+def test_batched_bulk_operations(db_dir):
+    test_db = DB(db_dir, create_if_missing=True, batch_size=7, sync=True)
+    c1 = test_db.collection('c1')
+    c1.append_all(range(50))
+    c1.map(lambda x: x*2, None)
+    c1.filter(lambda x: x % 3 == 0, None)
+    c1.map(lambda x: x+1, 'c2')
+    c1.delete_all()
+    test_db.close()
+
+    test_db2 = DB(db_dir)
+    assert len(test_db2.collection('c1')) == 0
+    assert [instance for instance in test_db2.collection('c2')] == [x*2+1 for x in range(50) if x*2 % 3 == 0]
+    test_db2.close()
+
+def test_record_writes_commit_together(db_dir):
+    test_db = DB(db_dir, create_if_missing=True, batch_size=1)
+    c1 = test_db.collection('c1')
+    c1.create_index('x')
+    c1.create_column('x')
+    with c1.batch():
+        for n in range(3):
+            c1.append({'x': n})
+            assert len(c1) == n + 1
+            assert c1.find(x=n) == [{'x': n}]
+            assert c1.column('x') == list(range(n + 1))
+        c1[0] = {'x': 10}
+        assert c1.find(x=10) == [{'x': 10}] and c1.find(x=0) == []
+        c1.delete(1)
+        assert len(c1) == 2 and c1.find(x=1) == []
+    test_db.close()
+
+    # A process killed between a record's writes leaves none of them behind
+    run_script(db_dir, """
+c1 = db.collection('c1')
+c1.create_index('exit', key=lambda record: os._exit(0) if record['x'] == 4 else record['x'])
+c1.append_all({'x': n} for n in range(3, 6))
+""", batch_size=1)
+    test_db2 = DB(db_dir)
+    c1 = test_db2.collection('c1')
+    assert c1.verify() == True
+    assert c1[:] == [{'x': 10}, {'x': 2}, {'x': 3}]
+    assert c1.column('x') == [10, 2, 3]
+    assert c1.find(x=3) == [{'x': 3}] and c1.find(x=4) == []
+    test_db2.close()
+
+def run_script(db_dir, script, **kwargs):
+    """Runs ``script`` with ``db`` opened on ``db_dir`` in another process, which may exit without closing it"""
+    import subprocess, sys
+    source = "import os\nfrom pypeline import DB\ndb = DB({0!r}, **{1!r})\n{2}".format(db_dir, kwargs, script)
+    subprocess.check_call([sys.executable, '-c', source],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def test_reset_reclaims_old_records(db_dir):
+    test_db = DB(db_dir, create_if_missing=True, background_reclaim=False)
+    c1 = test_db.collection('c1')
+    c1.append_all(range(10))
+    old_prefix = b'collection-items/' + c1.prefix
+
+    c1 = test_db.collection('c1', reset_collection=True)
+    assert len(c1) == 0
+    assert list(c1) == []
+    assert len(list(test_db.db.iterator(prefix=old_prefix))) == 10
+
+    c1.append_all(range(3))
+    test_db.reclaim()
+    assert len(list(test_db.db.iterator(prefix=old_prefix))) == 0
+    assert list(c1) == [0,1,2]
+
+    test_db.delete('c1')
+    c1 = test_db.collection('c1')
+    assert len(c1) == 0
+    test_db.reclaim()
+    c1.append(5)
+    test_db.close()
+
+    test_db2 = DB(db_dir)
+    assert list(test_db2.collection('c1')) == [5]
+    assert list(test_db2.garbage_set.iterator()) == []
+    test_db2.close()
+
+def test_reclaim_during_replacement(db_dir):
+    import threading
+    test_db = DB(db_dir, create_if_missing=True, background_reclaim=False)
+    a = test_db.collection('a')
+    a.append_all(range(100))
+    b = a.clone('b')
+    a.delete_all()
+    listed, resume = threading.Event(), threading.Event()
+
+    # Pauses reclaim() between listing garbage/ and deleting what it listed
+    class PausedListing:
+        def __init__(self, garbage_set):
+            self.garbage_set = garbage_set
+
+        def iterator(self, **kwargs):
+            prefixes = list(self.garbage_set.iterator(**kwargs))
+            listed.set()
+            resume.wait()
+            return iter(prefixes)
+
+        def __getattr__(self, name):
+            return getattr(self.garbage_set, name)
+
+    test_db.garbage_set = PausedListing(test_db.garbage_set)
+    reclaimer = threading.Thread(target=test_db.reclaim)
+    original_records = b._records
+
+    def paused_records():
+        # Runs once the replacement's prefix is listed under garbage/
+        reclaimer.start()
+        listed.wait()
+        for item in original_records():
+            yield item
+
+    b._records = paused_records
+    b.materialize()
+    resume.set()
+    reclaimer.join()
+
+    assert len(b) == 100
+    assert list(b) == list(range(100))
+    assert b[0] == 0
+    test_db.garbage_set = test_db.garbage_set.garbage_set
+    test_db.reclaim()
+    assert list(b) == list(range(100))
+    test_db.close()
+
+def test_background_reclaim_survives_errors(db, monkeypatch):
+    import threading
+    calls = []
+    retried = threading.Event()
+
+    def failing_reclaim():
+        calls.append(None)
+        if len(calls) == 1:
+            raise IOError('disk full')
+        retried.set()
+
+    monkeypatch.setattr(db, 'reclaim', failing_reclaim)
+    with pytest.warns(RuntimeWarning, match='disk full'):
+        db._schedule_reclaim()
+        while not retried.wait(0.01):
+            db._schedule_reclaim()
+
+def test_collection_codecs(db_dir):
+    import numpy
+    test_db = DB(db_dir, create_if_missing=True)
+    c1 = test_db.collection('pickled', codec='pickle')
+    c1.append((1, {2, 3}))
+    c2 = test_db.collection('raw', codec='raw')
+    c2.append(b'\x00\x01')
+    with pytest.raises(TypeError):
+        c2.append(u'text')
+    c3 = test_db.collection('arrays', codec='numpy')
+    c3.append(numpy.arange(6, dtype='int16').reshape(2, 3))
+    assert c1.map(lambda x: x[0], 'mapped', codec='pickle')[:] == [1]
+    with pytest.raises(ValueError):
+        test_db.collection('pickled', codec='json')
+    with pytest.raises(ValueError):
+        test_db.collection('unknown', codec='nonexistant-codec')
+    test_db.close()
+
+    test_db2 = DB(db_dir)
+    assert test_db2.collection('pickled')[0] == (1, {2, 3})
+    assert test_db2.collection('raw')[:] == [b'\x00\x01']
+    array = test_db2.collection('arrays')[0]
+    assert array.dtype == numpy.dtype('int16')
+    assert array.tolist() == [[0, 1, 2], [3, 4, 5]]
+    assert test_db2.collection('mapped').codec.name == 'pickle'
+    c1 = test_db2.collection('pickled', reset_collection=True, codec='json')
+    c1.append([1])
+    assert c1[0] == [1]
+    test_db2.close()
+
+def test_custom_codec(db):
+    from pypeline import Codec, register_codec
+
+    class UpperCodec(Codec):
+        name = 'upper'
+        def encode(self, obj):
+            return obj.upper().encode()
+        def decode(self, data):
+            return data.decode()
+
+    register_codec(UpperCodec())
+    c1 = db.collection('c1', codec='upper')
+    c1.append_all(['a', 'b'])
+    assert list(c1) == ['A', 'B']
+
+def test_msgpack_codec(db):
+    pytest.importorskip('msgpack')
+    c1 = db.collection('c1', codec='msgpack')
+    c1.append({'a': [1, 2.5, b'bytes']})
+    assert c1[0] == {'a': [1, 2.5, b'bytes']}
+
+def add_one(x):
+    return x + 1
+
+def is_even(x):
+    return x % 2 == 0
+
+def test_parallel_map_filter(db):
+    c1 = db.collection('c1')
+    c1.append_all(range(100))
+    c2 = c1.map(add_one, 'c2', workers=3, chunk_size=7)
+    assert list(c2) == list(range(1, 101))
+    c1.map(add_one, None, workers=2, chunk_size=10)
+    assert list(c1) == list(range(1, 101))
+
+    c3 = c1.filter(is_even, 'c3', workers=3, chunk_size=9, codec='pickle')
+    assert list(c3) == list(range(2, 101, 2))
+    c1.filter(is_even, None, workers=2, chunk_size=16)
+    assert list(c1) == list(range(2, 101, 2))
+    assert len(c1) == 50
+    c1.refresh()
+    assert len(c1) == 50
+
+def add(x, y):
+    return x + y
+
+def count_parity(counts, x):
+    counts = dict(counts)
+    key = 'even' if x % 2 == 0 else 'odd'
+    counts[key] = counts.get(key, 0) + 1
+    return counts
+
+def merge_counts(a, b):
+    return dict((key, a.get(key, 0) + b.get(key, 0)) for key in set(a) | set(b))
+
+def test_parallel_reduce(db):
+    c1 = db.collection('c1')
+    c1.append_all(range(1000))
+    c2 = c1.reduce(add, 'c2', combiner=add, workers=3, chunk_size=64)
+    assert c2[:] == [sum(range(1000))]
+
+    c1.reduce(count_parity, 'c2', initializer={}, combiner=merge_counts, workers=2, chunk_size=100)
+    assert c2[:] == [{'even': 500, 'odd': 500}]
+
+    # Without a combiner the reduction stays serial, so lambdas still work
+    c1.reduce(lambda x, y: x + y, 'c2', workers=4)
+    assert c2[:] == [sum(range(1000))]
+
+def test_pipeline(db):
+    c1 = db.collection('c1')
+    c1.append_all(range(10))
+
+    pipeline = c1.pipeline().map(lambda x: x * 3).filter(lambda x: x % 2 == 0)
+    assert list(pipeline) == [0, 6, 12, 18, 24]
+
+    out = pipeline.persist('tripled_evens').map(lambda x: x + 1).into('out')
+    assert list(out) == [1, 7, 13, 19, 25]
+    assert list(db.collection('tripled_evens')) == [0, 6, 12, 18, 24]
+    assert list(c1) == list(range(10))
+
+    total = c1.pipeline().filter(lambda x: x > 5).reduce(lambda x, y: x + y, 'total')
+    assert total[:] == [6 + 7 + 8 + 9]
+
+    c1.pipeline().filter(lambda x: x < 4).map(lambda x: -x).into(None)
+    assert list(c1) == [0, -1, -2, -3]
+    c1.refresh()
+    assert len(c1) == 4
+
+    with pytest.raises(ValueError):
+        c1.pipeline().persist('c1').into('out')
+    with pytest.raises(ValueError):
+        c1.pipeline().into('out', error_if_exists=True)
+
+def test_key_index(collection):
+    collection.append_all(range(20))
+    assert len(list(collection.keys.runs())) == 1
+
+    collection.delete(5)
+    collection.delete(0)
+    collection.delete(-1)
+    assert list(collection.keys.runs()) == [(2, 6), (7, 20)]
+    expected = [x for x in range(20) if x not in (0, 5, 19)]
+    assert list(collection) == expected
+    assert collection[4:8] == expected[4:8]
+    assert collection[-2] == expected[-2]
+    assert len(collection) == 17
+
+    collection.append(20)
+    collection.refresh()
+    assert list(collection) == expected + [20]
+    with pytest.raises(IndexError):
+        collection.delete(18)
+
+def test_persisted_index(db_dir):
+    test_db = DB(db_dir, create_if_missing=True)
+    c1 = test_db.collection('test')
+    c1.append_all(range(10))
+    c1.delete(3)
+    c1.delete(-1)
+    c1.filter(lambda x: x != 5, None)
+    test_db.close()
+
+    raw = plyvel.DB(db_dir)
+    metadata = json.loads(raw.get(b'collections/test').decode())
+    assert metadata['length'] == 7
+    assert metadata['last_index'] == 10
+    assert 'rewriting' not in metadata
+    assert raw.get(b'collection-index/test') is not None
+    raw.close()
+
+    test_db2 = DB(db_dir)
+    c2 = test_db2.collection('test')
+    assert len(c2) == 7
+    assert list(c2) == [0, 1, 2, 4, 6, 7, 8]
+    assert c2.verify() == True
+    # Ids are never reused, even after the last record was deleted
+    c2.append(10)
+    assert c2.keys[-1] == 11
+
+    c2.db.delete(encode_key(1))
+    assert c2.verify(repair=False) == False
+    assert c2.verify() == False
+    assert list(c2) == [1, 2, 4, 6, 7, 8, 10]
+    assert c2.verify() == True
+    test_db2.close()
+
+def test_interrupted_rewrite_is_repaired(db_dir):
+    test_db = DB(db_dir, create_if_missing=True)
+    c1 = test_db.collection('test')
+    c1.append_all(range(10))
+
+    def failing_filter(x):
+        if x == 6:
+            raise RuntimeError()
+        return x % 2 == 0
+
+    # An interrupted in-place filter leaves the records alone
+    with pytest.raises(RuntimeError):
+        c1.filter(failing_filter, None)
+    assert list(c1) == list(range(10))
+    assert len(c1) == 10
+    c1.delete(1)
+    test_db.close()
+
+    # Simulate a process that stopped in the middle of a rewrite
+    raw = plyvel.DB(db_dir)
+    metadata = json.loads(raw.get(b'collections/test').decode())
+    metadata['rewriting'] = True
+    metadata['length'] = 10
+    raw.put(b'collections/test', json.dumps(metadata).encode())
+    raw.close()
+
+    test_db2 = DB(db_dir)
+    c2 = test_db2.collection('test')
+    assert len(c2) == 9
+    assert list(c2) == [0, 2, 3, 4, 5, 6, 7, 8, 9]
+    assert c2.verify() == True
+    test_db2.close()
+
+def test_sort_keys_preserve_order():
+    from pypeline.sortkey import encode_sort_key
+    values = [None, False, True, -1e300, -2, -1.5, 0, 0.25, 1, 3, 1e300,
+        u'', u'a', u'a\x00', u'ab', u'b', b'', b'\x00', b'a',
+        [], [1], [1, u'a'], [1, u'b'], [2], (3, 4)]
+    keys = [encode_sort_key(value) for value in values]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+
+    # Integers beyond 2**53 are ordered exactly, also among nearby floats
+    big = [-2**70 - 1, -2**70, -2**60 - 1, -float(2**60), -2**60 + 1, 2**53, 2**53 + 1,
+        float(2**60), 2**60 + 1, 2**60 + 2, 2**64, 2**64 + 1, 1e300]
+    keys = [encode_sort_key(value) for value in big]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == len(keys)
+    assert encode_sort_key(1) == encode_sort_key(1.0)
+    assert encode_sort_key(-0.0) == encode_sort_key(0)
+    with pytest.raises(TypeError):
+        encode_sort_key({'a': 1})
+
+def test_secondary_indexes(db_dir):
+    test_db = DB(db_dir, create_if_missing=True)
+    c1 = test_db.collection('events')
+    c1.append_all({'user': user, 'n': n} for n, user in enumerate(['a', 'b', 'a', 'c', 'b', 'a']))
+    c1.append('not a dict')
+    c1.create_index('user')
+    c1.create_index('parity', key=lambda record: isinstance(record, dict) and record['n'] % 2)
+
+    assert [r['n'] for r in c1.find(user='a')] == [0, 2, 5]
+    assert [r['n'] for r in c1.find(user='a', parity=1)] == [5]
+    assert c1.find(user='z') == []
+    assert [r['n'] for r in c1.range('user', 'b', 'c')] == [1, 4, 3]
+    assert [r['n'] for r in c1.range('user', low='b')] == [1, 4, 3]
+
+    c1.append({'user': 'c', 'n': 6})
+    c1[0] = {'user': 'c', 'n': 0}
+    c1.delete(2)
+    assert [r['n'] for r in c1.find(user='c')] == [0, 3, 6]
+    assert [r['n'] for r in c1.find(user='a')] == [5]
+
+    c1.map(lambda r: dict(r, user=r['user'].upper()) if isinstance(r, dict) else r, None)
+    assert [r['n'] for r in c1.find(user='C')] == [0, 3, 6]
+    c1.filter(lambda r: isinstance(r, dict) and r['n'] > 0, None)
+    assert [r['n'] for r in c1.find(user='C')] == [3, 6]
+    c2 = c1.filter(lambda r: r['n'] > 3, 'c2')
+    c2.create_index('user')
+    assert [r['n'] for r in c2.find(user='B')] == [4]
+    # Lists and tuples share sort keys and match each other
+    c3 = test_db.collection('pairs')
+    c3.create_index('t')
+    c3.append({'t': [1, [2, 3]]})
+    assert len(c3.find(t=(1, (2, 3)))) == 1 and len(c3.find(t=[1, [2, 3]])) == 1
+
+    with pytest.raises(ValueError):
+        c1.find(missing=1)
+    test_db.close()
+
+    test_db2 = DB(db_dir)
+    c1 = test_db2.collection('events')
+    assert [r['n'] for r in c1.find(user='C')] == [3, 6]
+    # Key function indexes must be bound again, and are rebuilt if written to meanwhile
+    with pytest.raises(ValueError):
+        c1.find(parity=1)
+    c1.append({'user': 'D', 'n': 7})
+    c1.create_index('parity', key=lambda record: record['n'] % 2)
+    assert [r['n'] for r in c1.find(parity=1)] == [1, 3, 5, 7]
+
+    c1.drop_index('parity')
+    with pytest.raises(ValueError):
+        c1.find(parity=1)
+    test_db2.collection('events', reset_collection=True)
+    assert c1.find(user='C') == []
+    c1.append({'user': 'C', 'n': 8})
+    assert [r['n'] for r in c1.find(user='C')] == [8]
+    test_db2.close()
+
+def test_record_cache(db_dir):
+    test_db = DB(db_dir, create_if_missing=True, cache_entries=3)
+    c1 = test_db.collection('c1')
+    c1.append_all(range(10))
+
+    assert c1[0] == 0
+    assert c1[0] == 0
+    assert c1.cache.hits == 1
+    assert c1.cache.misses == 1
+    for i in range(5):
+        c1[i]
+    assert len(c1.cache) == 3
+
+    c1[4] = 40
+    assert c1[4] == 40
+    c1.delete(0)
+    assert c1[0] == 1
+    c1.map(lambda x: x * 2, None)
+    assert c1[0] == 2
+    c1.filter(lambda x: x > 10, None)
+    assert c1[:2] == [80, 12]
+    test_db.collection('c1', reset_collection=True)
+    c1.append(5)
+    assert c1[0] == 5
+
+    c2 = test_db.collection('c2')
+    cache = c2.enable_cache(max_bytes=4)
+    c2.append_all([u'ab', u'cd'])
+    c2[0]
+    c2[1]
+    c2[1]
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 1, 'entries': 1, 'bytes': 4}
+    assert test_db.record_cache.hits == c1.cache.hits
+    c2.disable_cache()
+    assert c2.cache is test_db.record_cache
+    test_db.close()
+
+def test_random_subset_sampling(db):
+    c1 = db.collection('c1')
+    c1.append_all({'n': n, 'group': n % 3} for n in range(100))
+    c1.create_index('group')
+
+    c2 = c1.random_subset(10, 'c2', seed=7)
+    c3 = c1.random_subset(10, 'c3', seed=7)
+    assert list(c2) == list(c3)
+    assert len(c2) == 10
+    ns = [record['n'] for record in c2]
+    assert ns == sorted(ns)
+
+    c4 = c1.random_subset(5, 'c4', seed=1, weight=lambda record: 1 if record['n'] < 10 else 0)
+    assert sorted(record['n'] for record in c4) == [record['n'] for record in c4]
+    assert all(record['n'] < 10 for record in c4)
+    assert len(c4) == 5
+
+    c5 = c1.random_subset(4, 'c5', seed=2, stratify=lambda record: record['group'], codec='pickle')
+    assert sorted(record['group'] for record in c5) == [0]*4 + [1]*4 + [2]*4
+
+    assert len(c1.random_subset(1000, 'c6')) == 100
+
+    c1.random_subset(6, None, seed=3)
+    assert len(c1) == 6
+    assert c1.verify() == True
+    ns = [record['n'] for record in c1]
+    assert ns == sorted(ns)
+    assert sorted(record['n'] for group in range(3) for record in c1.find(group=group)) == ns
+    c1.random_subset(2, None, stratify=lambda record: record['group'] == 0)
+    assert len(c1) <= 4
+    c1.append({'n': 100, 'group': 1})
+    assert c1[-1] == {'n': 100, 'group': 1}
+    assert c1.verify() == True
+
+def test_pandas_export(db):
+    pandas = pytest.importorskip('pandas')
+    c1 = db.collection('c1')
+    assert len(c1.to_pandas()) == 0
+    c1.append_all({'a': n, 'b': str(n)} for n in range(5))
+    c1.append({'a': 5, 'c': True})
+
+    frame = c1.to_pandas()
+    assert list(frame.columns) == ['a', 'b', 'c']
+    assert list(frame['a']) == list(range(6))
+    assert pandas.isna(frame['b'][5]) and frame['c'][5] == True
+    assert list(c1.to_pandas(columns=['b']).columns) == ['b']
+
+    chunks = list(c1.to_pandas(chunksize=4))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    assert list(chunks[1].index) == [4, 5]
+    assert pandas.concat(chunks)['a'].tolist() == list(range(6))
+
+    c2 = db.collection('c2')
+    c2.append_dataframe(frame[['a', 'b']], chunksize=4)
+    assert len(c2) == 6
+    assert c2[0] == {'a': 0, 'b': '0'}
+    assert type(c2[0]['a']) == int
+    c3 = db.collection('c3')
+    c3.append_dataframe(pandas.DataFrame({'x': [1.5]}, index=['row']), index=True)
+    assert c3[0] == {'index': 'row', 'x': 1.5}
+
+def test_numpy_export(db):
+    numpy = pytest.importorskip('numpy')
+    c1 = db.collection('c1')
+    c1.append_all({'a': n} for n in range(4))
+    assert c1.to_numpy('a').tolist() == [0, 1, 2, 3]
+    assert c1.to_numpy('a', dtype='float32').dtype == numpy.float32
+
+    c2 = db.collection('c2', codec='numpy')
+    c2.append_all(numpy.arange(6).reshape(3, 2) + n for n in range(3))
+    stacked = c2.to_numpy()
+    assert stacked.shape == (3, 3, 2)
+    assert stacked[2, 0].tolist() == [2, 3]
+    assert db.collection('c3').to_numpy(dtype='int64').shape == (0,)
+
+def test_arrow_export(db):
+    pytest.importorskip('pyarrow')
+    c1 = db.collection('c1')
+    c1.append_all({'a': n} for n in range(5))
+    table = c1.to_arrow(chunksize=2)
+    assert table.num_rows == 5
+    assert table.column('a').to_pylist() == list(range(5))
+
+def test_file_import_export(db, tmpdir):
+    c1 = db.collection('c1')
+    c1.append_all({'a': n, 'b': 'x\ny' if n == 2 else str(n)} for n in range(5))
+    c1.append({'a': 5, 'c': [1]})
+
+    path = str(tmpdir.join('records.jsonl'))
+    c1.export_file(path)
+    assert open(path, 'rb').read().count(b'\n') == 6
+    c2 = db.collection('c2', codec='pickle')
+    c2.import_file(path)
+    assert list(c2) == list(c1)
+    c2.export_file(str(tmpdir.join('pickled.ndjson')))
+    c3 = db.collection('c3')
+    c3.import_file(str(tmpdir.join('pickled.ndjson')), workers=2, chunk_size=2)
+    assert list(c3) == list(c1)
+
+    path = str(tmpdir.join('records.csv'))
+    c1.export_file(path)
+    assert open(path).readline().strip() == 'a,b,c'
+    c4 = db.collection('c4')
+    c4.import_file(path)
+    assert c4[2] == {'a': '2', 'b': 'x\ny', 'c': ''}
+    c1.export_file(path, columns=['b'])
+    c4.delete_all()
+    c4.import_file(path, format='csv')
+    assert c4[0] == {'b': '0'}
+
+    with pytest.raises(ValueError):
+        c1.export_file(str(tmpdir.join('records.txt')))
+    # A .json file is a single document unless format='jsonl' says otherwise
+    with pytest.raises(ValueError):
+        c1.export_file(str(tmpdir.join('records.json')))
+    c1.export_file(str(tmpdir.join('records.json')), format='jsonl')
+    c5 = db.collection('c5')
+    c5.import_file(str(tmpdir.join('records.json')), format='jsonl')
+    assert list(c5) == list(c1)
+
+def test_parquet_import_export(db, tmpdir):
+    pytest.importorskip('pyarrow')
+    c1 = db.collection('c1')
+    c1.append_all({'a': n, 'b': str(n)} for n in range(5))
+    path = str(tmpdir.join('records.parquet'))
+    c1.export_file(path, chunk_size=2)
+    c2 = db.collection('c2')
+    c2.import_file(path, chunk_size=2)
+    assert list(c2) == list(c1)
+
+    # Column types that change at a chunk boundary
+    c3 = db.collection('c3')
+    c3.append_all([{'x': 1, 'y': None}, {'x': 2, 'y': None}, {'x': 2.5, 'y': 3}])
+    c3.export_file(path, chunk_size=2)
+    c4 = db.collection('c4')
+    c4.import_file(path)
+    assert list(c4) == [{'x': 1.0, 'y': None}, {'x': 2.0, 'y': None}, {'x': 2.5, 'y': 3}]
+
+    import pyarrow
+    c3.export_file(path, columns=['y'], chunk_size=2,
+        schema=pyarrow.schema([('x', pyarrow.float32()), ('y', pyarrow.int8())]))
+    c4 = db.collection('c4', reset_collection=True)
+    c4.import_file(path)
+    assert list(c4) == [{'y': None}, {'y': None}, {'y': 3}]
+
+def test_async_api(db_dir):
+    import asyncio
+    from pypeline.aio import AsyncDB
+
+    async def main():
+        adb = AsyncDB(db_dir, create_if_missing=True)
+        c1 = await adb.collection('c1')
+        writes = []
+        original_write = c1._write
+        def counting_write(record_lists):
+            writes.append(len(record_lists))
+            return original_write(record_lists)
+        c1._write = counting_write
+
+        await asyncio.gather(*[c1.append_many([n, n + 100]) for n in range(20)] + [c1.append(-1)])
+        assert len(c1) == 41
+        assert sum(writes) == 21 and len(writes) < 21
+        assert await c1.get(0) == 0
+        assert await c1.get(slice(0, 2)) == [0, 100]
+
+        records = [record async for record in c1.iterator(chunk_size=7)]
+        assert sorted(records) == sorted(list(range(20)) + list(range(100, 120)) + [-1])
+
+        c2 = await c1.map(add_one, 'c2')
+        c3 = await c2.filter(is_even, None)
+        assert c3 is c2
+        assert len([record async for record in c2]) == 21
+
+        with pytest.raises(TypeError):
+            await c1.append(set())
+        assert len(c1) == 41
+        # A rejected append only fails its own caller
+        results = await asyncio.gather(c1.append_many([1, 2]), c1.append_many([3, set()]), c1.append(4),
+            return_exceptions=True)
+        assert results[0] is None and isinstance(results[1], TypeError) and results[2] is None
+        assert await c1.get(slice(41, None)) == [1, 2, 4]
+        await adb.close()
+
+    asyncio.run(main())
+
+def test_concurrent_appends_and_reads(db):
+    import threading
+    c1 = db.collection('c1')
+    c1.enable_cache(max_entries=100)
+    c1.create_index('n')
+    c1.append({'n': -1})
+    errors = []
+
+    def write(offset):
+        try:
+            for n in range(offset, offset + 200):
+                if n % 50 == 0:
+                    with c1.batch():
+                        c1.append({'n': n})
+                        c1.append({'n': n + 10000})
+                else:
+                    c1.append({'n': n})
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            for _ in range(200):
+                length = len(c1)
+                assert isinstance(c1[0], dict) and isinstance(c1[-1], dict)
+                assert all(isinstance(record, dict) for record in c1[::7])
+                assert len(list(c1.iterator(0, length))) <= len(c1)
+                assert c1.find(n=-1) == [{'n': -1}]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(offset,)) for offset in range(0, 1000, 200)]
+    threads += [threading.Thread(target=read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(c1) == 1021
+    assert c1.verify() == True
+    assert sorted(record['n'] for record in c1)[1:1001] == list(range(1000))
+    c1.refresh()
+    assert len(c1) == 1021 and c1.last_index == 1021
+
+def test_reads_during_in_place_rewrites(db_dir):
+    import threading
+    test_db = DB(db_dir, create_if_missing=True, batch_size=50)
+    c1 = test_db.collection('c1')
+    c1.append_all({'n': n} for n in range(2000))
+    c1.create_index('n')
+    c1.create_column('n')
+    done = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            while not done.is_set():
+                with c1.snapshot() as view:
+                    records = list(view)
+                    assert len(records) == len(view)
+                    assert view[len(view) - 1] == records[-1]
+                    assert view.column('n') == [record['n'] for record in records]
+                assert isinstance(c1[1], dict)
+                assert len(c1.find(n=1998)) <= 1
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    c1.filter(lambda record: record['n'] % 3 != 1, None)
+    c1.map(lambda record: {'n': record['n'] * 2}, None)
+    c1.pipeline().filter(lambda record: record['n'] % 4 == 0).into(None)
+    done.set()
+    for reader in readers:
+        reader.join()
+
+    assert errors == []
+    expected = [n * 2 for n in range(2000) if n % 3 != 1 and n % 2 == 0]
+    assert [record['n'] for record in c1] == expected
+    assert c1.column('n') == expected
+    assert c1.find(n=expected[-1]) == [{'n': expected[-1]}] and c1.find(n=2) == []
+    assert c1.verify() == True
+    test_db.close()
+
+def test_snapshot(db):
+    c1 = db.collection('c1')
+    c1.create_index('n')
+    c1.append_all({'n': n} for n in range(10))
+
+    with c1.snapshot() as view:
+        scan = view.iterator()
+        assert next(scan) == {'n': 0}
+        c1.append({'n': 10})
+        c1[1] = {'n': 100}
+        c1.delete(2)
+        assert [record['n'] for record in scan] == list(range(1, 10))
+        assert len(view) == 10 and len(c1) == 10
+        assert view[1] == {'n': 1} and view[-1] == {'n': 9}
+        assert view[::4] == [{'n': 0}, {'n': 4}, {'n': 8}]
+        assert view.find(n=2) == [{'n': 2}] and c1.find(n=2) == []
+        assert view.range('n', 8) == [{'n': 8}, {'n': 9}]
+        assert view.reduce(lambda total, record: total + record['n'], initializer=0) == 45
+        assert view.map(lambda record: record['n'], 'c2')[:] == list(range(10))
+        assert len(view.filter(lambda record: record['n'] % 2, 'c3')) == 5
+        with pytest.raises(ValueError):
+            view.map(lambda record: record, None)
+
+        c1.delete_all()
+        assert len(view) == 10 and view[9] == {'n': 9}
+
+    assert len(c1) == 0
+
+def test_clone(db):
+    c1 = db.collection('c1')
+    c1.append_all({'n': n} for n in range(10))
+
+    c2 = c1.clone('c2')
+    c3 = db.copy_collection('c1', 'c3', 2, 6)
+    assert list(c2) == list(c1)
+    assert [record['n'] for record in c3] == [2, 3, 4, 5]
+    assert c2.layers == c1.layers == c3.layers and len(c1.layers) == 1
+
+    # Writes to either side stay on that side
+    c1[0] = {'n': 100}
+    c1.append({'n': 10})
+    c2[1] = {'n': 101}
+    c2.delete(2)
+    c2.append({'n': 11})
+    c3.delete(0)
+    assert [record['n'] for record in c1] == [100] + list(range(1, 11))
+    assert [record['n'] for record in c2] == [0, 101] + list(range(3, 10)) + [11]
+    assert [record['n'] for record in c3] == [3, 4, 5]
+    assert c2[-1] == {'n': 11} and c2[::4] == [{'n': 0}, {'n': 5}, {'n': 9}]
+    assert c2.verify() == True
+
+    # Clones of clones stack layers
+    c4 = c2.clone('c4', end=3)
+    assert [record['n'] for record in c4] == [0, 101, 3]
+    assert len(c4.layers) == 2
+    c4.create_index('n')
+    assert c4.find(n=101) == [{'n': 101}]
+
+    c2.filter(lambda record: record['n'] % 2 == 1, None)
+    assert [record['n'] for record in c2] == [101, 3, 5, 7, 9, 11]
+    assert [record['n'] for record in c4] == [0, 101, 3]
+
+    # Shared layers survive until nothing reads them
+    db.delete('c1')
+    c2.materialize()
+    assert c2.layers == []
+    assert [record['n'] for record in c2] == [101, 3, 5, 7, 9, 11]
+    db.reclaim()
+    assert [record['n'] for record in c3] == [3, 4, 5]
+    assert [record['n'] for record in c4] == [0, 101, 3]
+    c3.delete_all()
+    c4.materialize()
+    db.reclaim()
+    assert [record['n'] for record in c4] == [0, 101, 3]
+    assert c4.find(n=3) == [{'n': 3}]
+    c4.refresh()
+    assert c4.verify() == True and len(c4) == 3
+    for name in ['c2', 'c3', 'c4']:
+        db.delete(name)
+    db.reclaim()
+    assert list(db.db.iterator(prefix=b'collection-items/')) == []
+
+    # Repeated copies after appends don't stack layers without bound
+    from pypeline.DB import MAX_LAYERS
+    c5 = db.collection('c5')
+    for n in range(MAX_LAYERS * 2 + 1):
+        c5.append(n)
+        copy = db.copy_collection('c5', 'copy{0}'.format(n))
+        assert len(c5.layers) <= MAX_LAYERS
+    assert list(db.collection('copy0')) == [0]
+    assert list(copy) == list(c5) == list(range(MAX_LAYERS * 2 + 1))
+
+def double(x):
+    return x * 2
+
+def test_incremental_map_filter(db):
+    calls = []
+    def tracked_double(x):
+        calls.append(x)
+        return x * 2
+
+    c1 = db.collection('c1')
+    c1.append_all(range(5))
+    assert c1.map(tracked_double, 'doubled', incremental=True)[:] == [0, 2, 4, 6, 8]
+    c1.append_all(range(5, 8))
+    del calls[:]
+    assert c1.map(tracked_double, 'doubled', incremental=True)[:] == [0, 2, 4, 6, 8, 10, 12, 14]
+    assert calls == [5, 6, 7]
+    c1.filter(is_even, 'evens')
+    c1.append(8)
+    assert c1.filter(is_even, 'evens', incremental=True)[:] == [0, 2, 4, 6, 8]
+    c1.append(9)
+    assert c1.filter(is_even, 'evens', incremental=True, workers=2)[:] == [0, 2, 4, 6, 8]
+    assert c1.map(double, 'doubled2', incremental=True, workers=2)[:] == [x * 2 for x in range(10)]
+
+    del calls[:]
+    c1.map(tracked_double, 'doubled', incremental=True)
+    assert calls == [8, 9]
+    # Nothing new
+    c1.map(tracked_double, 'doubled', incremental=True)
+    assert calls == [8, 9]
+    assert db.collection('doubled')[:] == [x * 2 for x in range(8)] + [16, 18]
+
+    # Changes to existing records, or a different function, rebuild everything
+    c1[0] = 100
+    del calls[:]
+    assert c1.map(tracked_double, 'doubled', incremental=True)[:] == [200] + [x * 2 for x in range(1, 10)]
+    assert len(calls) == 10
+    assert c1.map(add_one, 'doubled', incremental=True)[:] == [101] + list(range(2, 11))
+    # Lambdas of the same scope are told apart by their code
+    maps = [lambda x: x + 1, lambda x: x - 1]
+    assert c1.map(maps[0], 'lambdas', incremental=True)[:] == [101] + list(range(2, 11))
+    assert c1.map(maps[1], 'lambdas', incremental=True)[:] == [99] + list(range(0, 9))
+    # Partials are told apart by their arguments, and callable objects always rebuild
+    from functools import partial
+    assert c1.map(partial(scale, 2), 'scaled', incremental=True)[:3] == [200, 2, 4]
+    assert c1.map(partial(scale, 100), 'scaled', incremental=True)[:3] == [10000, 100, 200]
+    class Scale:
+        factor = 2
+        def __call__(self, x):
+            return x * self.factor
+    scaler = Scale()
+    assert c1.map(scaler, 'scaled', incremental=True)[:3] == [200, 2, 4]
+    Scale.factor = 3
+    assert c1.map(scaler, 'scaled', incremental=True)[:3] == [300, 3, 6]
+    c1.delete(0)
+    assert c1.filter(is_even, 'evens', incremental=True)[:] == [2, 4, 6, 8]
+    c1.delete_all()
+    c1.append(3)
+    assert c1.map(add_one, 'doubled', incremental=True)[:] == [4]
+
+    # A recreated source is not mistaken for the old one
+    db.delete('c1')
+    c1 = db.collection('c1')
+    c1.append_all([1, 2])
+    assert c1.map(add_one, 'doubled', incremental=True)[:] == [2, 3]
+
+def test_interrupted_incremental_map(db_dir):
+    test_db = DB(db_dir, create_if_missing=True)
+    test_db.collection('c1').append_all(range(7))
+    test_db.close()
+
+    # The first run is killed partway through, the second finishes it
+    script = """
+def times_ten(x):
+    if x == 4 and not os.path.exists(db.marker):
+        open(db.marker, 'w').close()
+        os._exit(0)
+    return x * 10
+db.marker = {0!r}
+db.collection('c1').map(times_ten, 'c2', incremental=True)
+""".format(db_dir + '-marker')
+    try:
+        run_script(db_dir, script, batch_size=2)
+        test_db2 = DB(db_dir)
+        assert test_db2.collection('c2')[:] == [0, 10, 20, 30]
+        test_db2.close()
+        run_script(db_dir, script, batch_size=2)
+    finally:
+        os.remove(db_dir + '-marker')
+    test_db3 = DB(db_dir)
+    assert test_db3.collection('c2')[:] == [x * 10 for x in range(7)]
+    test_db3.close()
+
+def scale(factor, x):
+    return factor * x
+
+def last_digit(x):
+    return x % 10
+
+def test_group_by(db_dir):
+    db = DB(db_dir, create_if_missing=True, background_reclaim=False)
+    c1 = db.collection('c1')
+    c1.append_all(range(100))
+
+    by_digit = [[digit, list(range(digit, 100, 10))] for digit in range(10)]
+    assert c1.group_by(last_digit, list, 'groups')[:] == by_digit
+    # Spilling to disk keeps groups in key order and records in collection order
+    assert c1.group_by(last_digit, list, 'groups', max_entries=7)[:] == by_digit
+    assert c1.group_by(last_digit, len, 'groups', workers=2, chunk_size=16)[:] == \
+        [[digit, 10] for digit in range(10)]
+    assert c1.group_by(is_even, sum, 'groups')[:] == [[False, 2500], [True, 2450]]
+
+    sums = [[digit, sum(range(digit, 100, 10))] for digit in range(10)]
+    assert c1.reduce_by_key(last_digit, add, 'sums')[:] == sums
+    assert c1.reduce_by_key(last_digit, add, 'sums', max_entries=3)[:] == sums
+    assert c1.reduce_by_key(last_digit, add, 'sums', combiner=add, max_entries=3)[:] == sums
+    assert c1.reduce_by_key(last_digit, add, 'sums', initializer=0, combiner=add,
+        workers=2, chunk_size=16, max_entries=3)[:] == sums
+    assert c1.reduce_by_key(lambda x: 'n', add, 'sums', initializer=1000)[:] == [['n', 1000 + 4950]]
+
+    # Integer keys beyond 2**53 are separate groups
+    big = db.collection('big')
+    big.append_all([2**60 + 2, 2**60, 2**60 + 1, 2**60])
+    grouped = [[2**60, [2**60, 2**60]], [2**60 + 1, [2**60 + 1]], [2**60 + 2, [2**60 + 2]]]
+    assert big.group_by(lambda x: x, list, 'groups')[:] == grouped
+    assert big.group_by(lambda x: x, list, 'groups', max_entries=1)[:] == grouped
+    assert big.reduce_by_key(lambda x: x, add, 'sums', combiner=add, max_entries=1)[:] == \
+        [[2**60, 2**61], [2**60 + 1, 2**60 + 1], [2**60 + 2, 2**60 + 2]]
+
+    # Spilled scratch data is reclaimed
+    assert list(db.db.iterator(prefix=b'scratch/')) != []
+    db.reclaim()
+    assert list(db.db.iterator(prefix=b'scratch/')) == []
+
+    c1.group_by(is_even, len, None)
+    assert c1[:] == [[False, 50], [True, 50]]
+    db.close()
+
+def test_sort(db):
+    c1 = db.collection('c1')
+    c1.append_all([{'name': name, 'n': n} for n, name in enumerate('dbacdbe')])
+
+    assert [r['name'] for r in c1.sort(lambda r: r['name'], 'sorted')] == list('abbcdde')
+    # Ties keep their collection order in both directions
+    assert [r['n'] for r in c1.sort(lambda r: r['name'], 'sorted')] == [2, 1, 5, 3, 0, 4, 6]
+    assert [r['n'] for r in c1.sort(lambda r: r['name'], 'sorted', reverse=True)] == [6, 0, 4, 3, 1, 5, 2]
+    assert c1.sort(lambda r: [r['name'], -r['n']], 'sorted', codec='pickle')[:2] == \
+        [{'name': 'a', 'n': 2}, {'name': 'b', 'n': 5}]
+
+    c2 = db.collection('c2')
+    c2.append_all([3, -1.5, 10, 0, 2])
+    assert c2.sort(add_one, 'sorted', workers=2, chunk_size=2)[:] == [-1.5, 0, 2, 3, 10]
+    c2.sort(add_one, None, reverse=True)
+    assert c2[:] == [10, 3, 2, 0, -1.5]
+
+    # Integers beyond 2**53 are sorted exactly
+    c3 = db.collection('c3')
+    c3.append_all([2**60 + 2, 2**60, 2**60 + 1, -2**60 - 1, -2**60])
+    assert c3.sort(add_one, 'sorted', workers=2, chunk_size=2)[:] == \
+        [-2**60 - 1, -2**60, 2**60, 2**60 + 1, 2**60 + 2]
+    assert len(c2) == 5
+
+def test_join(db):
+    users = db.collection('users')
+    users.append_all([{'id': 1, 'name': 'ann'}, {'id': 2, 'name': 'bob'}, {'id': 3, 'name': 'cy'}])
+    orders = db.collection('orders')
+    orders.append_all([{'user': 2, 'item': 'pen'}, {'user': 1, 'item': 'ink'},
+        {'user': 2, 'item': 'pad'}, {'user': 4, 'item': 'cup'}])
+
+    def names(collection):
+        return [[user and user['name'], order and order['item']] for user, order in collection]
+
+    expected_inner = [['ann', 'ink'], ['bob', 'pen'], ['bob', 'pad']]
+    expected_left = expected_inner + [['cy', None]]
+    by_user = lambda r: r['user']
+    by_id = lambda r: r['id']
+    # Hash joins, with either side in memory, and a sort-merge join
+    assert names(db.join('users', 'orders', by_id, by_user, 'joined')) == expected_inner
+    assert names(db.join('users', 'orders', by_id, by_user, 'joined', max_entries=3)) == \
+        [['bob', 'pen'], ['ann', 'ink'], ['bob', 'pad']]
+    assert names(db.join('users', 'orders', by_id, by_user, 'joined', max_entries=2)) == expected_inner
+    assert names(db.join('users', 'orders', by_id, by_user, 'joined', how='left')) == expected_left
+    assert names(db.join('users', 'orders', by_id, by_user, 'joined', how='left', max_entries=1)) == expected_left
+    joined = db.join('orders', 'users', by_user, by_id, 'joined', how='left', max_entries=1)
+    assert [[order['item'], user and user['name']] for order, user in joined] == \
+        [['ink', 'ann'], ['pen', 'bob'], ['pad', 'bob'], ['cup', None]]
+
+    # Integer keys beyond 2**53 only match equal keys
+    big_users = db.collection('big_users')
+    big_users.append_all([{'id': 2**60 + n, 'name': name} for n, name in enumerate(['ann', 'bob'])])
+    big_orders = db.collection('big_orders')
+    big_orders.append_all([{'user': 2**60 + 1, 'item': 'pen'}, {'user': 2**60 + 2, 'item': 'cup'}])
+    for max_entries in (100, 1):
+        joined = db.join('big_users', 'big_orders', by_id, by_user, 'joined', how='left', max_entries=max_entries)
+        assert names(joined) == [['ann', None], ['bob', 'pen']]
+
+    with pytest.raises(ValueError):
+        db.join('users', 'orders', by_id, by_user, 'joined', how='outer')
+    with pytest.raises(ValueError):
+        db.join('users', 'orders', by_id, by_user, 'users')
+
+def test_field_reads(db_dir):
+    db = DB(db_dir, create_if_missing=True, background_reclaim=False)
+    c1 = db.collection('c1')
+    c1.append_all([{'a': n, 'b': str(n), 'wide': 'x' * 100} for n in range(10)])
+    c1.append([1, 2])
+    c1.append({'b': 'no a'})
+
+    def check():
+        assert c1.column('a') == list(range(10)) + [None, None]
+        assert c1.column('a', 2, 4) == [2, 3]
+        assert list(c1.iterator(fields=['a', 'b'], start=9)) == [{'a': 9, 'b': '9'}, {}, {'b': 'no a'}]
+        with c1.snapshot() as view:
+            assert view.column('b', -1) == ['no a']
+
+    check()
+    c1.create_column('a')
+    c1.create_column('b')
+    assert sorted(c1.columns) == ['a', 'b']
+    check()
+
+    # Only the stored column is read
+    prefix = c1.columns['a'].prefix
+    assert len(list(db.db.iterator(prefix=prefix))) == 10
+    for record_id in range(1, 12):
+        db.db.delete(c1.db.prefix + encode_key(record_id))
+    assert c1.column('a') == list(range(10)) + [None, None]
+    c1.delete_all()
+
+    c1.append_all([{'a': n} for n in range(5)])
+    c1[0] = {'a': 100}
+    c1.delete(1)
+    c1.append({'a': 5})
+    assert c1.column('a') == [100, 2, 3, 4, 5]
+    c1.clone('c2')
+    c2 = db.collection('c2')
+    c2.create_column('a')
+    c2[1] = {'a': 'two'}
+    assert c2.column('a') == [100, 'two', 3, 4, 5]
+    assert c1.column('a') == [100, 2, 3, 4, 5]
+    c1.filter(lambda record: record['a'] % 2, None)
+    assert c1.column('a') == [3, 5]
+
+    # Columns survive reopening
+    db.close()
+    db = DB(db_dir, background_reclaim=False)
+    c1 = db.collection('c1')
+    assert sorted(c1.columns) == ['a', 'b']
+    assert c1.column('a') == [3, 5]
+    c1.drop_column('a')
+    assert c1.column('a') == [3, 5]
+    db.reclaim()
+    assert list(db.db.iterator(prefix=prefix)) == []
+    db.close()
+
+def test_columnar_layout(db_dir):
+    numpy = pytest.importorskip('numpy')
+    db = DB(db_dir, create_if_missing=True, background_reclaim=False)
+    c1 = db.collection('c1', layout='columnar')
+    assert c1.layout == 'columnar'
+    c1.set_layout('records')
+    c1.set_layout('columnar', chunk_size=4)
+    c1.append_all([{'x': n, 'y': n * 0.5} for n in range(10)])
+    c1.append({'x': 10, 'y': 5})
+
+    batches = list(c1.batches())
+    assert [len(batch['x']) for batch in batches] == [3, 4, 4]
+    assert numpy.concatenate([batch['x'] for batch in batches]).tolist() == list(range(11))
+    assert c1.reduce_batches(lambda total, batch: total + batch['x'].sum(), 'total', initializer=0)[:] == [55]
+    doubled = c1.map_batches(lambda batch: {'x': batch['x'] * 2}, 'doubled', layout='columnar')
+    assert doubled.layout == 'columnar'
+    assert doubled.column('x') == [n * 2 for n in range(11)]
+
+    # The record-level API keeps working and keeps the chunks up to date
+    assert c1[3] == {'x': 3, 'y': 1.5}
+    c1[3] = {'x': 30, 'y': 0.25}
+    c1.delete(0)
+    with c1.batch():
+        for n in range(11, 14):
+            c1.append({'x': n, 'y': 0})
+        c1.delete(4)
+    xs = [record['x'] for record in c1]
+    assert numpy.concatenate([batch['x'] for batch in c1.batches(['x'])]).tolist() == xs
+    assert c1.map_batches(lambda batch: batch['y'] > 1, 'big')[:] == [record['y'] > 1 for record in c1]
+    with pytest.raises(ValueError):
+        c1.append({'x': 'one', 'y': 1})
+    with pytest.raises(ValueError):
+        c1.append({'x': 1})
+    with pytest.raises(ValueError):
+        c1.append({'x': 2**70, 'y': 1})
+    # Values must fit the dtype their field took from the first record
+    with pytest.raises(ValueError):
+        c1.append({'x': 1.5, 'y': 1})
+    with pytest.raises(ValueError):
+        c1.append({'x': 1, 'y': 2**53 + 1})
+    with pytest.raises(ValueError):
+        c1[0] = [1, 2]
+    assert [record['x'] for record in c1] == xs
+
+    # In-place rewrites check their records too
+    with pytest.raises(ValueError):
+        c1.map(lambda record: 5, None)
+    with pytest.raises(ValueError):
+        c1.pipeline().map(lambda record: {'x': str(record['x']), 'y': 0}).into(None)
+    assert [record['x'] for record in c1] == xs
+    c1.map(lambda record: {'x': record['x'] * 2, 'y': record['y']}, None)
+    xs = [x * 2 for x in xs]
+    assert numpy.concatenate([batch['x'] for batch in c1.batches(['x'])]).tolist() == xs
+
+    c1.filter(lambda record: record['x'] % 4 == 0, None)
+    with c1.snapshot() as view:
+        assert view.reduce_batches(lambda total, batch: total + batch['x'].sum(), initializer=0) == \
+            sum(x for x in xs if x % 4 == 0)
+    db.close()
+
+    db = DB(db_dir, background_reclaim=False)
+    c1 = db.collection('c1')
+    assert c1.layout == 'columnar'
+    c1.delete_all()
+    c1.append({'x': 1.5, 'y': 2})
+    assert [batch['x'].tolist() for batch in c1.batches()] == [[1.5]]
+
+    # Single commits add segments to a chunk, which are merged once there are too many
+    c5 = db.collection('c5', layout='columnar')
+    for n in range(40):
+        c5.append({'x': n})
+        c5[0] = {'x': -n}
+    assert [batch['x'].tolist() for batch in c5.batches()] == [[-39] + list(range(1, 40))]
+    c6 = db.collection('c6', layout='columnar')
+    c6.append_all([{'n': 2**53 + 1, 'b': True}, {'n': -2**63, 'b': False}])
+    assert [batch['n'].tolist() for batch in c6.batches()] == [[2**53 + 1, -2**63]]
+    assert c6.map_batches(lambda batch: batch['n'], 'c7')[:] == [2**53 + 1, -2**63]
+    with pytest.raises(ValueError):
+        c6.append({'n': 2.5, 'b': True})
+    with pytest.raises(ValueError):
+        c6.append({'n': 1, 'b': 1})
+    # Records cloned into a columnar collection are added to its chunks
+    c8 = db.collection('c8')
+    c8.append_all({'x': n} for n in range(1, 6))
+    c9 = db.copy_collection('c8', 'c9', layout='columnar')
+    c9.append({'x': 9})
+    assert [batch['x'].tolist() for batch in c9.batches()] == [[1, 2, 3, 4, 5, 9]]
+    assert c9.reduce_batches(lambda total, batch: total + int(batch['x'].sum()), 'c9-total', initializer=0)[:] == [24]
+    with pytest.raises(ValueError):
+        c9.append({'x': 0.5})
+    with pytest.raises(ValueError):
+        db.collection('c2', codec='pickle', layout='columnar').append({'x': 1j})
+    with pytest.raises(ValueError):
+        db.collection('c2', layout='rows')
+    with pytest.raises(ValueError):
+        c1.map_batches(lambda batch: batch, 'c3').map_batches(lambda batch: batch, 'c4')
+    db.close()